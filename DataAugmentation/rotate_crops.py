@@ -5,8 +5,14 @@ import cv2
 import numpy as np
 from PIL import Image, ImageDraw
 from glob import glob
+from multiprocessing import Pool
 # from DataWrangling.Cropping.crop_and_convert_tiff import save_image_as_jpg
 
+## the threaded output sink is shared with the cropping scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataWrangling", "Cropping"))
+from image_sink import ImageSink
+from rotation_table import DEFAULT_ROTATION_TABLE, ROTATION_TABLE_FILENAME, RotationTable
+
 ## get all the images in the directory
 ## create a collection of images that are rotated from -30 to 30 degrees, in 5 degree intervals
 ## save them into a cropped/rotated directory
@@ -41,81 +47,144 @@ def find_crops(images_parent_directory):
     return image_filenames
 
 
-def rotate_image_and_save(image, rotation_angle, image_shape, image_outfile, outfile_parent_directory):
+def rotation_table_filename(rotated_directory, width, height):
+    ## the table of the default crop size keeps the plain name, which Metrics and Plotting look for
+    if (width, height) == (DEFAULT_ROTATION_TABLE.crop_width, DEFAULT_ROTATION_TABLE.crop_height):
+        return os.path.join(rotated_directory, ROTATION_TABLE_FILENAME)
+    return os.path.join(rotated_directory, "%dx%d_%s" % (width, height, ROTATION_TABLE_FILENAME))
+
+
+def rotation_angles(image_rotation_angle_max):
+    ## Angles every crop is rotated by: -max to max degrees, at 5 degree increments
+    return list(range(-image_rotation_angle_max, image_rotation_angle_max + 5, 5))
+
+
+def rotated_name(crop_name, angle):
+    ## Name of a rotated crop, with no extension; Metrics and Plotting read the angle back from it
+    return "%s_%d" % (crop_name, angle)
+
+
+def rotate_crop(image, angles, rotation_table):
     """
         Inputs:
-            - image_filename: The image array of the image to be rotated/translated
-            - rotation_angle: The angle for the image to be rotated
-            - image_shape: The shape tuple of the image
-            - image_outfile: The filepath where the rotated/translated image will be saved
+            - image: The decoded pixels of the crop
+            - angles: The angles the crop is rotated by
+            - rotation_table: RotationTable of the crop size
         Outputs:
-            - rotation_mat: Rotation matrix, accounting for translation, of image
+            - Generator over (angle, rotated image) of every angle, all warped from the one decoded crop
     """
+    for angle in angles:
+        yield angle, cv2.warpAffine(image, rotation_table.forward(angle), rotation_table.canvas(angle))
 
-    ## rotate and translate the image
-    height, width = image_shape[0], image_shape[1]
-    image_center = (width // 2, height // 2)
-    rotation_mat = cv2.getRotationMatrix2D(image_center, rotation_angle, scale=1.0)
-    cos = np.abs(rotation_mat[0, 0])
-    sin = np.abs(rotation_mat[0, 1])
-    
-    adjustedWidth = int((height * sin) + (width * cos))
-    adjustedHeight = int((height * cos) + (width * sin))
- 
-    bounds = (adjustedWidth, adjustedHeight)
-    
-    rotation_mat[0, 2] += (adjustedWidth / 2) - image_center[0]
-    rotation_mat[1, 2] += (adjustedHeight / 2) - image_center[1]
-
-    image = np.array(image)
-
-    rotated_mat = cv2.warpAffine(image, rotation_mat, bounds)
 
-    ## save the image
-    save_image_as_jpg(rotated_mat, image_outfile, outfile_parent_directory)
-    print("Rotated: ", image_outfile)
-    
-    return rotation_mat
-
-def save_rotation_matrix(rotation_matrix, outfile):
+def rotate_crops_into_sink(image_filenames, angles, sink, rotation_tables):
     """
         Inputs:
-            - rotation_matrix: The rotation matrix of the warped image
-            - outfile: The outfile of the rotation matrix save file
+            - image_filenames: The crops to rotate
+            - angles: The angles every crop is rotated by
+            - sink: ImageSink the rotated crops are handed to
+            - rotation_tables: Dictionary of {(width, height): RotationTable}; the tables of new crop sizes are added to it
+        Outputs:
+            - failed_crops: List of (filename, error message) of the crops which could not be decoded
     """
-    np.save(outfile + ".npy", rotation_matrix)
-    print("Saved Rotation Matrix: ", outfile)
+    failed_crops = []
+    for image_filename in image_filenames:
+        ## every crop is decoded once, and all of its angles are warped from that buffer
+        try:
+            image = np.array(Image.open(image_filename))
+        except Exception as e:
+            print("Failed to read %s: %s" % (image_filename, e))
+            failed_crops.append((image_filename, "%s: %s" % (type(e).__name__, e)))
+            continue
+        size = (image.shape[1], image.shape[0])
+        if size not in rotation_tables:
+            rotation_tables[size] = RotationTable(size[0], size[1], angles)
+
+        file_name_no_extension = image_filename.split(os.sep)[-1].split('.')[0]
+        for angle, rotated_mat in rotate_crop(image, angles, rotation_tables[size]):
+            sink.submit(rotated_mat, rotated_name(file_name_no_extension, angle))
+        print("Rotated: ", image_filename)
+    return failed_crops
+
+
+def rotate_crops_worker(arguments):
+    ## Pool entry point; rotates a batch of crops into a sink of its own
+    ## Arguments
+        ## arguments: Tuple of (image_filenames, angles, rotated_directory, num_threads)
+    ## Outputs
+        ## (crop sizes, (succeeded, failed), failed_crops) of the batch
+    image_filenames, angles, rotated_directory, num_threads = arguments
+    rotation_tables = {}
+    with ImageSink(rotated_directory, num_threads=num_threads) as sink:
+        failed_crops = rotate_crops_into_sink(image_filenames, angles, sink, rotation_tables)
+    return (list(rotation_tables), sink.counts(), failed_crops)
 
 
-def driver(images_parent_directory, image_rotation_angle_max):
+## crops handed to a worker at once; each batch opens one sink, so its encoder threads are shared by many crops
+CROPS_PER_TASK = 64
+
+def driver(images_parent_directory, image_rotation_angle_max, num_threads=4, num_workers=1):
     """
         Inputs:
             - images_parent_directory: Where the cropped test-time images live
             - image_rotation_angle_max: The maximal angle of rotation
+            - num_threads: Number of threads encoding the rotated images, per process
+            - num_workers: Number of processes to rotate crops with; 1 rotates them in this process
+        Outputs:
+            - (succeeded, failed): Number of rotated images saved and failed; every angle of a crop
+              which could not be read counts as failed
     """
     ## for all images in test time crop directory
         ## for all angles between -30 and 30 degress at 5 degree increments
             ## save the rotated image
-            ## save the corresponding rotation matrix
-    for image_filename in find_crops(images_parent_directory):
-        
-        image = Image.open(image_filename)
-        width, height = image.size
-        
-        for angle in range(-image_rotation_angle_max, image_rotation_angle_max + 5, 5):
-            ## function to produce the filename of the image, with no extension
-            file_name_no_extension = image_filename.split(os.sep)[-1].split('.')[0]
-            build_string = lambda filename, rotation: "%s_%d" % (filename, rotation)
-            rotation_mat = rotate_image_and_save(image, angle, (width, height), build_string(file_name_no_extension, angle), os.path.join(images_parent_directory, "rotated"))
-            save_rotation_matrix(rotation_mat, os.path.join(images_parent_directory, "rotated", build_string(file_name_no_extension, angle)))
+    ## the rotation matrices only depend on the angle and the crop size, so they are saved once, as a table
+    angles = rotation_angles(image_rotation_angle_max)
+    rotated_directory = os.path.join(images_parent_directory, "rotated")
+    image_filenames = find_crops(images_parent_directory)
+    rotation_tables = {}
+
+    if num_workers <= 1:
+        with ImageSink(rotated_directory, num_threads=num_threads) as sink:
+            failed_crops = rotate_crops_into_sink(image_filenames, angles, sink, rotation_tables)
+        succeeded, failed = sink.counts()
+    else:
+        ## every crop writes its own uniquely named files, so the batches may finish in any order
+        arguments = [(image_filenames[k:k + CROPS_PER_TASK], angles, rotated_directory, num_threads) for k in range(0, len(image_filenames), CROPS_PER_TASK)]
+        succeeded = failed = 0
+        failed_crops = []
+        pool = Pool(processes=num_workers)
+        try:
+            for idx, (sizes, (batch_succeeded, batch_failed), batch_failed_crops) in enumerate(pool.imap_unordered(rotate_crops_worker, arguments)):
+                succeeded += batch_succeeded
+                failed += batch_failed
+                failed_crops += batch_failed_crops
+                for width, height in sizes:
+                    if (width, height) not in rotation_tables:
+                        rotation_tables[(width, height)] = RotationTable(width, height, angles)
+                print("Rotated batch (%d/%d)" % (idx + 1, len(arguments)))
+        finally:
+            pool.close()
+            pool.join()
+
+    for (width, height), rotation_table in rotation_tables.items():
+        rotation_table.save(rotation_table_filename(rotated_directory, width, height))
+        print("Saved Rotation Table: ", rotation_table)
+
+    failed += len(failed_crops) * len(angles)
+    for filename, error in failed_crops:
+        print("Failed: ", filename, error)
+    print("Saved %d rotated images, %d failed" % (succeeded, failed))
+    return (succeeded, failed)
 
 
 if __name__ == "__main__":
     
     crops_parent_directroy = sys.argv[1]
     rotation_max_angle = int(sys.argv[2])
+    ## optional number of processes to rotate the crops with
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
 
     if not os.path.exists(os.path.join(crops_parent_directroy, "rotated")):
         os.mkdir(os.path.join(crops_parent_directroy, "rotated"))
 
-    driver(crops_parent_directroy, rotation_max_angle)
\ No newline at end of file
+    driver(crops_parent_directroy, rotation_max_angle, num_workers=num_workers)
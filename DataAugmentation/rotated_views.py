@@ -0,0 +1,85 @@
+"""
+    Rotated views of the test crops, made as they are read instead of saving 13 rotated JPEG
+    copies of every crop before inference (run_rotation.sh). The views use the geometry of
+    rotate_crops, and every view carries its name, angle and inverse transform, so inference can
+    consume the arrays directly and write predictions which Metrics and Plotting project back
+    onto the maps exactly as they do for saved rotated crops.
+
+    Usage:
+        for name, image, angle, inverse, offset in rotated_views(crops_directory, 30):
+            boxes = ... inference on image ...
+            write_view_predictions(predictions_directory, name, boxes)
+"""
+import io
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+from rotate_crops import find_crops, rotate_crop, rotated_name, rotation_angles
+from rotation_table import RotationTable
+
+## crops may also be read from a harvested crop store
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataWrangling", "Cropping"))
+from crop_store import CropStore, crop_name, is_crop_store
+
+
+def read_crops(crops_source):
+    """
+        Inputs:
+            - crops_source: Directory of cropped test-time JPEGs, or a crop store directory
+        Outputs:
+            - Generator over (crop name, decoded crop pixels) of every crop, each decoded once
+    """
+    if is_crop_store(crops_source):
+        store = CropStore(crops_source)
+        for map_name in store.maps():
+            for x_0, y_0 in store.crop_anchors(map_name).tolist():
+                yield crop_name(map_name, x_0, y_0), np.array(Image.open(io.BytesIO(store.read_image(map_name, x_0, y_0))))
+    else:
+        for image_filename in find_crops(crops_source):
+            yield image_filename.split(os.sep)[-1].split('.')[0], np.array(Image.open(image_filename))
+
+
+def rotated_views(crops_source, image_rotation_angle_max=30, rotation_tables=None):
+    """
+        Inputs:
+            - crops_source: Directory of cropped test-time JPEGs, or a crop store directory
+            - image_rotation_angle_max: The maximal angle of rotation
+            - rotation_tables: Optional dictionary of {(width, height): RotationTable}; the tables of new
+              crop sizes are added to it
+        Outputs:
+            - Generator over (name, rotated image, angle, inverse, offset) of every crop and angle:
+                - name: Name the rotated crop would have been saved under by rotate_crops, with no extension
+                - rotated image: The rotated crop pixels, warped when the view is reached
+                - angle: The angle the crop is rotated by
+                - inverse, offset: The inverse transform of the angle, see RotationTable
+    """
+    angles = rotation_angles(image_rotation_angle_max)
+    if rotation_tables is None:
+        rotation_tables = {}
+    for name, image in read_crops(crops_source):
+        size = (image.shape[1], image.shape[0])
+        if size not in rotation_tables:
+            rotation_tables[size] = RotationTable(size[0], size[1], angles)
+        rotation_table = rotation_tables[size]
+        for angle, rotated_mat in rotate_crop(image, angles, rotation_table):
+            inverse, offset = rotation_table.inverse(angle)
+            yield rotated_name(name, angle), rotated_mat, angle, inverse, offset
+
+
+def write_view_predictions(predictions_directory, name, boxes, scores=None):
+    """
+        Writes the predictions on a view in the format of the inference output, so the rotated
+        Metrics dictionaries and stitching read them with the view's angle
+        Inputs:
+            - predictions_directory: Directory of the predicted annotation files
+            - name: Name of the view, as given by rotated_views
+            - boxes: The 8 point boxes predicted on the view, in view coordinates
+            - scores: Optional confidence of every box, written as a ninth value
+    """
+    with open(os.path.join(predictions_directory, "res_%s.txt" % name), "w") as f:
+        for k, box in enumerate(np.asarray(boxes).reshape(-1, 8).tolist()):
+            values = [str(int(x)) for x in box] + ([repr(float(scores[k]))] if scores is not None else [])
+            f.write(",".join(values) + "\n")
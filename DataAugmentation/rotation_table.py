@@ -0,0 +1,103 @@
+"""
+    Rotation geometry shared by the crop rotation, the Metrics dictionaries and the rotated
+    stitching. The transforms of a rotated crop only depend on the angle and the crop size, so
+    they are computed once per angle and kept in a single table, instead of one .npy file per
+    rotated crop.
+"""
+import cv2
+import numpy as np
+
+## name of the table rotate_crops saves next to the rotated crops
+ROTATION_TABLE_FILENAME = "rotation_table.npz"
+
+
+class RotationTable(object):
+    """
+        Per angle transforms of a crop_width x crop_height crop:
+            - forward: 2x3 affine which warps the crop onto its rotated canvas
+            - inverse: 2x3 affine which rotates a point of the rotated canvas back around the canvas center
+            - offset: Int (x, y) which then moves the canvas center back onto the crop center
+            - canvas: (width, height) of the rotated canvas
+    """
+
+    def __init__(self, crop_width=512, crop_height=512, angles=()):
+        """
+            Inputs:
+                - crop_width: Width of a crop before it is rotated
+                - crop_height: Height of a crop before it is rotated
+                - angles: Angles to precompute; any other angle is computed when first asked for
+        """
+        self.crop_width = int(crop_width)
+        self.crop_height = int(crop_height)
+        ## transforms, keyed on the angle
+        self._transforms = {}
+        for angle in angles:
+            self.transforms(angle)
+
+    def _compute(self, angle):
+        width, height = self.crop_width, self.crop_height
+        image_center = (width // 2, height // 2)
+        rotation_mat = cv2.getRotationMatrix2D(image_center, angle, scale=1.0)
+        cos = np.abs(rotation_mat[0, 0])
+        sin = np.abs(rotation_mat[0, 1])
+
+        adjustedWidth = int((height * sin) + (width * cos))
+        adjustedHeight = int((height * cos) + (width * sin))
+
+        ## the forward warp is translated so the rotated crop is centered on its canvas
+        forward = rotation_mat.copy()
+        forward[0, 2] += (adjustedWidth / 2) - image_center[0]
+        forward[1, 2] += (adjustedHeight / 2) - image_center[1]
+
+        ## predictions are rotated back around the center of the canvas, then moved onto the crop
+        cX, cY = (adjustedWidth // 2, adjustedHeight // 2)
+        inverse = cv2.getRotationMatrix2D((cX, cY), -angle, 1.0)
+        offset = np.array([int((width / 2) - cX), int((height / 2) - cY)])
+        return forward, inverse, offset, (adjustedWidth, adjustedHeight)
+
+    def transforms(self, angle):
+        """
+            Inputs:
+                - angle: Angle the crop is rotated by, in degrees
+            Outputs:
+                - (forward, inverse, offset, canvas) of the angle, see RotationTable
+        """
+        key = float(angle)
+        if key not in self._transforms:
+            self._transforms[key] = self._compute(key)
+        return self._transforms[key]
+
+    def forward(self, angle):
+        return self.transforms(angle)[0]
+
+    def inverse(self, angle):
+        ## (inverse, offset) of the angle
+        return self.transforms(angle)[1:3]
+
+    def canvas(self, angle):
+        return self.transforms(angle)[3]
+
+    def angles(self):
+        return sorted(self._transforms)
+
+    def save(self, filename):
+        angles = self.angles()
+        transforms = [self._transforms[angle] for angle in angles]
+        np.savez(filename, crop_size=np.array([self.crop_width, self.crop_height]), angles=np.array(angles, dtype=np.float64),
+                 forward=np.array([t[0] for t in transforms]).reshape(-1, 2, 3), inverse=np.array([t[1] for t in transforms]).reshape(-1, 2, 3),
+                 offset=np.array([t[2] for t in transforms], dtype=np.int64).reshape(-1, 2), canvas=np.array([t[3] for t in transforms], dtype=np.int64).reshape(-1, 2))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            table = cls(*f["crop_size"].tolist())
+            for k, angle in enumerate(f["angles"].tolist()):
+                table._transforms[angle] = (f["forward"][k], f["inverse"][k], f["offset"][k], tuple(f["canvas"][k].tolist()))
+        return table
+
+    def __repr__(self):
+        return "RotationTable(crop_width=%d, crop_height=%d, angles=%s)" % (self.crop_width, self.crop_height, self.angles())
+
+
+## the 512 x 512 crops every existing rotated directory was produced from
+DEFAULT_ROTATION_TABLE = RotationTable()
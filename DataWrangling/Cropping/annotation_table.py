@@ -0,0 +1,202 @@
+"""
+    Binary annotation table. Every annotation is one fixed-width record:
+        map (int32), anchor_x (int32), anchor_y (int32), class (int32), angle (float32), score (float32),
+        box (8 x float32; x1, y1, ..., x4, y4 relative to the crop anchor)
+    The records are written back to back in <name>.annotations, and the map and class names which the
+    map and class columns index are kept in <name>.annotations.json. Tables are read with np.memmap,
+    so no per-line parsing is needed. A CSV bridge converts to and from text.
+"""
+import csv
+import json
+import os
+import re
+import numpy as np
+from glob import glob
+
+ANNOTATION_DTYPE = np.dtype([
+    ("map", "<i4"),
+    ("anchor_x", "<i4"),
+    ("anchor_y", "<i4"),
+    ("class", "<i4"),
+    ("angle", "<f4"),
+    ("score", "<f4"),
+    ("box", "<f4", (8,))
+])
+
+TABLE_SUFFIX = ".annotations"
+NAMES_SUFFIX = ".annotations.json"
+
+CSV_HEADER = ["map", "anchor_x", "anchor_y", "class", "angle", "score", "x1", "y1", "x2", "y2", "x3", "y3", "x4", "y4"]
+
+def table_filename(name):
+    ## Path of the records of the table called name
+    return name if name.endswith(TABLE_SUFFIX) else name + TABLE_SUFFIX
+
+def is_annotation_table(filename):
+    ## Whether filename is (or names) an annotation table
+    return os.path.isfile(table_filename(filename)) and os.path.isfile(table_filename(filename)[:-len(TABLE_SUFFIX)] + NAMES_SUFFIX)
+
+def create_records(count):
+    ## Empty records; the score column defaults to NaN, meaning no confidence is known
+    records = np.zeros(count, dtype=ANNOTATION_DTYPE)
+    records["score"] = np.nan
+    return records
+
+def write_annotation_table(name, records, map_names, class_names):
+    """
+        Inputs:
+            - name: Path of the table, with or without the .annotations extension
+            - records: Array of ANNOTATION_DTYPE records
+            - map_names: Names indexed by the map column
+            - class_names: Names indexed by the class column
+    """
+    filename = table_filename(name)
+    records = np.asarray(records, dtype=ANNOTATION_DTYPE)
+    records.tofile(filename + ".partial")
+    with open(filename[:-len(TABLE_SUFFIX)] + NAMES_SUFFIX, "w+") as f:
+        json.dump({"maps": [str(m) for m in map_names], "classes": [str(c) for c in class_names]}, f)
+    os.rename(filename + ".partial", filename)
+
+def read_annotation_table(name, mmap=True):
+    """
+        Inputs:
+            - name: Path of the table, with or without the .annotations extension
+            - mmap: Map the records instead of reading them into memory
+        Outputs:
+            - records: Array of ANNOTATION_DTYPE records
+            - map_names: Names indexed by the map column
+            - class_names: Names indexed by the class column
+    """
+    filename = table_filename(name)
+    with open(filename[:-len(TABLE_SUFFIX)] + NAMES_SUFFIX) as f:
+        names = json.load(f)
+    if os.path.getsize(filename) == 0:
+        records = create_records(0)
+    elif mmap:
+        records = np.memmap(filename, dtype=ANNOTATION_DTYPE, mode="r")
+    else:
+        records = np.fromfile(filename, dtype=ANNOTATION_DTYPE)
+    return records, names["maps"], names["classes"]
+
+def select_records(records, names, column, name):
+    ## Records whose map or class column (column) refers to name; empty if name is not in names
+    if name not in names:
+        return records[:0]
+    return records[records[column] == names.index(name)]
+
+def absolute_boxes(records):
+    ## (N, 8) float array of the boxes of records offset by their crop anchors
+    return records["box"] + np.tile(np.stack([records["anchor_x"], records["anchor_y"]], axis=1), 4).astype(np.float32)
+
+def export_csv(name, csv_filename):
+    """
+        Writes a table as CSV, with the map and class names spelled out
+    """
+    records, map_names, class_names = read_annotation_table(name)
+    with open(csv_filename, "w+") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for record in records:
+            writer.writerow([map_names[record["map"]], int(record["anchor_x"]), int(record["anchor_y"]), class_names[record["class"]],
+                             repr(float(record["angle"])), repr(float(record["score"]))] + [repr(float(x)) for x in record["box"]])
+
+def import_csv(csv_filename, name):
+    """
+        Reads a CSV written by export_csv into a table
+    """
+    with open(csv_filename) as f:
+        rows = list(csv.DictReader(f))
+    map_names = sorted(set(row["map"] for row in rows))
+    class_names = sorted(set(row["class"] for row in rows))
+    records = create_records(len(rows))
+    for i, row in enumerate(rows):
+        records[i]["map"] = map_names.index(row["map"])
+        records[i]["anchor_x"] = int(row["anchor_x"])
+        records[i]["anchor_y"] = int(row["anchor_y"])
+        records[i]["class"] = class_names.index(row["class"])
+        records[i]["angle"] = float(row["angle"])
+        records[i]["score"] = float(row["score"])
+        records[i]["box"] = [float(row[key]) for key in CSV_HEADER[6:]]
+    write_annotation_table(name, records, map_names, class_names)
+
+def parse_annotation_text_file(filename):
+    """
+        Parses a crop's annotation text file of "x1,y1,...,x4,y4[,score]" lines
+        Outputs:
+            - boxes: (N, 8) float array
+            - scores: (N,) float array; NaN where a line has no ninth field
+    """
+    with open(filename) as f:
+        lines = [line for line in f.read().split("\n") if line.strip()]
+    boxes = np.zeros((len(lines), 8), dtype=np.float32)
+    scores = np.full(len(lines), np.nan, dtype=np.float32)
+    for i, line in enumerate(lines):
+        fields = line.split(",")
+        boxes[i] = [float(x.strip()) for x in fields[:8]]
+        if len(fields) > 8:
+            try:
+                scores[i] = float(fields[8].strip())
+            except ValueError:
+                pass
+    return boxes, scores
+
+def import_text_annotations(annotations_dir, name, class_name, rotated=False):
+    """
+        Converts a directory of per-crop text annotations, either ground truth (annotation_<map>_<x>_<y>.txt)
+        or predictions (res_cropped_image_<map>_<x>_<y>[_<angle>].txt), into one table
+        Inputs:
+            - annotations_dir: Directory of the text files
+            - name: Path of the table to write
+            - class_name: Name of the character folder the annotations belong to
+            - rotated: Whether the files are predictions on rotated crops, with the angle in their name;
+              a positive angle can't be told apart from the anchor by the name alone
+        Outputs:
+            - records: The written records
+    """
+    if rotated:
+        pattern = re.compile(r"(?:res_cropped_image|annotation)_(.*)_(\d+)_(\d+)_(-?\d+)\.txt$")
+    else:
+        pattern = re.compile(r"(?:res_cropped_image|annotation)_(.*)_(\d+)_(\d+)()\.txt$")
+    parsed = []
+    ## keep glob's order, which is the order the Metrics dictionaries concatenate the files in,
+    ## so a table is evaluated exactly like the directory it was imported from
+    for filename in glob(os.path.join(annotations_dir, "*.txt")):
+        match = pattern.match(filename.split(os.sep)[-1])
+        if match is None:
+            continue
+        map_name, anchor_x, anchor_y, angle = match.groups()
+        boxes, scores = parse_annotation_text_file(filename)
+        parsed.append((map_name, int(anchor_x), int(anchor_y), float(angle or 0), boxes, scores))
+
+    map_names = sorted(set(p[0] for p in parsed))
+    records = create_records(sum(len(p[4]) for p in parsed))
+    start = 0
+    for map_name, anchor_x, anchor_y, angle, boxes, scores in parsed:
+        rows = records[start:start + len(boxes)]
+        rows["map"] = map_names.index(map_name)
+        rows["anchor_x"] = anchor_x
+        rows["anchor_y"] = anchor_y
+        rows["angle"] = angle
+        rows["score"] = scores
+        rows["box"] = boxes
+        start += len(boxes)
+    write_annotation_table(name, records, map_names, [class_name])
+    return records
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog [-x] import <annotations directory> <table> <class name>\n"
+                                "       %prog export <table> <csv>\n"
+                                "       %prog import-csv <csv> <table>")
+    parser.add_option("-x", "--rotated", action="store_true", default=False, help="import predictions on rotated crops, with the angle in their filenames")
+    (options, args) = parser.parse_args()
+    if len(args) == 4 and args[0] == "import":
+        records = import_text_annotations(args[1], args[2], args[3], options.rotated)
+        print("Imported %d annotations into %s" % (len(records), table_filename(args[2])))
+    elif len(args) == 3 and args[0] == "export":
+        export_csv(args[1], args[2])
+    elif len(args) == 3 and args[0] == "import-csv":
+        import_csv(args[1], args[2])
+    else:
+        parser.error("unknown command")
@@ -11,14 +11,18 @@ import numpy as np
 from glob import glob
 import logging
 from PIL import Image
+from tiling_plan import DEFAULT_TILING_PLAN
+from image_sink import ImageSink
 
 
-def crop_images_to_512_512(image_array, height, width):
+def crop_images_to_512_512(image_array, height, width, tiling_plan=None):
     ## Generator function
     ## Arguments
-        ## image_array: This is the array container of the image pixels
+        ## image_array: This is the array container of the image pixels; a WindowedImageReader
+        ##              may be passed instead so that only the cropped regions are decoded
         ## height: Height of the image
         ## width: Width of the image
+        ## tiling_plan: TilingPlan giving the window size and stride; defaults to 512 x 512 windows with stride 200
     ## Outputs
         ## (cropped: Cropped region of image, 
         #   x_0: Top-Left anchor x-coordinate,
@@ -29,15 +33,15 @@ def crop_images_to_512_512(image_array, height, width):
     image_x_max = height 
     image_y_max = width
 
-    image_crop_x = image_crop_y = 512
-    x_0 = y_0 = 0
-    image_crop_step = 200
-    crops = []
+    if tiling_plan is None:
+        tiling_plan = DEFAULT_TILING_PLAN
+
+    image_crop_x = tiling_plan.crop_width
+    image_crop_y = tiling_plan.crop_height
 
-    for y_0 in range(0, image_y_max - image_crop_y, image_crop_step):
-        for x_0 in range(0, image_x_max - image_crop_x, image_crop_step):
-            cropped = image_array[y_0:y_0+image_crop_y, x_0:x_0+image_crop_x]
-            yield (cropped, x_0, y_0, image_crop_x, image_crop_y)
+    for x_0, y_0 in tiling_plan.windows(image_x_max, image_y_max):
+        cropped = image_array[y_0:y_0+image_crop_y, x_0:x_0+image_crop_x]
+        yield (cropped, x_0, y_0, image_crop_x, image_crop_y)
 
 def save_image_as_jpg(image_array, outfile, crop_directory):
     
@@ -57,15 +61,29 @@ def save_image_as_jpg(image_array, outfile, crop_directory):
         print(e)
 
 
-def save_cropped_image(image, width, height, file_stripped_name, crop_directory):
+def save_cropped_image(image, width, height, file_stripped_name, crop_directory, tiling_plan=None, sink=None):
 
     ## Arguments
-        ## image: Image array of image to be cropped
+        ## image: Image array (or WindowedImageReader) of image to be cropped
         ## width: Width of the image; for naming usage
         ## height: Height of the image; from naming usage
         ## file_stripped_name: Raw name identifier of the image
         ## crop_directory: Parent directory of the newly cropped images
+        ## tiling_plan: TilingPlan giving the crop windows; defaults to the original 512 x 512, stride 200 windows
+        ## sink: ImageSink the crops are handed to; if None one is created for crop_directory/images and closed here
+    ## Outputs
+        ## (succeeded, failed): Number of crops saved and failed; counts of the whole sink if one was passed in
+
+    owns_sink = sink is None
+    if owns_sink:
+        sink = ImageSink(os.path.join(crop_directory, "images"))
+
+    try:
+        for cropped, x_0, y_0, _, _ in crop_images_to_512_512(image, width, height, tiling_plan):
+            build_string = lambda x_0, y_0, file_stripped_name: "cropped_image_%s_%d_%d" % (file_stripped_name, x_0 , y_0)
+            sink.submit(cropped, build_string(x_0, y_0, file_stripped_name))
+    finally:
+        if owns_sink:
+            sink.close()
 
-    for cropped, x_0, y_0, _, _ in crop_images_to_512_512(image, width, height):
-        build_string = lambda x_0, y_0, file_stripped_name: "cropped_image_%s_%d_%d" % (file_stripped_name, x_0 , y_0)
-        save_image_as_jpg(cropped, build_string(x_0, y_0, file_stripped_name), crop_directory)
+    return sink.counts()
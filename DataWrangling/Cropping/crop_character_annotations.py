@@ -7,6 +7,7 @@
 import numpy as np
 from glob import glob
 import os
+from tiling_plan import DEFAULT_TILING_PLAN
 
 def check_box_in_crop(box_coordinates, crop_x, crop_y, crop_width=512, crop_height=512):
 	"""
@@ -44,38 +45,152 @@ def find_and_parse_npy_files(annotation_file):
 	## Outputs
 		## _dict: Dictionary of all the verticies
 
-	anot = np.load(annotation_file)
+	anot = np.load(annotation_file, allow_pickle=True)
 	_dict = np.reshape(anot, -1)[0]
 	return _dict
 
 
 
-def save_cropped_annotations(annotation_file, width, height, crop_directory):
+def parse_annotation_boxes(_dict):
+
+	## Arguments
+		## _dict: Dictionary of all the verticies, as returned by find_and_parse_npy_files
+	## Outputs
+		## boxes: Float array of shape (N, 4, 2); every 4 vertex annotation, in dictionary order
+
+	quads = [_dict[key]['vertices'] for key in _dict if len(_dict[key]['vertices']) == 4]
+	return np.array(quads, dtype=np.float64).reshape(-1, 4, 2)
+
+def assign_boxes_to_windows(boxes, x_anchors, y_anchors, crop_width=512, crop_height=512):
+
+	## Finds every crop window that fully contains each box in one batched step. A window anchored
+	## at (x_0, y_0) contains a box exactly when
+	##     x_0 <= min_x  and  max_x <= x_0 + crop_width
+	## (and likewise for y), so the containing windows of a box form a rectangle of anchor
+	## indices, found with a binary search of the sorted integer anchors instead of testing every window.
+	## Arguments
+		## boxes: Float array of shape (N, 4, 2) of box vertices
+		## x_anchors: Sorted int array of the window x-coordinates
+		## y_anchors: Sorted int array of the window y-coordinates
+		## crop_width: Width of the crop window
+		## crop_height: Height of the crop window
+	## Outputs
+		## window_ids: Int array of row-major window indices (ky * len(x_anchors) + kx)
+		## box_ids: Int array of the box contained in the matching window; pairs are sorted by window, then box
+
+	if len(boxes) == 0:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+	## a window edge lies on an integer, so the box extent can be snapped outwards to integers first
+	box_min = np.floor(boxes.min(axis=1)).astype(np.int64)
+	box_max = np.ceil(boxes.max(axis=1)).astype(np.int64)
+
+	## first window: smallest anchor >= max - size; last window: largest anchor <= min
+	first_x = np.searchsorted(x_anchors, box_max[:, 0] - crop_width, side='left')
+	first_y = np.searchsorted(y_anchors, box_max[:, 1] - crop_height, side='left')
+	last_x = np.searchsorted(x_anchors, box_min[:, 0], side='right') - 1
+	last_y = np.searchsorted(y_anchors, box_min[:, 1], side='right') - 1
+
+	count_x = np.maximum(last_x - first_x + 1, 0)
+	count_y = np.maximum(last_y - first_y + 1, 0)
+	counts = count_x * count_y
+
+	## expand each box into its (kx, ky) rectangle of windows
+	box_ids = np.repeat(np.arange(len(boxes)), counts)
+	offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+	kx = first_x[box_ids] + offsets % count_x[box_ids]
+	ky = first_y[box_ids] + offsets // count_x[box_ids]
+	window_ids = ky * len(x_anchors) + kx
+
+	order = np.lexsort((box_ids, window_ids))
+	return window_ids[order], box_ids[order]
+
+def save_cropped_annotations(annotation_file, width, height, crop_directory, tiling_plan=None):
 
 	## Arguments
 		## annotation_file: This is the original annotation file that will be cropped into regions
 		## width: Width of the corresponding image
 		## height: Height of the corresponding image
 		## crop_directory: Where the cropped region annotations will live
+		## tiling_plan: TilingPlan giving the crop windows; defaults to the original 512 x 512, stride 200 windows
+
+	save_cropped_annotations_all_classes([annotation_file], width, height, [crop_directory], tiling_plan)
 
-	_dict = find_and_parse_npy_files(annotation_file)
+def load_annotation_table(annotation_files):
 
-	file_name_no_extension = annotation_file.split(os.sep)[-1].split('.')[0]
+	## Arguments
+		## annotation_files: The original annotation file of each character folder; the position is the class column
+	## Outputs
+		## boxes: Float array of shape (N, 4, 2) of the boxes of every character folder, folder by folder
+		## classes: Int array of shape (N,) of the class column of each box
+
+	class_boxes = [parse_annotation_boxes(find_and_parse_npy_files(annotation_file)) for annotation_file in annotation_files]
+	boxes = np.concatenate(class_boxes) if class_boxes else np.zeros((0, 4, 2))
+	classes = np.repeat(np.arange(len(class_boxes)), [len(b) for b in class_boxes])
+	return boxes, classes
+
+def save_cropped_annotations_all_classes(annotation_files, width, height, crop_directories, tiling_plan=None):
+
+	## Crops the annotations of every character folder of one map in a single sweep of the crop grid
+	## Arguments
+		## annotation_files: The original annotation file of each character folder; the position is the class column
+		## width: Width of the corresponding image
+		## height: Height of the corresponding image
+		## crop_directories: Where the cropped region annotations of each character folder will live
+		## tiling_plan: TilingPlan giving the crop windows; defaults to the original 512 x 512, stride 200 windows
+
+	## combined box table of every character folder, with a class column
+	boxes, classes = load_annotation_table(annotation_files)
+
+	file_names_no_extension = [annotation_file.split(os.sep)[-1].split('.')[0] for annotation_file in annotation_files]
 		
-	image_x_max = width
-	image_y_max = height
-
-	image_crop_x = image_crop_y = 512
-	image_crop_step = 200
-
-	for y_0 in range(0, image_y_max - image_crop_y, image_crop_step):
-		for x_0 in range(0, image_x_max - image_crop_x, image_crop_step):
-			with open(os.path.join(crop_directory, ("annotation_%s_%d_%d.txt" % (file_name_no_extension, x_0 , y_0))), "w+") as f:
-				for key in _dict:
-					verticies = _dict[key]['vertices']
-					if len(verticies) == 4:
-						relative_coordinates = check_box_in_crop(verticies, x_0, y_0, image_crop_x, image_crop_y)
-						if relative_coordinates is not None: 
-							box_string = ",".join([str(x) for t in relative_coordinates for x in t])
-							f.write("%s\n" % box_string)
+	if tiling_plan is None:
+		tiling_plan = DEFAULT_TILING_PLAN
+
+	image_crop_x = tiling_plan.crop_width
+	image_crop_y = tiling_plan.crop_height
+
+	x_anchors, y_anchors = tiling_plan.anchors(width, height)
+
+	## boxes are numbered class by class, so within a window the pairs are also grouped by class
+	window_ids, box_ids = assign_boxes_to_windows(boxes, x_anchors, y_anchors, image_crop_x, image_crop_y)
+	## boundaries of each window's run of boxes in the sorted assignment
+	window_bounds = np.searchsorted(window_ids, np.arange(len(x_anchors) * len(y_anchors) + 1))
+	box_classes = classes[box_ids]
+
+	for ky, y_0 in enumerate(y_anchors.tolist()):
+		for kx, x_0 in enumerate(x_anchors.tolist()):
+			window_id = ky * len(x_anchors) + kx
+			window_start, window_end = window_bounds[window_id], window_bounds[window_id + 1]
+			## boundaries of each class's run of boxes inside the window
+			class_bounds = window_start + np.searchsorted(box_classes[window_start:window_end], np.arange(len(annotation_files) + 1))
+			for class_id, crop_directory in enumerate(crop_directories):
+				with open(os.path.join(crop_directory, ("annotation_%s_%d_%d.txt" % (file_names_no_extension[class_id], x_0 , y_0))), "w+") as f:
+					for box_id in box_ids[class_bounds[class_id]:class_bounds[class_id + 1]]:
+						relative_coordinates = (boxes[box_id] - (x_0, y_0)).astype(np.int64)
+						box_string = ",".join([str(x) for x in relative_coordinates.reshape(-1)])
+						f.write("%s\n" % box_string)
+
+def store_cropped_annotations_all_classes(annotation_files, class_names, width, height, store_writer, tiling_plan=None):
+
+	## Crops the annotations of every character folder of one map into a single table of a crop store
+	## Arguments
+		## annotation_files: The original annotation file of each character folder; the position is the class column
+		## class_names: Name of each character folder
+		## width: Width of the corresponding image
+		## height: Height of the corresponding image
+		## store_writer: CropStoreWriter of the map
+		## tiling_plan: TilingPlan giving the crop windows; defaults to the original 512 x 512, stride 200 windows
+
+	boxes, classes = load_annotation_table(annotation_files)
+
+	if tiling_plan is None:
+		tiling_plan = DEFAULT_TILING_PLAN
+
+	x_anchors, y_anchors = tiling_plan.anchors(width, height)
+	window_ids, box_ids = assign_boxes_to_windows(boxes, x_anchors, y_anchors, tiling_plan.crop_width, tiling_plan.crop_height)
 
+	## one row per (window, box) pair, with the same truncated relative coordinates as the text files
+	anchors = np.stack([x_anchors[window_ids % len(x_anchors)], y_anchors[window_ids // len(x_anchors)]], axis=1) if len(window_ids) else np.zeros((0, 2), dtype=np.int64)
+	relative_boxes = (boxes[box_ids] - anchors[:, np.newaxis, :]).astype(np.int64).reshape(-1, 8)
+	store_writer.write_annotations(class_names, anchors, classes[box_ids], relative_boxes)
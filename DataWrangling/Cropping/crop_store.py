@@ -0,0 +1,213 @@
+"""
+    Sharded container for harvested crops. Instead of one JPEG per crop and one text file
+    per crop and character folder, every map is stored as:
+        - <map>.jpgs: the JPEG bytes of all of the map's crops, back to back
+        - <map>.index.npy: (x_0, y_0, offset, length) of every crop in <map>.jpgs
+        - <map>.annotations: one binary annotation table (annotation_table.py) of the cropped
+          annotations of every character folder
+    Crops and their annotations are looked up by (map, x_0, y_0).
+"""
+import os
+import re
+import threading
+import numpy as np
+from glob import glob
+from annotation_table import create_records, read_annotation_table, write_annotation_table
+
+CROP_INDEX_DTYPE = np.dtype([("x_0", np.int64), ("y_0", np.int64), ("offset", np.int64), ("length", np.int64)])
+
+IMAGES_SUFFIX = ".jpgs"
+INDEX_SUFFIX = ".index.npy"
+
+def crop_name(map_name, x_0, y_0):
+    ## Name of a crop, matching the names of the individual JPEG files
+    return "cropped_image_%s_%d_%d" % (map_name, x_0, y_0)
+
+def parse_crop_name(name):
+    ## Inverse of crop_name; returns (map_name, x_0, y_0)
+    map_name, x_0, y_0 = re.match(r"cropped_image_(.*)_(\d+)_(\d+)$", name).groups()
+    return (map_name, int(x_0), int(y_0))
+
+def is_crop_store(directory):
+    ## Whether the directory holds a crop store
+    return os.path.isdir(directory) and len(glob(os.path.join(directory, "*" + INDEX_SUFFIX))) > 0
+
+
+class CropStoreWriter(object):
+    """
+        Writes the crops and annotations of one map into a crop store. The image writes are
+        thread-safe so the writer can be handed to an ImageSink as its output.
+    """
+
+    def __init__(self, store_directory, map_name):
+        """
+            Inputs:
+                - store_directory: Directory of the crop store
+                - map_name: Raw name identifier of the map
+        """
+        self.store_directory = store_directory
+        self.map_name = map_name
+        self._lock = threading.Lock()
+        self._index = []
+        self._offset = 0
+        self._images_filename = os.path.join(store_directory, map_name + IMAGES_SUFFIX)
+        ## written under a temporary name so a crashed harvest never leaves a half written map behind
+        self._images_file = open(self._images_filename + ".partial", "wb")
+
+    def write(self, name, data):
+        """
+            Inputs:
+                - name: Crop name, as built by crop_name
+                - data: Encoded image bytes
+        """
+        _, x_0, y_0 = parse_crop_name(name)
+        self.write_image(x_0, y_0, data)
+
+    def write_image(self, x_0, y_0, data):
+        with self._lock:
+            self._images_file.write(data)
+            self._index.append((x_0, y_0, self._offset, len(data)))
+            self._offset += len(data)
+
+    def write_annotations(self, class_names, anchors, classes, boxes):
+        """
+            Inputs:
+                - class_names: Name of every character folder; the class column indexes into it
+                - anchors: Int array of shape (N, 2) of the (x_0, y_0) of the crop each box belongs to
+                - classes: Int array of shape (N,) of the class of each box
+                - boxes: Int array of shape (N, 8) of the box coordinates relative to its crop
+        """
+        anchors = np.asarray(anchors).reshape(-1, 2)
+        records = create_records(len(anchors))
+        records["anchor_x"] = anchors[:, 0]
+        records["anchor_y"] = anchors[:, 1]
+        records["class"] = classes
+        records["box"] = np.asarray(boxes).reshape(-1, 8)
+        write_annotation_table(os.path.join(self.store_directory, self.map_name), records, [self.map_name], class_names)
+
+    def close(self):
+        ## Commits the map; the index is renamed into place last, since the store lists a map by its index
+        with self._lock:
+            self._images_file.close()
+            index = np.array(self._index, dtype=CROP_INDEX_DTYPE)
+        ## the images are written in the order the encoder threads finish; keep the index in crop order
+        index = index[np.lexsort((index["x_0"], index["y_0"]))]
+        index_filename = os.path.join(self.store_directory, self.map_name + INDEX_SUFFIX)
+        with open(index_filename + ".partial", "wb") as f:
+            np.save(f, index)
+        os.rename(self._images_filename + ".partial", self._images_filename)
+        os.rename(index_filename + ".partial", index_filename)
+
+    def abort(self):
+        ## Drops the map after a failed harvest, leaving no index, so the store never lists it
+        with self._lock:
+            self._images_file.close()
+        for filename in [self._images_filename, os.path.join(self.store_directory, self.map_name + INDEX_SUFFIX)]:
+            if os.path.exists(filename + ".partial"):
+                os.remove(filename + ".partial")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CropStore(object):
+    """
+        Random access reader of a crop store
+    """
+
+    def __init__(self, store_directory):
+        self.store_directory = store_directory
+        self._indices = {}
+        self._annotations = {}
+        self._crop_rows = {}
+
+    def maps(self):
+        ## Sorted names of the maps in the store
+        index_filenames = glob(os.path.join(self.store_directory, "*" + INDEX_SUFFIX))
+        return sorted(filename.split(os.sep)[-1][:-len(INDEX_SUFFIX)] for filename in index_filenames)
+
+    def index(self, map_name):
+        if map_name not in self._indices:
+            self._indices[map_name] = np.load(os.path.join(self.store_directory, map_name + INDEX_SUFFIX))
+        return self._indices[map_name]
+
+    def crop_anchors(self, map_name):
+        ## Int array of shape (K, 2) of the (x_0, y_0) of every crop of the map, rows first
+        index = self.index(map_name)
+        return np.stack([index["x_0"], index["y_0"]], axis=1)
+
+    def crop_names(self):
+        ## Names of every crop in the store
+        return [crop_name(map_name, x_0, y_0) for map_name in self.maps() for x_0, y_0 in self.crop_anchors(map_name).tolist()]
+
+    def read_image(self, map_name, x_0, y_0):
+        """
+            Outputs:
+                - data: The encoded JPEG bytes of the crop anchored at (x_0, y_0)
+        """
+        index = self.index(map_name)
+        row = np.flatnonzero((index["x_0"] == x_0) & (index["y_0"] == y_0))
+        if len(row) == 0:
+            raise KeyError("No crop of %s at (%d, %d)" % (map_name, x_0, y_0))
+        offset, length = int(index["offset"][row[0]]), int(index["length"][row[0]])
+        with open(os.path.join(self.store_directory, map_name + IMAGES_SUFFIX), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def annotations(self, map_name):
+        """
+            Outputs:
+                - records: Memory-mapped annotation records of the map
+                - class_names: Names indexed by the class column
+        """
+        if map_name not in self._annotations:
+            records, _, class_names = read_annotation_table(os.path.join(self.store_directory, map_name))
+            self._annotations[map_name] = (records, class_names)
+        return self._annotations[map_name]
+
+    def class_names(self):
+        ## Names of the character folders in the store
+        return self.annotations(self.maps()[0])[1]
+
+    def class_annotations(self, map_name, class_name):
+        """
+            Outputs:
+                - anchors: Int array of shape (N, 2) of the crop anchor of each box of the character folder
+                - boxes: Int array of shape (N, 8) of the box coordinates relative to the crop
+        """
+        records, class_names = self.annotations(map_name)
+        if class_name not in class_names:
+            return np.zeros((0, 2), dtype=np.int32), np.zeros((0, 8), dtype=np.int32)
+        records = records[records["class"] == class_names.index(class_name)]
+        return np.stack([records["anchor_x"], records["anchor_y"]], axis=1), records["box"].astype(np.int32)
+
+    def crop_annotations(self, map_name, x_0, y_0, class_name):
+        """
+            Outputs:
+                - boxes: Int array of shape (K, 8) of the boxes of the character folder in the crop, relative to the crop
+        """
+        anchors, boxes = self.class_annotations(map_name, class_name)
+        return boxes[(anchors[:, 0] == x_0) & (anchors[:, 1] == y_0)]
+
+    def crop_records(self, map_name, x_0, y_0):
+        """
+            Outputs:
+                - records: Annotation records of every character folder in the crop anchored at (x_0, y_0),
+                  in table order
+        """
+        records, _ = self.annotations(map_name)
+        if map_name not in self._crop_rows:
+            ## rows grouped by crop once per map, so a crop is found with a binary search
+            order = np.lexsort((records["anchor_x"], records["anchor_y"]))
+            keys = (records["anchor_y"][order].astype(np.int64) << 32) | records["anchor_x"][order].astype(np.int64)
+            self._crop_rows[map_name] = (order, keys)
+        order, keys = self._crop_rows[map_name]
+        key = (int(y_0) << 32) | int(x_0)
+        start, end = np.searchsorted(keys, [key, key + 1])
+        return records[order[start:end]]
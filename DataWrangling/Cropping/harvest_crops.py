@@ -8,53 +8,184 @@ import os
 import numpy as np
 from PIL import Image
 import sys
+from multiprocessing import Pool
+from optparse import OptionParser
 from crop_and_convert_tiff import save_cropped_image
-from crop_character_annotations import save_cropped_annotations
+from crop_character_annotations import save_cropped_annotations_all_classes, store_cropped_annotations_all_classes
+from crop_store import CropStoreWriter
+from image_sink import ImageSink
+from windowed_image_reader import WindowedImageReader
+from tiling_plan import DEFAULT_TILING_PLAN, TilingPlan
 
-def harvest(images_parent_directory, annotations_parent_directory, crop_directory, updated=False):
+def find_annotation_folders(annotations_parent_directory):
+    ## Arguments
+        ## annotations_parent_directory: Directory where the character annotations home folder is (contains each character folder)
+    ## Outputs
+        ## annotation_folders: Sorted list of the character folder names
+    return sorted(filter(lambda folder: os.path.isdir(os.path.join(annotations_parent_directory, folder)), os.listdir(annotations_parent_directory)))
+
+def find_annotation_filenames(annotations_parent_directory, file_stripped_name, updated=False):
+    ## Arguments
+        ## annotations_parent_directory: Directory where the character annotations home folder is (contains each character folder)
+        ## file_stripped_name: Raw name identifier of the map
+        ## updated: Whether the annotation files live directly in the character folder, rather than in "current"
+    ## Outputs
+        ## annotation_folders: Sorted list of the character folder names
+        ## annotation_filenames: The map's annotation file in each character folder
+    annotation_folders = find_annotation_folders(annotations_parent_directory)
+    annotation_filenames = []
+    for annotation_folder in annotation_folders:
+        ## get the corresponding annotation filename
+        if updated:
+            annotation_filenames.append(os.path.join(annotations_parent_directory, annotation_folder, file_stripped_name + ".npy"))
+        else:
+            annotation_filenames.append(os.path.join(annotations_parent_directory, annotation_folder, "current", file_stripped_name + ".npy"))
+    return annotation_folders, annotation_filenames
+
+def harvest_map(filename, annotations_parent_directory, crop_directory, updated=False, tiling_plan=None, use_store=False, cache_directory=None):
+    ## Crops a single map and the annotations of every character folder for that map
+    ## Arguments
+        ## filename: Path to the TIFF image of the map
+        ## annotations_parent_directory: Directory where the character annotations home folder is (contains each character folder)
+        ## crop_directory: Where the cropped images and annotations will go
+        ## updated: Whether the annotation files live directly in the character folder, rather than in "current"
+        ## tiling_plan: TilingPlan shared by the image and annotation crops; defaults to 512 x 512 windows with stride 200
+        ## use_store: Write the map into the sharded crop store in crop_directory/store instead of individual files
+        ## cache_directory: Optional directory to keep the decoded maps which can not be windowed in across runs
+    ## Outputs
+        ## file_stripped_name: Raw name identifier of the map; raises on failure
+
+    ## get the stripped filename
+    file_stripped_name = filename.split(os.sep)[-1].split('.')[0]
+    annotation_folders, annotation_filenames = find_annotation_filenames(annotations_parent_directory, file_stripped_name, updated)
+
+    store_writer = CropStoreWriter(os.path.join(crop_directory, "store"), file_stripped_name) if use_store else None
+    try:
+        ## only the rows each crop window needs are decoded, instead of the whole map
+        with WindowedImageReader(filename, cache_directory) as image:
+            width, height = image.size
+
+            ## start image cropping; crops are encoded on a pool of threads
+            with ImageSink(os.path.join(crop_directory, "images"), writer=store_writer) as sink:
+                save_cropped_image(image, width, height, file_stripped_name, crop_directory, tiling_plan, sink)
+        _, failed_crops = sink.counts()
+        if failed_crops:
+            raise IOError("%d crops of %s could not be saved" % (failed_crops, file_stripped_name))
+
+        ## start annotation cropping; every character folder is cropped in one sweep of the crop grid
+        if use_store:
+            store_cropped_annotations_all_classes(annotation_filenames, annotation_folders, width, height, store_writer, tiling_plan)
+        else:
+            annotation_crop_directories = []
+            for annotation_folder in annotation_folders:
+                if not os.path.exists(os.path.join(crop_directory, "annotations", annotation_folder)):
+                    os.mkdir(os.path.join(crop_directory, "annotations", annotation_folder))
+                annotation_crop_directories.append(os.path.join(crop_directory, "annotations", annotation_folder))
+            save_cropped_annotations_all_classes(annotation_filenames, width, height, annotation_crop_directories, tiling_plan)
+
+        ## the map only enters the store once its crops and annotations are all written
+        if store_writer is not None:
+            store_writer.close()
+    except Exception:
+        if store_writer is not None:
+            store_writer.abort()
+        raise
+
+    return file_stripped_name
+
+def harvest_map_worker(arguments):
+    ## Pool entry point; wraps harvest_map so that a failing map is reported instead of killing the pool
+    ## Arguments
+        ## arguments: Tuple of (filename, annotations_parent_directory, crop_directory, updated, tiling_plan, use_store, cache_directory)
+    ## Outputs
+        ## (filename, error): error is None if the map was cropped, else the error message
+    filename = arguments[0]
+    try:
+        harvest_map(*arguments)
+        return (filename, None)
+    except Exception as e:
+        return (filename, "%s: %s" % (type(e).__name__, e))
+
+def harvest(images_parent_directory, annotations_parent_directory, crop_directory, updated=False, num_workers=1, tiling_plan=None, use_store=False, cache_directory=None):
     ## Find the filenames of TIFF images, and then finds the corresponding annotation file
     ## Arguments
         ## images_parent_directory: Parent directory where the images live
         ## annotations_parent_directory: Directory where the character annotations home folder is (contains each character folder)
         ## crop_directory: Where the cropped images and annotations will go
+        ## updated: Whether the annotation files live directly in the character folder, rather than in "current"
+        ## num_workers: Number of processes to crop maps with; 1 crops serially in this process
+        ## tiling_plan: TilingPlan shared by the image and annotation crops; defaults to 512 x 512 windows with stride 200
+        ## use_store: Write the sharded crop store in crop_directory/store instead of individual files
+        ## cache_directory: Optional directory to keep the decoded maps which can not be windowed in across runs
+    ## Outputs
+        ## failed: List of (filename, error message) for the maps which could not be cropped
     
     image_filenames = glob(os.path.join(images_parent_directory, "*.tiff"))
-    for filename in image_filenames:
-        try:
-            ## get the stripped filename
-            file_stripped_name = filename.split(os.sep)[-1].split('.')[0]
-            
-            image = Image.open(filename)
-            width, height = image.size
+    failed = []
 
-            ## start image cropping
-            save_cropped_image(np.array(image), width, height, file_stripped_name, crop_directory)
+    if tiling_plan is None:
+        tiling_plan = DEFAULT_TILING_PLAN
+    ## record the tiling next to the crops so evaluation can recover the crop geometry
+    tiling_plan.save(os.path.join(crop_directory, "tiling_plan.json"))
 
-            for annotation_folder in list(filter(lambda folder: os.path.isdir(os.path.join(annotations_parent_directory, folder)), os.listdir(annotations_parent_directory))):
-                ## get the corresponding annotation filename
-                if updated:
-                    annotation_filename = os.path.join(annotations_parent_directory, annotation_folder, file_stripped_name + ".npy")
-                else:
-                    annotation_filename = os.path.join(annotations_parent_directory, annotation_folder, "current", file_stripped_name + ".npy")
-                ## start annotation cropping
-                if not os.path.exists(os.path.join(crop_directory, "annotations", annotation_folder)):
-                    os.mkdir(os.path.join(crop_directory, "annotations", annotation_folder))
-                save_cropped_annotations(annotation_filename, width, height, os.path.join(crop_directory, "annotations", annotation_folder))
+    if num_workers <= 1:
+        for filename in image_filenames:
+            try:
+                file_stripped_name = harvest_map(filename, annotations_parent_directory, crop_directory, updated, tiling_plan, use_store, cache_directory)
+                print("Cropped: ", file_stripped_name)
+            except Exception as e:
+                print(e)
+                failed.append((filename, "%s: %s" % (type(e).__name__, e)))
+        return failed
 
-            print("Cropped: ", file_stripped_name)
-        except Exception as e:
-            print(e)
+    ## create the character folders up front so that workers never race on mkdir
+    for annotation_folder in ([] if use_store else find_annotation_folders(annotations_parent_directory)):
+        if not os.path.exists(os.path.join(crop_directory, "annotations", annotation_folder)):
+            os.mkdir(os.path.join(crop_directory, "annotations", annotation_folder))
+
+    ## every map is independent and writes to its own uniquely named files, so the
+    ## output matches the serial path regardless of the order the workers finish in
+    arguments = [(filename, annotations_parent_directory, crop_directory, updated, tiling_plan, use_store, cache_directory) for filename in image_filenames]
+    ## a fresh process per map returns the decoded map's memory to the system
+    pool = Pool(processes=num_workers, maxtasksperchild=1)
+    try:
+        for idx, (filename, error) in enumerate(pool.imap_unordered(harvest_map_worker, arguments)):
+            file_stripped_name = filename.split(os.sep)[-1].split('.')[0]
+            if error is None:
+                print("Cropped (%d/%d): %s" % (idx + 1, len(arguments), file_stripped_name))
+            else:
+                print("Failed (%d/%d): %s -- %s" % (idx + 1, len(arguments), file_stripped_name, error))
+                failed.append((filename, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    print("Harvested %d maps, %d failed" % (len(arguments) - len(failed), len(failed)))
+    for filename, error in failed:
+        print("Failed: ", filename, error)
+    return failed
 
     
 if __name__ == "__main__":
-    images_parent_directory = sys.argv[1]
-    annotations_parent_directory = sys.argv[2]
-    crop_directory = sys.argv[3]
+    parser = OptionParser(usage="%prog images_parent_directory annotations_parent_directory crop_directory [options]")
+    parser.add_option("-w", "--workers", type="int", default=1, help="number of processes to crop maps with; defaults to the serial path")
+    parser.add_option("-t", "--tiling", help="tiling plan json; defaults to 512 x 512 windows with stride 200")
+    parser.add_option("-s", "--store", action="store_true", default=False, help="write a sharded crop store instead of one file per crop")
+    parser.add_option("-k", "--cache", help="optional directory to keep the decoded maps which can not be windowed in across runs; a temporary one per map otherwise")
+    (options, args) = parser.parse_args()
+
+    images_parent_directory = args[0]
+    annotations_parent_directory = args[1]
+    crop_directory = args[2]
+    tiling_plan = TilingPlan.load(options.tiling) if options.tiling else None
     
     if not os.path.exists(crop_directory):
         os.mkdir(crop_directory)
 
-    os.mkdir(os.path.join(crop_directory, "images"))
-    os.mkdir(os.path.join(crop_directory, "annotations"))
+    if options.store:
+        os.mkdir(os.path.join(crop_directory, "store"))
+    else:
+        os.mkdir(os.path.join(crop_directory, "images"))
+        os.mkdir(os.path.join(crop_directory, "annotations"))
 
-    harvest(images_parent_directory, annotations_parent_directory, crop_directory)
\ No newline at end of file
+    harvest(images_parent_directory, annotations_parent_directory, crop_directory, num_workers=options.workers, tiling_plan=tiling_plan, use_store=options.store, cache_directory=options.cache)
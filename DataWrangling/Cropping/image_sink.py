@@ -0,0 +1,112 @@
+"""
+    Output sink which encodes and writes crops on a bounded pool of threads.
+    Pillow releases the GIL while encoding, so the threads encode crops in parallel
+    while the caller keeps producing them.
+"""
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+class ImageSink(object):
+    """
+        Accepts image arrays and writes them to disk in the background. At most
+        max_pending crops are held in memory at once; submit blocks until one is written
+        once that many are waiting, so a fast crop generator can not run ahead of the encoders.
+
+        Usage:
+            with ImageSink(crop_directory) as sink:
+                for cropped, x_0, y_0, _, _ in crop_images_to_512_512(...):
+                    sink.submit(cropped, outfile)
+            succeeded, failed = sink.counts()
+    """
+
+    def __init__(self, output_directory, num_threads=4, max_pending=None, image_format="JPEG", extension=".jpg", quality=75, verbose=False, writer=None):
+        """
+            Inputs:
+                - output_directory: Directory the images are written to
+                - num_threads: Number of encoder threads
+                - max_pending: Number of crops which may wait to be written; defaults to 4 per thread
+                - image_format: Pillow format name used to encode the crops
+                - extension: Extension appended to every outfile
+                - quality: Encoder quality; 75 is Pillow's JPEG default
+                - verbose: Print every saved path
+                - writer: Optional object with a write(outfile, data) method, e.g. a CropStoreWriter;
+                  the encoded bytes are handed to it instead of being written to output_directory
+        """
+        self.output_directory = output_directory
+        self.image_format = image_format
+        self.extension = extension
+        self.quality = quality
+        self.verbose = verbose
+        self.writer = writer
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending or 4 * num_threads)
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def submit(self, image_array, outfile):
+        """
+            Queue an image to be written
+            Inputs:
+                - image_array: RGB image pixels
+                - outfile: Name of the new image relative to the output directory; DO NOT ADD EXTENSION
+        """
+        ## backpressure: wait until a slot frees up
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._write, image_array, outfile)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _write(self, image_array, outfile):
+        name = outfile
+        outfile = os.path.join(self.output_directory, outfile) + self.extension
+        try:
+            image = Image.fromarray(image_array.astype('uint8'), 'RGB')
+            if self.writer is not None:
+                encoded = io.BytesIO()
+                image.save(encoded, self.image_format, quality=self.quality)
+                self.writer.write(name, encoded.getvalue())
+            else:
+                image.save(outfile, self.image_format, quality=self.quality)
+            with self._lock:
+                self.succeeded += 1
+            if self.verbose:
+                print("Output Saved: ", outfile)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self.errors.append((outfile, e))
+            print("Failed to save %s: %s" % (outfile, e))
+        finally:
+            self._slots.release()
+
+    def counts(self):
+        """
+            Outputs:
+                - (succeeded, failed): Number of images written and failed so far
+        """
+        with self._lock:
+            return (self.succeeded, self.failed)
+
+    def close(self):
+        """
+            Waits for every queued image to be written
+            Outputs:
+                - (succeeded, failed): Number of images written and failed
+        """
+        self._executor.shutdown(wait=True)
+        return self.counts()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,110 @@
+"""
+    Crop window geometry shared by image cropping, annotation cropping, and the Metrics
+    dictionaries which stitch the crops back into whole maps.
+"""
+import json
+import numpy as np
+
+
+class TilingPlan(object):
+    """
+        Describes how a map is tiled into crop windows: the window size, the stride between
+        neighbouring windows, and whether a final row and column of windows is aligned to the
+        bottom and right edges of the map.
+
+        The default plan reproduces the original range(0, max - 512, 200) tiling, which never
+        covers the edge strips of a map.
+    """
+
+    def __init__(self, crop_width=512, crop_height=512, crop_step=200, edge_aligned=False):
+        """
+            Inputs:
+                - crop_width: Width of a crop window
+                - crop_height: Height of a crop window
+                - crop_step: Stride between neighbouring windows, along both axes
+                - edge_aligned: Add a final window anchored at (max - crop size) when the stride does not land there
+        """
+        self.crop_width = int(crop_width)
+        self.crop_height = int(crop_height)
+        self.crop_step = int(crop_step)
+        self.edge_aligned = bool(edge_aligned)
+        ## precomputed anchors, keyed on the image size
+        self._anchors = {}
+
+    def _axis_anchors(self, image_max, crop_size):
+        anchors = np.arange(0, image_max - crop_size, self.crop_step, dtype=np.int64)
+        if self.edge_aligned and image_max >= crop_size and (len(anchors) == 0 or anchors[-1] != image_max - crop_size):
+            anchors = np.append(anchors, image_max - crop_size)
+        return anchors
+
+    def anchors(self, width, height):
+        """
+            Inputs:
+                - width: Width of the map
+                - height: Height of the map
+            Outputs:
+                - x_anchors: Sorted int array of the window x-coordinates
+                - y_anchors: Sorted int array of the window y-coordinates
+        """
+        key = (int(width), int(height))
+        if key not in self._anchors:
+            self._anchors[key] = (self._axis_anchors(key[0], self.crop_width), self._axis_anchors(key[1], self.crop_height))
+        return self._anchors[key]
+
+    def window_anchors(self, width, height):
+        """
+            Inputs:
+                - width: Width of the map
+                - height: Height of the map
+            Outputs:
+                - window_anchors: Int array of shape (K, 2) of every window's (x_0, y_0), in row-major order
+        """
+        x_anchors, y_anchors = self.anchors(width, height)
+        return np.stack([np.tile(x_anchors, len(y_anchors)), np.repeat(y_anchors, len(x_anchors))], axis=1)
+
+    def windows(self, width, height):
+        """
+            Generator over the (x_0, y_0) anchor of every window, rows first, as Python ints
+        """
+        x_anchors, y_anchors = self.anchors(width, height)
+        for y_0 in y_anchors.tolist():
+            for x_0 in x_anchors.tolist():
+                yield (x_0, y_0)
+
+    def contains_anchor(self, x_0, y_0, width, height):
+        """
+            Whether (x_0, y_0) is the anchor of one of this plan's windows on a map of the given size.
+            Lets evaluation use a subset of an existing, denser tiling without re-tiling the maps.
+        """
+        x_anchors, y_anchors = self.anchors(width, height)
+        return bool(np.any(x_anchors == x_0) and np.any(y_anchors == y_0))
+
+    def to_dict(self):
+        return {
+            "crop_width": self.crop_width,
+            "crop_height": self.crop_height,
+            "crop_step": self.crop_step,
+            "edge_aligned": self.edge_aligned
+        }
+
+    def save(self, filename):
+        with open(filename, "w+") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls(**json.load(f))
+
+    def __eq__(self, other):
+        return isinstance(other, TilingPlan) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "TilingPlan(crop_width=%d, crop_height=%d, crop_step=%d, edge_aligned=%s)" % (self.crop_width, self.crop_height, self.crop_step, self.edge_aligned)
+
+
+## the tiling every existing crop directory was produced with
+DEFAULT_TILING_PLAN = TilingPlan()
@@ -0,0 +1,230 @@
+"""
+    Read regions of a large map TIFF without holding the whole decoded map in memory.
+    The reader can be sliced like the array returned by np.array(Image.open(...)), so it
+    can be handed to crop_images_to_512_512 in place of that array.
+"""
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+
+from PIL import Image
+
+## tifffile (with zarr) decodes individual strips/tiles of a TIFF; without it every map
+## is decoded once with Pillow into a memory-mapped cache
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def same_as_pillow(page):
+    ## Whether tifffile yields the same array for the page as np.array(Image.open(...))
+    return page.dtype == np.uint8 and page.photometric in (tifffile.PHOTOMETRIC.RGB, tifffile.PHOTOMETRIC.MINISBLACK) and page.planarconfig == tifffile.PLANARCONFIG.CONTIG
+
+
+def tifffile_bands(filename):
+    """
+        Inputs:
+            - filename: Path to a TIFF whose first page is same_as_pillow
+        Outputs:
+            - Generator over (y_0, rows) of every strip, or of every row of tiles, decoded one at a time
+    """
+    with tifffile.TiffFile(filename) as tiff:
+        page = tiff.pages[0]
+        height, width = page.shape[:2]
+        rows, rows_y_0 = None, None
+        for segment, (_, _, y_0, x_0, _), _ in page.segments():
+            if rows is not None and y_0 != rows_y_0:
+                yield rows_y_0, rows
+                rows = None
+            if rows is None:
+                segment_height = min(page.rowsperstrip if not page.is_tiled else page.tilelength, height - y_0)
+                rows, rows_y_0 = np.zeros((segment_height, width) + page.shape[2:], dtype=page.dtype), y_0
+            if segment is None:
+                continue
+            ## segments on the right and bottom edges are padded to the full tile size
+            segment = segment[0, :len(rows), :width - x_0]
+            rows[:, x_0:x_0 + segment.shape[1]] = segment.reshape(segment.shape[:2] + page.shape[2:])
+        if rows is not None:
+            yield rows_y_0, rows
+
+
+def pillow_bands(filename):
+    """
+        Inputs:
+            - filename: Path to the image
+        Outputs:
+            - Generator over the single band (0, np.array(Image.open(filename))); Pillow has no public
+              API which decodes part of a strip-stored image, so it is decoded whole
+    """
+    with Image.open(filename) as image:
+        yield 0, np.array(image)
+
+
+def decoded_bands(filename):
+    """
+        Inputs:
+            - filename: Path to the image
+        Outputs:
+            - Generator over (y_0, rows) of bands covering np.array(Image.open(filename)) from the top;
+              strip by strip when tifffile can decode the image, whole otherwise
+    """
+    if tifffile is not None:
+        try:
+            with tifffile.TiffFile(filename) as tiff:
+                segmented = same_as_pillow(tiff.pages[0])
+        except Exception:
+            segmented = False
+        if segmented:
+            return tifffile_bands(filename)
+    return pillow_bands(filename)
+
+
+class WindowedImageReader(object):
+    """
+        Array-like view of an image on disk. Slicing with [y_0:y_1, x_0:x_1] decodes only the
+        rows which are needed, and keeps the last band of decoded rows around since the
+        crop generator walks the image row by row.
+
+        Backends:
+            - "memmap": uncompressed, contiguous TIFF; mapped straight from the file
+            - "windowed": striped or tiled TIFF; only the intersecting strips/tiles are decoded
+            - "cache": anything else; decoded once into an uncompressed memory-mapped .npy cache, strip by
+              strip when tifffile can decode it
+    """
+
+    def __init__(self, filename, cache_directory=None):
+        """
+            Inputs:
+                - filename: Path to the image
+                - cache_directory: Where the uncompressed cache is kept for images which can not be
+                  windowed, and kept across runs; if None a temporary cache is created and removed on close
+        """
+        self.filename = filename
+        self.cache_directory = cache_directory
+        self._temporary_directory = None
+        self._tiff = None
+        self.source, self.backend = self._open_source()
+        self.shape = tuple(self.source.shape)
+        self.dtype = self.source.dtype
+        ## last band of decoded full-width rows
+        self._band_y_0 = self._band_y_1 = 0
+        self._band = None
+
+    @property
+    def size(self):
+        ## (width, height), matching PIL's Image.size
+        return (self.shape[1], self.shape[0])
+
+    def _open_source(self):
+        if tifffile is not None:
+            try:
+                source = self._open_tiff_source()
+                if source is not None:
+                    return source
+            except Exception as e:
+                print("Falling back to cached decode of %s: %s" % (self.filename, e))
+                self._close_tiff()
+        return self._open_cached_source(), "cache"
+
+    def _open_tiff_source(self):
+        self._tiff = tifffile.TiffFile(self.filename)
+        page = self._tiff.pages[0]
+        if not same_as_pillow(page):
+            self._close_tiff()
+            return None
+        if page.is_memmappable:
+            self._close_tiff()
+            return tifffile.memmap(self.filename, mode="r"), "memmap"
+        if zarr is not None and len(page.dataoffsets) > 1:
+            return zarr.open(page.aszarr(), mode="r"), "windowed"
+        ## a single compressed strip has to be decoded whole anyway
+        self._close_tiff()
+        return None
+
+    def _open_cached_source(self):
+        if self.cache_directory is None:
+            self._temporary_directory = tempfile.mkdtemp(prefix="windowed_image_")
+            cache_directory = self._temporary_directory
+        else:
+            cache_directory = self.cache_directory
+            if not os.path.exists(cache_directory):
+                os.makedirs(cache_directory)
+
+        ## key the cache on the file's size and modification time so a changed map is decoded again
+        stat = os.stat(self.filename)
+        file_stripped_name = self.filename.split(os.sep)[-1].split('.')[0]
+        cache_filename = os.path.join(cache_directory, "%s_%d_%d.npy" % (file_stripped_name, stat.st_size, stat.st_mtime_ns))
+
+        if not os.path.exists(cache_filename):
+            ## fill the cache a band at a time, so the decoded map is never held in memory whole
+            partial_filename = cache_filename + ".partial"
+            with Image.open(self.filename) as image:
+                height = image.size[1]
+            cache = None
+            for y_0, rows in decoded_bands(self.filename):
+                if cache is None:
+                    cache = np.lib.format.open_memmap(partial_filename, mode="w+", dtype=rows.dtype, shape=(height,) + rows.shape[1:])
+                cache[y_0:y_0 + len(rows)] = rows
+            cache.flush()
+            del cache
+            os.rename(partial_filename, cache_filename)
+
+            ## the caches of earlier versions of the map are never read again
+            stale = re.compile(re.escape(file_stripped_name) + r"_\d+_\d+\.npy$")
+            for filename in os.listdir(cache_directory):
+                if stale.match(filename) and os.path.join(cache_directory, filename) != cache_filename:
+                    os.remove(os.path.join(cache_directory, filename))
+
+        return np.load(cache_filename, mmap_mode="r")
+
+    def _rows(self, y_0, y_1):
+        ## full-width rows [y_0, y_1), reusing the overlap with the previously decoded band
+        if self._band is not None and self._band_y_0 <= y_0 and y_1 <= self._band_y_1:
+            return self._band[y_0 - self._band_y_0:y_1 - self._band_y_0]
+        if self._band is not None and self._band_y_0 <= y_0 < self._band_y_1:
+            overlap = self._band[y_0 - self._band_y_0:]
+            band = np.concatenate([overlap, np.asarray(self.source[self._band_y_1:y_1])])
+        else:
+            band = np.asarray(self.source[y_0:y_1])
+        self._band, self._band_y_0, self._band_y_1 = band, y_0, y_0 + len(band)
+        return band
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        row_key = key[0]
+        if self.backend != "windowed" or not isinstance(row_key, slice) or row_key.step not in (None, 1):
+            return np.asarray(self.source[key])
+        y_0, y_1, _ = row_key.indices(self.shape[0])
+        return self._rows(y_0, max(y_0, y_1))[(slice(None),) + key[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.asarray(self.source[:])
+        return array if dtype is None else array.astype(dtype)
+
+    def _close_tiff(self):
+        if self._tiff is not None:
+            self._tiff.close()
+            self._tiff = None
+
+    def close(self):
+        self._band = None
+        self.source = None
+        self._close_tiff()
+        if self._temporary_directory is not None:
+            shutil.rmtree(self._temporary_directory, ignore_errors=True)
+            self._temporary_directory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -6,12 +6,13 @@ import shutil
 def move_matricies(source, destination):
     """
         Inputs:
-            - source: Where the npy files live currently
-            - destination: Where the npy files need to be moved
+            - source: Where the rotation tables (or the per crop npy files of older rotations) live currently
+            - destination: Where they need to be moved
         Outputs:
             None
     """
-    for filename in glob(os.path.join(source, "*.npy")):
+    ## rotate_crops now saves one rotation table per crop size instead of one npy file per rotated crop
+    for filename in glob(os.path.join(source, "*rotation_table.npz")) + glob(os.path.join(source, "*.npy")):
         shutil.move(os.path.join(source, filename), destination)
 
 
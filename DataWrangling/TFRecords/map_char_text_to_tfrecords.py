@@ -5,81 +5,298 @@ import util
 import os
 from dataset_utils import int64_feature, float_feature, bytes_feature, convert_to_example
 
+import json
+import struct
 import sys
+from multiprocessing import Pool
+from optparse import OptionParser
+
 sys.path.append('/home/sgkelley/pixel_link')
+## the crop store lives with the cropping scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Cropping"))
 
 import config
+from crop_store import CropStore, is_crop_store, parse_crop_name
+
+## written next to the tfrecords; sample counts of every split and shard, read by dataset_factory
+MANIFEST_FILENAME = 'tfrecords_manifest.json'
+
+## start of frame markers; every SOFn except DHT (C4), JPG (C8) and DAC (CC)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+def jpeg_size(image_data):
+    ## Reads (height, width) from the frame header of a JPEG, without decoding it
+    ## Arguments
+        ## image_data: Encoded JPEG bytes
+    data = bytearray(image_data)
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            raise ValueError("Malformed JPEG marker at byte %d" % offset)
+        marker = data[offset + 1]
+        ## fill bytes and markers without a length
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            offset += 2
+            continue
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack('>HH', bytes(data[offset + 5:offset + 9]))
+            return height, width
+        offset += 2 + struct.unpack('>H', bytes(data[offset + 2:offset + 4]))[0]
+    raise ValueError("No JPEG frame header found")
+
+def shard_name(annotation_folder, split_name, shard, num_shards):
+    ## Filename of a tfrecord shard; a single shard keeps the unsharded name
+    if num_shards == 1:
+        return '%s_%s.tfrecord' % (annotation_folder, split_name)
+    return '%s_%s-%05d-of-%05d.tfrecord' % (annotation_folder, split_name, shard, num_shards)
+
+def update_manifest(output_dir, annotation_folder, split_name, shard_counts):
+    ## Records the sample count of every shard of a split in the manifest of output_dir
+    ## Arguments
+        ## shard_counts: List of (shard filename, number of examples)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    manifest['%s_%s' % (annotation_folder, split_name)] = {
+        'num_samples': sum(count for _, count in shard_counts),
+        'shards': dict(shard_counts)
+    }
+    with open(manifest_path + '.partial', 'w+') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.rename(manifest_path + '.partial', manifest_path)
+
+def split_shards(image_names, num_shards):
+    ## Contiguous runs of images, so reading the shards in order gives the unsharded order
+    return [list(names) for names in np.array_split(np.array(image_names, dtype=object), num_shards)]
+
+def run_shard_tasks(worker, tasks, num_workers):
+    ## Runs worker over the shard tasks, on a pool of processes when there is more than one of each
+    if num_workers > 1 and len(tasks) > 1:
+        pool = Pool(min(num_workers, len(tasks)), maxtasksperchild=1)
+        try:
+            return pool.map(worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return [worker(task) for task in tasks]
 
+def lines_to_example(image_data, image_name, shape, lines):
+    ## Builds the example of a crop from the lines of its annotation text file
+    oriented_bboxes = [];
+    bboxes = []
+    labels = [];
+    labels_text = [];
+    h, w = shape[0:2];
+    h *= 1.0;
+    w *= 1.0;
+    for line in lines:
+        line = util.str.remove_all(line, '\xef\xbb\xbf')
+        gt = util.str.split(line, ',');
+        oriented_box = [int(gt[i]) for i in range(8)];
+        oriented_box = np.asarray(oriented_box) / ([w, h] * 4);
+        oriented_bboxes.append(oriented_box);
         
+        xs = oriented_box.reshape(4, 2)[:, 0]                
+        ys = oriented_box.reshape(4, 2)[:, 1]
+        xmin = xs.min()
+        xmax = xs.max()
+        ymin = ys.min()
+        ymax = ys.max()
+        bboxes.append([xmin, ymin, xmax, ymax])
 
-def cvt_to_tfrecords(output_path , data_path, gt_path):
-    image_names = util.io.ls(data_path, '.jpg')#[0:10];
+        # might be wrong here, but it doesn't matter because the label is not going to be used in detection
+        labels_text.append(gt[-1]); 
+        ignored = util.str.contains(gt[-1], '###')
+        if ignored:
+            labels.append(config.ignore_label);
+        else:
+            labels.append(config.text_label)
+    return convert_to_example(image_data, image_name, labels, labels_text, bboxes, oriented_bboxes, shape)
+
+def boxes_to_example(image_data, image_name, shape, boxes):
+    ## Builds the example of a crop from its int (N, 8) boxes in a crop store
+    oriented_bboxes = [];
+    bboxes = []
+    labels = [];
+    labels_text = [];
+    h, w = shape[0:2];
+    h *= 1.0;
+    w *= 1.0;
+    for box in boxes:
+        oriented_box = np.asarray(box) / ([w, h] * 4);
+        oriented_bboxes.append(oriented_box);
+        
+        xs = oriented_box.reshape(4, 2)[:, 0]                
+        ys = oriented_box.reshape(4, 2)[:, 1]
+        bboxes.append([xs.min(), ys.min(), xs.max(), ys.max()])
+
+        ## same label text as the last field of a text annotation line
+        labels_text.append(str(box[-1]));
+        labels.append(config.text_label)
+    return convert_to_example(image_data, image_name, labels, labels_text, bboxes, oriented_bboxes, shape)
+
+def read_image(path):
+    ## Returns the JPEG bytes and the (h, w, 3) shape of an image; only the JPEG header is read
+    ## to get the size, and crops are decoded as RGB
+    image_data = tf.gfile.FastGFile(path, 'rb').read()
+    h, w = jpeg_size(image_data)
+    return image_data, (h, w, 3)
+
+def cvt_to_tfrecords(output_path , data_path, gt_path, image_names=None):
+    ## Returns the number of examples written
+    ## Arguments
+        ## image_names: Optional subset of the images in data_path to convert, e.g. one shard
+    if image_names is None:
+        image_names = util.io.ls(data_path, '.jpg')#[0:10];
     print("%d images found in %s"%(len(image_names), data_path));
     with tf.python_io.TFRecordWriter(output_path) as tfrecord_writer:
         for idx, image_name in enumerate(image_names):
-            oriented_bboxes = [];
-            bboxes = []
-            labels = [];
-            labels_text = [];
             path = util.io.join_path(data_path, image_name);
             print("\tconverting image: %d/%d %s"%(idx, len(image_names), image_name));
-            image_data = tf.gfile.FastGFile(path, 'r').read()
-            
-            image = util.img.imread(path, rgb = True);
-            shape = image.shape
-            h, w = shape[0:2];
-            h *= 1.0;
-            w *= 1.0;
+            image_data, shape = read_image(path)
             image_name = util.str.split(image_name, '.')[0];
             
             gt_name = 'annotation_' + image_name[14:] + '.txt';
             gt_filepath = util.io.join_path(gt_path, gt_name);
             lines = util.io.read_lines(gt_filepath);
-                
-            for line in lines:
-                line = util.str.remove_all(line, '\xef\xbb\xbf')
-                gt = util.str.split(line, ',');
-                oriented_box = [int(gt[i]) for i in range(8)];
-                oriented_box = np.asarray(oriented_box) / ([w, h] * 4);
-                oriented_bboxes.append(oriented_box);
-                
-                xs = oriented_box.reshape(4, 2)[:, 0]                
-                ys = oriented_box.reshape(4, 2)[:, 1]
-                xmin = xs.min()
-                xmax = xs.max()
-                ymin = ys.min()
-                ymax = ys.max()
-                bboxes.append([xmin, ymin, xmax, ymax])
-
-                # might be wrong here, but it doesn't matter because the label is not going to be used in detection
-                labels_text.append(gt[-1]); 
-                ignored = util.str.contains(gt[-1], '###')
-                if ignored:
-                    labels.append(config.ignore_label);
-                else:
-                    labels.append(config.text_label)
-            example = convert_to_example(image_data, image_name, labels, labels_text, bboxes, oriented_bboxes, shape)
+            example = lines_to_example(image_data, image_name, shape, lines)
             tfrecord_writer.write(example.SerializeToString())
-        
+    return len(image_names)
+
+def cvt_all_to_tfrecords(output_dir, data_path, gt_parent_path, annotation_folders, split_name, image_names=None, shard=0, num_shards=1):
+    ## Same as calling cvt_to_tfrecords for every annotation folder, but every image is read once and
+    ## fanned out to the tfrecords of all of the folders
+    ## Arguments
+        ## output_dir: Directory of the tfrecords
+        ## gt_parent_path: Directory containing the annotation folders
+        ## annotation_folders: Names of the character folders, e.g. char_anots_a
+        ## split_name: train or test
+        ## image_names: Optional subset of the images in data_path to convert, e.g. one shard
+        ## shard, num_shards: Which shard of the split is written
+    ## Returns a list of (annotation folder, tfrecord filename, number of examples)
+    if image_names is None:
+        image_names = util.io.ls(data_path, '.jpg')
+    print("%d images found in %s"%(len(image_names), data_path));
+    filenames = [shard_name(annotation_folder, split_name, shard, num_shards) for annotation_folder in annotation_folders]
+    writers = [tf.python_io.TFRecordWriter(util.io.join_path(output_dir, filename)) for filename in filenames]
+    try:
+        for idx, image_name in enumerate(image_names):
+            print("\tconverting image: %d/%d %s"%(idx, len(image_names), image_name));
+            image_data, shape = read_image(util.io.join_path(data_path, image_name))
+            image_name = util.str.split(image_name, '.')[0];
+            gt_name = 'annotation_' + image_name[14:] + '.txt';
+            for annotation_folder, tfrecord_writer in zip(annotation_folders, writers):
+                lines = util.io.read_lines(util.io.join_path(gt_parent_path, annotation_folder, gt_name));
+                example = lines_to_example(image_data, image_name, shape, lines)
+                tfrecord_writer.write(example.SerializeToString())
+    finally:
+        for tfrecord_writer in writers:
+            tfrecord_writer.close()
+    return [(annotation_folder, filename, len(image_names)) for annotation_folder, filename in zip(annotation_folders, filenames)]
+
+def cvt_all_shard_worker(arguments):
+    ## Pool worker; converts one shard of every annotation folder
+    return cvt_all_to_tfrecords(*arguments)
+
+def record_shard_counts(output_dir, annotation_folders, split_name, results):
+    ## Writes the (annotation folder, filename, count) results of every shard to the manifest
+    for annotation_folder in annotation_folders:
+        shard_counts = [(filename, count) for shard_results in results for folder, filename, count in shard_results if folder == annotation_folder]
+        update_manifest(output_dir, annotation_folder, split_name, shard_counts)
+
+def cvt_all_to_sharded_tfrecords(output_dir, data_path, gt_parent_path, annotation_folders, split_name, num_shards=1, num_workers=1):
+    ## Same as cvt_all_to_tfrecords, but splits the images into num_shards tfrecords per annotation folder,
+    ## written by a pool of processes, and records the shard sizes in the manifest
+    image_names = util.io.ls(data_path, '.jpg')
+    tasks = [(output_dir, data_path, gt_parent_path, annotation_folders, split_name, names, shard, num_shards) for shard, names in enumerate(split_shards(image_names, num_shards))]
+    results = run_shard_tasks(cvt_all_shard_worker, tasks, num_workers)
+    record_shard_counts(output_dir, annotation_folders, split_name, results)
+    return results
+
+def cvt_store_all_to_tfrecords(output_dir, store_directory, crop_names, class_names, split_name, shard=0, num_shards=1):
+    ## Same as cvt_all_to_tfrecords, for a crop store; every crop and its annotations are read once
+    ## Returns a list of (annotation folder, tfrecord filename, number of examples)
+    store = CropStore(store_directory)
+    print("%d images found in %s"%(len(crop_names), store_directory));
+    filenames = [shard_name(annotation_folder, split_name, shard, num_shards) for annotation_folder in class_names]
+    writers = [tf.python_io.TFRecordWriter(util.io.join_path(output_dir, filename)) for filename in filenames]
+    try:
+        for idx, image_name in enumerate(crop_names):
+            print("\tconverting image: %d/%d %s"%(idx, len(crop_names), image_name));
+            map_name, x_0, y_0 = parse_crop_name(image_name)
+            image_data = store.read_image(map_name, x_0, y_0)
+            h, w = jpeg_size(image_data)
+            records = store.crop_records(map_name, x_0, y_0)
+            map_class_names = store.annotations(map_name)[1]
+            for annotation_folder, tfrecord_writer in zip(class_names, writers):
+                if annotation_folder in map_class_names:
+                    boxes = records["box"][records["class"] == map_class_names.index(annotation_folder)].astype(np.int32)
+                else:
+                    boxes = np.zeros((0, 8), dtype=np.int32)
+                example = boxes_to_example(image_data, image_name, (h, w, 3), boxes)
+                tfrecord_writer.write(example.SerializeToString())
+    finally:
+        for tfrecord_writer in writers:
+            tfrecord_writer.close()
+    return [(annotation_folder, filename, len(crop_names)) for annotation_folder, filename in zip(class_names, filenames)]
+
+def cvt_store_all_shard_worker(arguments):
+    ## Pool worker; converts one shard of every character folder of a crop store
+    return cvt_store_all_to_tfrecords(*arguments)
+
+def cvt_store_splits_to_tfrecords(root_dir, num_shards=1, num_workers=1):
+    ## Converts the train and test splits of a crop store, written by train_test_split.py, for every character folder
+    ## Arguments
+        ## root_dir: Parent cropped directory, containing the store and the split directories
+        ## num_shards: Number of tfrecords every character folder and split is written to
+        ## num_workers: Number of processes writing shards
+    store_directory = util.io.join_path(root_dir, 'store')
+    class_names = CropStore(store_directory).class_names()
+    ## both splits are written next to each other, as for the file based crops
+    output_dir = os.path.join(root_dir, 'train_split', 'tfrecords')
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    for split_name in ['train', 'test']:
+        split_dir = util.io.join_path(root_dir, split_name + '_split')
+        crop_names = util.io.read_lines(util.io.join_path(split_dir, split_name + '_split.txt'))
+        crop_names = [crop_name.strip() for crop_name in crop_names if crop_name.strip()]
+        tasks = [(output_dir, store_directory, names, class_names, split_name, shard, num_shards) for shard, names in enumerate(split_shards(crop_names, num_shards))]
+        results = run_shard_tasks(cvt_store_all_shard_worker, tasks, num_workers)
+        record_shard_counts(output_dir, class_names, split_name, results)
+
 if __name__ == "__main__":
-    root_dir = util.io.get_absolute_path('/mnt/nfs/work1/elm/sgkelley/shishir/cropped')
+    parser = OptionParser()
+    parser.add_option("-r", "--root", default="/mnt/nfs/work1/elm/sgkelley/shishir/cropped", help="parent cropped directory, containing the split directories")
+    parser.add_option("-n", "--shards", type="int", default=1, help="number of tfrecords every character folder and split is written to")
+    parser.add_option("-w", "--workers", type="int", default=1, help="number of processes writing shards")
+    (options, args) = parser.parse_args()
+
+    root_dir = util.io.get_absolute_path(options.root)
     train_split_dir = util.io.join_path(root_dir, 'train_split')
     test_split_dir = util.io.join_path(root_dir, 'test_split')
 
+    if is_crop_store(util.io.join_path(root_dir, 'store')):
+        cvt_store_splits_to_tfrecords(root_dir, options.shards, options.workers)
+        sys.exit(0)
+
     os.mkdir(os.path.join(train_split_dir, 'tfrecords'))
     os.mkdir(os.path.join(test_split_dir, 'tfrecords'))
 
+    ## every image is read once for all of the annotation folders
     training_data_dir = util.io.join_path(train_split_dir, 'images')
     output_dir = util.io.join_path(os.path.join(train_split_dir, 'tfrecords'))
     annotations_parent_directory = util.io.join_path(train_split_dir, 'annotations')
-    for annotation_folder in list(filter(lambda folder: os.path.isdir(os.path.join(annotations_parent_directory, folder)), os.listdir(annotations_parent_directory))):
-        training_gt_dir = util.io.join_path(train_split_dir, 'annotations', annotation_folder)
-        cvt_to_tfrecords(output_path = util.io.join_path(output_dir, annotation_folder + '_train.tfrecord'), data_path = training_data_dir, gt_path = training_gt_dir)
+    annotation_folders = list(filter(lambda folder: os.path.isdir(os.path.join(annotations_parent_directory, folder)), os.listdir(annotations_parent_directory)))
+    cvt_all_to_sharded_tfrecords(output_dir, training_data_dir, annotations_parent_directory, annotation_folders, 'train', options.shards, options.workers)
     
     
     output_dir = util.io.join_path(os.path.join(train_split_dir, 'tfrecords'))
     test_data_dir = util.io.join_path(test_split_dir, 'images')
     annotations_parent_directory = util.io.join_path(test_split_dir, 'annotations')
-    for annotation_folder in list(filter(lambda folder: os.path.isdir(os.path.join(annotations_parent_directory, folder)), os.listdir(annotations_parent_directory))):
-        test_gt_dir = util.io.join_path(test_split_dir, 'annotations', annotation_folder)
-        cvt_to_tfrecords(output_path = util.io.join_path(output_dir, annotation_folder + '_test.tfrecord'), data_path = test_data_dir, gt_path = test_gt_dir)
\ No newline at end of file
+    annotation_folders = list(filter(lambda folder: os.path.isdir(os.path.join(annotations_parent_directory, folder)), os.listdir(annotations_parent_directory)))
+    cvt_all_to_sharded_tfrecords(output_dir, test_data_dir, annotations_parent_directory, annotation_folders, 'test', options.shards, options.workers)
@@ -4,7 +4,12 @@ from sklearn.model_selection import train_test_split
 from shutil import copyfile
 from glob import glob
 
+## the crop store lives with the cropping scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Cropping"))
+from crop_store import CropStore, is_crop_store
+
 cropped_path = sys.argv[1] ## parent cropped directory
+store_dir_path = os.path.join(cropped_path, "store")
 
 images_dir_path = os.path.join(cropped_path, "images")
 annotations_dir_path = os.path.join(cropped_path, "annotations")
@@ -28,6 +33,19 @@ train_split_annotations_path = os.path.join(train_split_path, "annotations")
 test_split_images_path = os.path.join(test_split_path, "images")
 test_split_annotations_path = os.path.join(test_split_path, "annotations")
 
+if is_crop_store(store_dir_path):
+    ## crops in a sharded crop store are read straight from the store, so only the
+    ## names of the crops in each split are written; nothing is copied
+    crop_names = CropStore(store_dir_path).crop_names()
+    train_idx, test_idx = train_test_split(list(range(len(crop_names))), test_size=0.2)
+    with open(os.path.join(train_split_path, "train_split.txt"), 'w+') as train_file:
+        for idx in train_idx:
+            train_file.write("%s\n" % crop_names[idx])
+    with open(os.path.join(test_split_path, "test_split.txt"), 'w+') as test_file:
+        for idx in test_idx:
+            test_file.write("%s\n" % crop_names[idx])
+    sys.exit(0)
+
 
 image_filenames = glob(os.path.join(images_dir_path, "*.jpg"))
 train_idx, test_idx = train_test_split(list(range(len(image_filenames))), test_size=0.2)
@@ -12,33 +12,36 @@ import sys
 from optparse import OptionParser
 
 import numpy as np
-from scipy.optimize import linear_sum_assignment
 
-from file_dictionary_util import (createGroundTruthDictionary,
+from file_dictionary_util import (TilingPlan, createGroundTruthDictionary,
+                                  createGroundTruthDictionaryFromStore,
+                                  createDictionaryFromTable, is_annotation_table,
                                   createPredictedDictionary, generateIoUReport,
                                   generateIoUReportThresholded,
-                                  generatePRCurves)
-from iou_util import performPolygonIoUCalculationThresholded
+                                  generatePRCurves,
+                                  generateThresholdedPrecisionRecallReport)
+from iou_util import AP_METHODS, IOU_ENGINES, MATCHERS, RANKINGS, performPolygonIoUCalculationMultiThreshold
 
-## instantiate an options parser to load ground truth annotations and predictions
-parser = OptionParser()
-parser.add_option("-d", "--detector", help="specify which character detector is being evaluated")
-parser.add_option("-o", "--original", help="directory containing the original images in tiff format")
-parser.add_option("-g", "--groundtruth", help="directory containing ground truth annotation files")
-parser.add_option("-p", "--predictions", help="directory containing predicted annotation files")
-parser.add_option("-r", "--reports", help="outfile directory to output the reports")
-
-## get options
-(options, args) = parser.parse_args()
-detector = options.detector
-original_images_dir = options.original
-ground_truth_directory = options.groundtruth
-ground_truth_files = glob.glob(ground_truth_directory)
-predictions_directory = options.predictions
-predictions_files = glob.glob(predictions_directory)
-reports_directory = options.reports
+def parseThresholds(thresholds):
+    """
+    Inputs:
+        - thresholds: "start:step:stop", with stop included, or a comma separated list of thresholds
+    Outputs:
+        - thresholds: List of float thresholds; a ValueError is raised for a malformed or empty range
+    """
+    if ":" in thresholds:
+        values = thresholds.split(":")
+        if len(values) != 3:
+            raise ValueError("threshold range %s must be start:step:stop" % thresholds)
+        start, step, stop = [float(x) for x in values]
+        if step <= 0:
+            raise ValueError("threshold range %s needs a positive step" % thresholds)
+        if start > stop:
+            raise ValueError("threshold range %s starts after it stops" % thresholds)
+        return [round(threshold, 10) for threshold in np.arange(start, stop + step / 2, step)]
+    return [float(x) for x in thresholds.split(",")]
 
-def driver(detector, original_images_dir, ground_truth_directory, predictions_directory, reports_dir):
+def driver(detector, original_images_dir, ground_truth_directory, predictions_directory, reports_dir, tiling_plan=None, store_dir=None, character_folder=None, engine="numpy", thresholds=None, num_workers=1, cache_dir=None, merge=None, ranking="file", ap_method="mean", pooled=False, matcher="legacy", rotated_dir=None):
     """
     Run IoU metric script for specified character detector
     
@@ -46,22 +49,48 @@ def driver(detector, original_images_dir, ground_truth_directory, predictions_di
         - detector: Letter of the detector to be evaluated
         - ground_truth_directory: Directory containing the ground truth annotations for the specified letter
         - predictions_directory: Directory containing the predictied annotations for the specified letter
+        - tiling_plan: Optional TilingPlan; only the crops on its windows are evaluated
+        - store_dir: Optional crop store to read the ground truth annotations from, instead of ground_truth_directory
+        - character_folder: Character folder of the detector in the crop store
+        - engine: Polygon IoU engine
+        - num_workers: Number of processes the images are evaluated in
+        - cache_dir: Optional directory to cache the parsed ground truth annotation files in
+        - merge: Optional merge spec for the duplicate predictions of overlapping crops
+        - ranking: Order the predictions take their matches in, one of RANKINGS
+        - ap_method: Average precision of a curve, one of AP_METHODS
+        - pooled: Also compute the dataset level average precision
+        - matcher: How predictions are matched to the ground truth, one of MATCHERS
+        - rotated_dir: Optional directory or annotation table containing the predicted annotations of the rotated
+          crops, fused with the predictions of the horizontal crops
+        - thresholds: IoU thresholds to evaluate; defaults to 0, 0.1, ..., 1
     """
     ## concatenate all ground truth annotations for an image into a single text file
     ## dictionary keys are image filenames and value is list of lists of all annotations in float 8 point form
-    ground_truth_annotation_dictionary = createGroundTruthDictionary(original_images_dir, ground_truth_directory)
+    if store_dir:
+        ground_truth_annotation_dictionary = createGroundTruthDictionaryFromStore(original_images_dir, store_dir, character_folder or "char_anots_%s" % detector, tiling_plan)
+    elif is_annotation_table(ground_truth_directory):
+        ground_truth_annotation_dictionary = createDictionaryFromTable(original_images_dir, ground_truth_directory, character_folder, tiling_plan)
+    else:
+        ground_truth_annotation_dictionary = createGroundTruthDictionary(original_images_dir, ground_truth_directory, tiling_plan, cache_dir)
     
     ## concatenate all predicted annotations for an image into a single text file
     ## dictionary keys are image filenames and value is list of lists of all annotations in float 8 point form
-    predicted_annotation_dictionary = createPredictedDictionary(original_images_dir, predictions_directory)
+    ## the confidences are read when they rank the predictions, and for the dataset average
+    ## precision, which always ranks the pooled detections by score
+    with_scores = ranking == "score" or pooled
+    predicted_annotation_dictionary = createPredictedDictionary(original_images_dir, predictions_directory, tiling_plan, merge, with_scores, rotated_dir, character_folder)
+
+    predicted_score_dictionary = None
+    if with_scores:
+        predicted_annotation_dictionary, predicted_score_dictionary = predicted_annotation_dictionary
 
     ## set number of curve threshold values
-    thresholds = list(np.linspace(0, 1, 11))
-    thresholded_dictionary = {}
+    if thresholds is None:
+        thresholds = list(np.linspace(0, 1, 11))
 
-    # dictionary keys are the image filenames and value is the average IoU score
-    for threshold in thresholds:
-        thresholded_dictionary[threshold] = performPolygonIoUCalculationThresholded(ground_truth_annotation_dictionary, predicted_annotation_dictionary, threshold)
+    ## the polygon IoUs are computed once and scored at every threshold
+    thresholded_dictionary = performPolygonIoUCalculationMultiThreshold(ground_truth_annotation_dictionary, predicted_annotation_dictionary, thresholds, engine, num_workers,
+                                                                         predicted_score_dictionary, ranking, ap_method, pooled, matcher)
     
     ## output text file with all average IoU values
     if not reports_dir:
@@ -75,15 +104,60 @@ def driver(detector, original_images_dir, ground_truth_directory, predictions_di
     if not os.path.isdir(figures_dir):
         os.mkdir(figures_dir)
     
-    ## output the correct text report
+    ## output the text report and the pr curve figures
     report_filepath = os.path.join(reports_dir, "%s_iou_report_thresholded.txt" % detector)
-    generateIoUReportThresholded(thresholds, thresholded_dictionary, report_filepath)
-
-    ## output the correct pr curve figures
-    generatePRCurves(thresholded_dictionary, detector, figures_dir)
+    generateThresholdedPrecisionRecallReport(thresholds, thresholded_dictionary, detector, figures_dir, report_filepath)
 
     ## signal completion
     print("PR Curve Calculation Complete!")
 
-## run
-driver(detector, original_images_dir, ground_truth_directory, predictions_directory, reports_directory)
+if __name__ == "__main__":
+    ## instantiate an options parser to load ground truth annotations and predictions
+    parser = OptionParser()
+    parser.add_option("-d", "--detector", help="specify which character detector is being evaluated")
+    parser.add_option("-o", "--original", help="directory containing the original images in tiff format")
+    parser.add_option("-g", "--groundtruth", help="directory containing ground truth annotation files, or a ground truth annotation table")
+    parser.add_option("-p", "--predictions", help="directory containing predicted annotation files, a predicted annotation table, or a fused prediction file")
+    parser.add_option("-x", "--rotated", help="optional directory containing the predicted annotation files of the rotated crops, or their annotation table; fused with --predictions")
+    parser.add_option("-r", "--reports", help="outfile directory to output the reports")
+    parser.add_option("-t", "--tiling", help="optional tiling plan json; only crops on its windows are evaluated")
+    parser.add_option("-s", "--store", help="optional crop store directory to read the ground truth annotations from instead of --groundtruth")
+    parser.add_option("-e", "--engine", default="numpy", choices=IOU_ENGINES, help="polygon IoU engine: numpy (batched) or shapely (one Polygon per pair)")
+    parser.add_option("-T", "--thresholds", default="0:0.1:1", help="IoU thresholds, as start:step:stop (inclusive, e.g. 0.5:0.05:0.95 for COCO) or a comma separated list")
+    parser.add_option("-w", "--workers", type="int", default=1, help="number of processes the images are evaluated in")
+    parser.add_option("-c", "--character", help="character folder of the detector in the crop store or annotation tables; defaults to char_anots_<detector> for the store")
+    parser.add_option("-k", "--cache", help="optional directory to cache the parsed ground truth annotation files in")
+    parser.add_option("-m", "--merge", help="optional merge of the duplicate predictions of overlapping crops: nms or wbf, with an optional IoU threshold, e.g. nms:0.5")
+    parser.add_option("-R", "--ranking", default="file", choices=RANKINGS, help="order the predictions take their matches in: file (as read) or score (by decreasing confidence)")
+    parser.add_option("-a", "--ap", default="mean", choices=AP_METHODS, help="average precision of a curve: mean (mean precision, the original metric) or voc (interpolated)")
+    parser.add_option("-P", "--pooled", action="store_true", default=False, help="also report the dataset level average precision over the detections of all images, ranked by score; needs scored predictions")
+    parser.add_option("-M", "--matching", default="legacy", choices=MATCHERS, help="matching of predictions to ground truth: legacy (best match only, the original metric), greedy (best unmatched) or optimal (assignment)")
+
+    ## get options
+    (options, args) = parser.parse_args()
+    try:
+        thresholds = parseThresholds(options.thresholds)
+    except ValueError as e:
+        parser.error("--thresholds: %s" % e)
+    detector = options.detector
+    original_images_dir = options.original
+    ground_truth_directory = options.groundtruth
+    ground_truth_files = glob.glob(ground_truth_directory) if ground_truth_directory else []
+    predictions_directory = options.predictions
+    predictions_files = glob.glob(predictions_directory)
+    reports_directory = options.reports
+    tiling_plan = TilingPlan.load(options.tiling) if options.tiling else None
+    store_directory = options.store
+    character_folder = options.character
+    engine = options.engine
+    num_workers = options.workers
+    cache_directory = options.cache
+    merge = options.merge
+    ranking = options.ranking
+    ap_method = options.ap
+    pooled = options.pooled
+    matcher = options.matching
+    rotated_directory = options.rotated
+
+    ## run
+    driver(detector, original_images_dir, ground_truth_directory, predictions_directory, reports_directory, tiling_plan, store_directory, character_folder, engine, thresholds, num_workers, cache_directory, merge, ranking, ap_method, pooled, matcher, rotated_directory)
@@ -0,0 +1,311 @@
+"""
+    The purpose of this file is to evaluate every character detector in one run. The original map
+    listing is read once and shared by all detectors, the detectors are evaluated in one process
+    or a pool of them, and a consolidated per-character mAP table is written next to the usual
+    per-detector IoU reports. Detectors whose annotations did not change since the last run are
+    not evaluated again.
+"""
+
+import hashlib
+import json
+import os
+import statistics
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import matplotlib.pyplot as plt
+
+from file_dictionary_util import (CropStore, TilingPlan, annotationsFingerprint, createAnchorFilter,
+                                  createDictionaryFromTable, createGroundTruthDictionary,
+                                  createGroundTruthDictionaryFromStore, createPredictedDictionary,
+                                  generatePrecisionRecallReport, is_annotation_table,
+                                  listOriginalImages, read_annotation_table)
+from iou_util import AP_METHODS, IOU_ENGINES, MATCHERS, RANKINGS, SUMMARY_KEYS, performPolygonIoUCalculation
+
+## files of the batch run in the reports directory
+SUMMARY_FILENAME = "all_detectors_report.txt"
+STATE_FILENAME = "all_detectors_state.json"
+
+def detectorFolders(annotations_root, folder_format):
+    """
+    Finds the per-character folders (or annotation table classes) under a root
+    Inputs:
+        - annotations_root: Directory of per-character annotation folders, or an annotation table
+        - folder_format: Folder name of a detector, with %s for the detector letter
+    Outputs:
+        - folders: Dictionary of {detector: folder name}
+    """
+    if is_annotation_table(annotations_root):
+        _, _, names = read_annotation_table(annotations_root)
+    else:
+        names = sorted(name for name in os.listdir(annotations_root) if os.path.isdir(os.path.join(annotations_root, name)))
+
+    ## recover the detector letter from the folder name
+    prefix, suffix = folder_format.split("%s")
+    folders = {}
+    for name in names:
+        if name.startswith(prefix) and name.endswith(suffix) and len(name) > len(prefix) + len(suffix):
+            folders[name[len(prefix):len(name) - len(suffix)]] = name
+    return folders
+
+def annotationsSource(annotations_root, folder):
+    """
+    Inputs:
+        - annotations_root: Directory of per-character annotation folders, or an annotation table
+        - folder: Folder name of the detector
+    Outputs:
+        - source: The detector's annotation directory, or the table itself
+    """
+    return annotations_root if is_annotation_table(annotations_root) else os.path.join(annotations_root, folder)
+
+def detectorFingerprint(ground_truth_source, predictions_source, image_filenames, tiling_file, settings, class_name=None, rotated_source=None):
+    """
+    Fingerprints everything a detector's evaluation depends on
+    Inputs:
+        - ground_truth_source: Ground truth directory, crop store or annotation table of the detector
+        - predictions_source: Predictions directory or annotation table of the detector
+        - image_filenames: Filenames of the original maps
+        - tiling_file: Optional tiling plan json
+        - settings: Dictionary of the evaluation settings which change the results
+        - class_name: Folder name of the detector; only its records of an annotation table are fingerprinted
+        - rotated_source: Optional rotated crop predictions directory or annotation table of the detector
+    Outputs:
+        - fingerprint: Hex digest of the inputs
+    """
+    digest = hashlib.sha1()
+    digest.update(annotationsFingerprint(ground_truth_source, class_name).encode("utf-8"))
+    digest.update(annotationsFingerprint(predictions_source, class_name).encode("utf-8"))
+    if rotated_source:
+        digest.update(annotationsFingerprint(rotated_source, class_name).encode("utf-8"))
+    digest.update("\n".join(sorted(os.path.basename(f) for f in image_filenames)).encode("utf-8"))
+    if tiling_file:
+        stat = os.stat(tiling_file)
+        digest.update(("%s\0%d\0%d" % (os.path.abspath(tiling_file), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def evaluateDetector(arguments):
+    """
+    Evaluates one detector and writes its IoU report, as IoU.py does
+    Inputs:
+        - arguments: (detector, folder, original_images_dir, ground_truth_source, predictions_source,
+          rotated_source, reports_dir, tiling_plan, store_dir, num_workers, settings); rotated_source
+          is None without rotated predictions, and settings holds the engine, cache_dir, merge, ranking,
+          ap_method, pooled and matcher options of driver
+    Outputs:
+        - detector, mAP, dataset AP (None unless pooled), number of images evaluated
+    """
+    detector, folder, original_images_dir, ground_truth_source, predictions_source, rotated_source, reports_dir, tiling_plan, store_dir, num_workers, settings = arguments
+    merge = settings["merge"]
+    ranking = settings["ranking"]
+
+    ## the ground truth and predicted dictionaries, read the same way as IoU.py
+    if store_dir:
+        ground_truth_annotation_dictionary = createGroundTruthDictionaryFromStore(original_images_dir, store_dir, folder, tiling_plan)
+    elif is_annotation_table(ground_truth_source):
+        ground_truth_annotation_dictionary = createDictionaryFromTable(original_images_dir, ground_truth_source, folder, tiling_plan)
+    else:
+        ground_truth_annotation_dictionary = createGroundTruthDictionary(original_images_dir, ground_truth_source, tiling_plan, settings["cache_dir"])
+
+    ## the confidences are read when they rank the predictions, and for the dataset average
+    ## precision, which always ranks the pooled detections by score
+    with_scores = ranking == "score" or settings["pooled"]
+    predicted_annotation_dictionary = createPredictedDictionary(original_images_dir, predictions_source, tiling_plan, merge, with_scores, rotated_source, folder)
+
+    predicted_score_dictionary = None
+    if with_scores:
+        predicted_annotation_dictionary, predicted_score_dictionary = predicted_annotation_dictionary
+
+    calculated_iou_dictionary = performPolygonIoUCalculation(ground_truth_annotation_dictionary, predicted_annotation_dictionary, engine=settings["engine"], num_workers=num_workers,
+                                                             predicted_score_dictionary=predicted_score_dictionary, ranking=ranking, ap_method=settings["ap_method"], pooled=settings["pooled"], matcher=settings["matcher"])
+
+    report_filepath = os.path.join(reports_dir, "%s_iou_report.txt" % detector)
+    generatePrecisionRecallReport(calculated_iou_dictionary, detector, reports_dir, report_filepath)
+    ## the per image curves are not needed once saved
+    plt.close("all")
+
+    num_images = len([key for key in calculated_iou_dictionary if key not in SUMMARY_KEYS])
+    return detector, calculated_iou_dictionary['detector_mAP'], calculated_iou_dictionary.get('dataset_AP'), num_images
+
+def evaluateDetectorWorker(arguments):
+    """
+    Pool entry point; wraps evaluateDetector so that a failing detector is reported instead of
+    losing the results of the others
+    Inputs:
+        - arguments: See evaluateDetector
+    Outputs:
+        - (detector, result, error): result is the output of evaluateDetector and error None if the
+          detector was evaluated, else result is None and error the error message
+    """
+    try:
+        return arguments[0], evaluateDetector(arguments), None
+    except Exception as e:
+        return arguments[0], None, "%s: %s" % (type(e).__name__, e)
+
+def loadState(reports_dir):
+    ## Results of the previous run, keyed by detector
+    state_filepath = os.path.join(reports_dir, STATE_FILENAME)
+    if not os.path.isfile(state_filepath):
+        return {}
+    with open(state_filepath) as f:
+        return json.load(f)
+
+def saveState(reports_dir, state):
+    with open(os.path.join(reports_dir, STATE_FILENAME), "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+def generateSummaryReport(state, detectors, report_path):
+    """
+    Creates a text file with one line per detector and the mean over the detectors
+
+    Inputs:
+        - state: Dictionary of {detector: {"mAP", "dataset_AP", "images", ...}}, or {detector: {"error"}}
+          for the detectors which failed
+        - detectors: Detectors to report, in order
+        - report_path: Filepath to where the report should be written
+    """
+    evaluated = [detector for detector in detectors if "error" not in state[detector]]
+    with open(report_path, "w+") as f:
+        f.write("%-10s %-22s %-25s %s\n" % ("Detector", "Mean Average Precision", "Dataset Average Precision", "Images"))
+        for detector in detectors:
+            if "error" in state[detector]:
+                f.write("%-10s Failed: %s\n" % (detector, state[detector]["error"]))
+            else:
+                f.write("%-10s %-22s %-25s %d\n" % (detector, str(state[detector]["mAP"]), str(state[detector].get("dataset_AP", "-")), state[detector]["images"]))
+        if evaluated:
+            f.write("Mean over detectors=%s\n" % str(statistics.mean(state[detector]["mAP"] for detector in evaluated)))
+
+def driver(original_images_dir, ground_truth_root, predictions_root, reports_dir, folder_format="char_anots_%s", detectors=None, tiling_file=None, store_dir=None, engine="numpy", num_workers=1, force=False, cache_dir=None, merge=None, ranking="file", ap_method="mean", pooled=False, matcher="legacy", rotated_root=None):
+    """
+    Run IoU metric script for every character detector
+
+    Inputs:
+        - original_images_dir: Directory containing the original images
+        - ground_truth_root: Directory of per-character ground truth folders, or a ground truth annotation table
+        - predictions_root: Directory of per-character prediction folders, or a predicted annotation table
+        - reports_dir: Directory the per-detector and consolidated reports are written to
+        - folder_format: Folder name of a detector, with %s for the detector letter
+        - detectors: Optional list of detectors to evaluate; defaults to every detector with predictions
+        - tiling_file: Optional tiling plan json; only the crops on its windows are evaluated
+        - store_dir: Optional crop store to read the ground truth annotations from, instead of ground_truth_root
+        - engine: Polygon IoU engine
+        - num_workers: Number of processes the detectors are evaluated in
+        - force: Evaluate every detector, even those whose annotations did not change
+        - cache_dir: Optional directory to cache the parsed ground truth annotation files in
+        - merge: Optional merge spec for the duplicate predictions of overlapping crops
+        - ranking: Order the predictions take their matches in, one of RANKINGS
+        - ap_method: Average precision of a curve, one of AP_METHODS
+        - pooled: Also compute the dataset level average precision
+        - matcher: How predictions are matched to the ground truth, one of MATCHERS
+        - rotated_root: Optional directory of per-character folders of the predictions of the rotated crops, or
+          their annotation table; a detector's rotated predictions are fused with its horizontal ones, as IoU.py -x does
+    """
+    if not reports_dir:
+        reports_dir = os.path.join(os.curdir, "reports")
+
+    if not os.path.isdir(reports_dir):
+        os.mkdir(reports_dir)
+
+    ## pair up the detectors found on both sides
+    predicted_folders = detectorFolders(predictions_root, folder_format)
+    if store_dir:
+        store_classes = CropStore(store_dir).class_names()
+        ground_truth_folders = {d: folder for d, folder in predicted_folders.items() if folder in store_classes}
+    else:
+        ground_truth_folders = detectorFolders(ground_truth_root, folder_format)
+    found = [d for d in sorted(predicted_folders) if d in ground_truth_folders]
+    if detectors:
+        missing = [d for d in detectors if d not in found]
+        if missing:
+            print("No ground truth or predictions for detectors: %s" % ", ".join(missing))
+        detectors = [d for d in detectors if d in found]
+    else:
+        detectors = found
+
+    ## the map listing and sizes are read once; forked workers inherit them
+    tiling_plan = TilingPlan.load(tiling_file) if tiling_file else None
+    image_filenames = listOriginalImages(original_images_dir)
+    createAnchorFilter(image_filenames, tiling_plan)
+
+    ## skip the detectors evaluated on the same inputs in a previous run
+    state = loadState(reports_dir)
+    settings = {"engine": engine, "cache_dir": cache_dir, "merge": merge, "ranking": ranking, "ap_method": ap_method, "pooled": pooled, "matcher": matcher}
+    ## the engine and the cache do not change the results
+    fingerprint_settings = {key: value for key, value in settings.items() if key not in ("engine", "cache_dir")}
+    tasks = []
+    fingerprints = {}
+    for detector in detectors:
+        folder = predicted_folders[detector]
+        ground_truth_source = store_dir or annotationsSource(ground_truth_root, folder)
+        predictions_source = annotationsSource(predictions_root, folder)
+        rotated_source = annotationsSource(rotated_root, folder) if rotated_root else None
+        if rotated_source and not is_annotation_table(rotated_source) and not os.path.isdir(rotated_source):
+            print("No rotated predictions for detector %s" % detector)
+            rotated_source = None
+        fingerprints[detector] = detectorFingerprint(ground_truth_source, predictions_source, image_filenames, tiling_file, fingerprint_settings, folder, rotated_source)
+        previous = state.get(detector)
+        if not force and previous and previous.get("fingerprint") == fingerprints[detector] and os.path.isfile(os.path.join(reports_dir, "%s_iou_report.txt" % detector)):
+            print("Detector %s unchanged, mAP=%s" % (detector, str(previous["mAP"])))
+            continue
+        tasks.append((detector, folder, original_images_dir, ground_truth_source, predictions_source, rotated_source, reports_dir, tiling_plan, store_dir, 1, settings))
+
+    ## the state is saved as every detector finishes, so an interrupted run keeps the finished ones
+    failed = []
+    def record(detector, result, error):
+        if error is None:
+            _, mAP, dataset_AP, num_images = result
+            state[detector] = {"fingerprint": fingerprints[detector], "mAP": mAP, "images": num_images}
+            if dataset_AP is not None:
+                state[detector]["dataset_AP"] = dataset_AP
+            print("Detector %s evaluated, mAP=%s" % (detector, str(mAP)))
+        else:
+            ## no fingerprint, so the next run evaluates the detector again
+            state[detector] = {"error": error}
+            failed.append((detector, error))
+            print("Detector %s failed: %s" % (detector, error))
+        saveState(reports_dir, state)
+
+    ## a single detector is evaluated with its images spread over the workers instead
+    if num_workers > 1 and len(tasks) > 1:
+        with Pool(min(num_workers, len(tasks))) as pool:
+            for detector, result, error in pool.imap_unordered(evaluateDetectorWorker, tasks):
+                record(detector, result, error)
+    else:
+        for task in tasks:
+            record(*evaluateDetectorWorker(task[:-2] + (num_workers, settings)))
+
+    generateSummaryReport(state, detectors, os.path.join(reports_dir, SUMMARY_FILENAME))
+
+    ## signal completion
+    print("IoU Calculation Complete for %d detectors (%d evaluated, %d failed)!" % (len(detectors), len(tasks) - len(failed), len(failed)))
+    for detector, error in failed:
+        print("Failed: ", detector, error)
+
+if __name__ == "__main__":
+    ## instantiate an options parser to load ground truth annotations and predictions
+    parser = OptionParser()
+    parser.add_option("-o", "--original", help="directory containing the original images in tiff format")
+    parser.add_option("-g", "--groundtruth", help="directory of per-character ground truth folders, or a ground truth annotation table")
+    parser.add_option("-p", "--predictions", help="directory of per-character prediction folders, or a predicted annotation table")
+    parser.add_option("-x", "--rotated", help="optional directory of per-character folders of the predictions of the rotated crops, or their annotation table; fused with --predictions")
+    parser.add_option("-r", "--reports", help="outfile directory to output the reports")
+    parser.add_option("-f", "--folder-format", dest="folder_format", default="char_anots_%s", help="folder name of a detector, with %s for the detector letter")
+    parser.add_option("-d", "--detectors", help="optional comma separated detectors to evaluate; defaults to all")
+    parser.add_option("-t", "--tiling", help="optional tiling plan json; only crops on its windows are evaluated")
+    parser.add_option("-s", "--store", help="optional crop store directory to read the ground truth annotations from instead of --groundtruth")
+    parser.add_option("-e", "--engine", default="numpy", choices=IOU_ENGINES, help="polygon IoU engine: numpy (batched) or shapely (one Polygon per pair)")
+    parser.add_option("-w", "--workers", type="int", default=1, help="number of processes the detectors are evaluated in")
+    parser.add_option("-k", "--cache", help="optional directory to cache the parsed ground truth annotation files in")
+    parser.add_option("-m", "--merge", help="optional merge of the duplicate predictions of overlapping crops: nms or wbf, with an optional IoU threshold, e.g. nms:0.5")
+    parser.add_option("-R", "--ranking", default="file", choices=RANKINGS, help="order the predictions take their matches in: file (as read) or score (by decreasing confidence)")
+    parser.add_option("-a", "--ap", default="mean", choices=AP_METHODS, help="average precision of a curve: mean (mean precision, the original metric) or voc (interpolated)")
+    parser.add_option("-P", "--pooled", action="store_true", default=False, help="also report the dataset level average precision over the detections of all images, ranked by score; needs scored predictions")
+    parser.add_option("-M", "--matching", default="legacy", choices=MATCHERS, help="matching of predictions to ground truth: legacy (best match only, the original metric), greedy (best unmatched) or optimal (assignment)")
+    parser.add_option("-F", "--force", action="store_true", default=False, help="evaluate every detector, even if its annotations did not change")
+
+    ## get options
+    (options, args) = parser.parse_args()
+    detectors = options.detectors.split(",") if options.detectors else None
+
+    ## run
+    driver(options.original, options.groundtruth, options.predictions, options.reports, options.folder_format, detectors, options.tiling, options.store, options.engine, options.workers, options.force, options.cache, options.merge, options.ranking, options.ap, options.pooled, options.matching, options.rotated)
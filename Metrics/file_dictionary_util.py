@@ -1,41 +1,206 @@
 import glob
+import hashlib
 import math
 import os
 import sys
 from optparse import OptionParser
 
 import numpy as np
+from PIL import Image
 from scipy.optimize import linear_sum_assignment
 
+## the crop geometry is shared with the cropping scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataWrangling", "Cropping"))
+from tiling_plan import TilingPlan
+from crop_store import CropStore
+from annotation_table import NAMES_SUFFIX, TABLE_SUFFIX, is_annotation_table, read_annotation_table, select_records, table_filename
+
+from polygon_merge import mergeDictionary, mergeDuplicates, parseMerge
+from prediction_fusion import backProjectPredictions, backProjectRecords, fusePredictions, isFusedPredictions, joinPredictions, predictionFiles, readFusedPredictions
+from iou_util import SUMMARY_KEYS
 from curve_utils import marshal_thresholded_dictionary, subplot_image, subplot_curve
-from util import (getAnnotationsFromFile, ground_truth_to_image_anchor,
-                  res_to_image_anchor)
+from util import (getAnnotationsFromFile, getAnnotationsFromRecords, getScoresFromFile,
+                  ground_truth_to_image_anchor, res_to_image_anchor)
+
+
+## original map filenames and sizes, read once per process; see listOriginalImages and createAnchorFilter
+_original_images = {}
+_image_sizes = {}
+
+def listOriginalImages(original_images_dir):
+    """
+    Lists the original TIFF images of a directory; the listing is kept, so evaluating several detectors
+    in one process globs the directory once
+    Inputs:
+        - original_images_dir: Directory containing the original images
+    Outputs:
+        - image_filenames: Filenames of the original TIFF images
+    """
+    if original_images_dir not in _original_images:
+        _original_images[original_images_dir] = glob.glob(os.path.join(original_images_dir, "*.tiff"))
+    return list(_original_images[original_images_dir])
+
+def annotationsFingerprint(annotations_path, class_name=None):
+    """
+    Fingerprints a directory of annotation files (or a crop store), or an annotation table, from the
+    names, sizes and modification times of its files; the contents are not read, except for the
+    records of class_name in a table
+    Inputs:
+        - annotations_path: Annotation directory, crop store or annotation table
+        - class_name: Optional class of a table to fingerprint, instead of the whole table
+    Outputs:
+        - fingerprint: Hex digest that changes whenever a file is added, removed or rewritten, or
+          whenever a record of class_name changes
+    """
+    if is_annotation_table(annotations_path) and class_name is not None:
+        ## only the records of the class, so editing another class of a shared table leaves it alone
+        records, map_names, class_names = read_annotation_table(annotations_path)
+        class_records = select_records(records, class_names, "class", class_name)
+        digest = hashlib.sha1(("%s\0%s\n" % (os.path.abspath(annotations_path), class_name)).encode("utf-8"))
+        digest.update("\n".join(map_names[map_id] for map_id in np.unique(class_records["map"]).tolist()).encode("utf-8"))
+        digest.update(np.ascontiguousarray(class_records).tobytes())
+        return digest.hexdigest()
+    if is_annotation_table(annotations_path):
+        filename = table_filename(annotations_path)
+        filenames = [filename, filename[:-len(TABLE_SUFFIX)] + NAMES_SUFFIX]
+    else:
+        filenames = sorted(f for f in glob.glob(os.path.join(annotations_path, "*")) if os.path.isfile(f))
+
+    digest = hashlib.sha1(os.path.abspath(annotations_path).encode("utf-8"))
+    for filename in filenames:
+        stat = os.stat(filename)
+        digest.update(("%s\0%d\0%d\n" % (os.path.basename(filename), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+    return digest.hexdigest()
+
+def createAnchorFilter(image_filenames, tiling_plan):
+    """
+    Creates a predicate which keeps only the crops that belong to a tiling plan, so that a
+    coarser tiling can be evaluated from crops which were harvested with a denser one
+    Inputs:
+        - image_filenames: Filenames of the original TIFF images
+        - tiling_plan: TilingPlan to evaluate; if None every crop is kept
+    Outputs:
+        - in_plan: Function of (image_name, anchorX, anchorY) returning whether the crop is kept
+    """
+    if tiling_plan is None:
+        return lambda image_name, anchorX, anchorY: True
+
+    ## only the TIFF header is read to get the size, once per process
+    image_sizes = {}
+    for filename in image_filenames:
+        if filename not in _image_sizes:
+            with Image.open(filename) as image:
+                _image_sizes[filename] = image.size
+        image_sizes[filename[:-5].split(os.sep)[-1]] = _image_sizes[filename]
+
+    def in_plan(image_name, anchorX, anchorY):
+        if image_name not in image_sizes:
+            return False
+        width, height = image_sizes[image_name]
+        return tiling_plan.contains_anchor(anchorX, anchorY, width, height)
+    return in_plan
+
+def groundTruthCacheKey(ground_truth_annotations_dir, image_filenames, tiling_plan=None):
+    """
+    Inputs:
+        - ground_truth_annotations_dir: Directory containing ground truth annotations
+        - image_filenames: Filenames of the original images, in listing order
+        - tiling_plan: Optional TilingPlan the ground truth is filtered with
+    Outputs:
+        - cache_key: Hex digest of the annotation files, the map listing and the tiling plan
+    """
+    digest = hashlib.sha1(annotationsFingerprint(ground_truth_annotations_dir).encode("utf-8"))
+    digest.update("\n".join(os.path.basename(f) for f in image_filenames).encode("utf-8"))
+    digest.update(repr(sorted(tiling_plan.to_dict().items()) if tiling_plan else None).encode("utf-8"))
+    return digest.hexdigest()
+
+def groundTruthCachePath(cache_dir, ground_truth_annotations_dir):
+    ## One cache file per character folder; a new key overwrites it. The folder name keeps the file
+    ## readable and the hash of the absolute path keeps folders of the same name apart
+    folder = os.path.abspath(ground_truth_annotations_dir)
+    return os.path.join(cache_dir, "%s_%s.npz" % (os.path.basename(folder), hashlib.sha1(folder.encode("utf-8")).hexdigest()[:12]))
 
+def readGroundTruthCache(cache_path, cache_key):
+    """
+    Inputs:
+        - cache_path: NPZ file written by writeGroundTruthCache
+        - cache_key: Key the cache must have been written with
+    Outputs:
+        - image_dict: Ground truth dictionary as built by createGroundTruthDictionary, or None on a miss
+    """
+    if not os.path.isfile(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        if str(cache["key"]) != cache_key:
+            return None
+        ## split the stacked boxes back into the images, keeping the dictionary order
+        boxes = np.split(cache["boxes"], np.cumsum(cache["counts"])[:-1])
+        return {str(image_name): image_boxes.tolist() for image_name, image_boxes in zip(cache["images"], boxes)}
 
-def createGroundTruthDictionary(original_images_dir, ground_truth_annotations_dir):
+def writeGroundTruthCache(cache_path, cache_key, image_dict):
+    """
+    Stores the ground truth dictionary as one stacked (N, 8) array and the box count of each image
+    Inputs:
+        - cache_path: NPZ file to write
+        - cache_key: Key of the ground truth the dictionary was built from
+        - image_dict: Ground truth dictionary as built by createGroundTruthDictionary
+    """
+    ## annotations of maps missing from the listing are nested differently, so they are not cached
+    if any(len(box) != 8 or isinstance(box[0], list) for boxes in image_dict.values() for box in boxes):
+        return
+    if not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+
+    boxes = [box for image_boxes in image_dict.values() for box in image_boxes]
+    ## write to a temporary file first so an interrupted run never leaves a truncated cache
+    temporary_path = cache_path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        np.savez(f, key=np.array(cache_key),
+                 images=np.array(list(image_dict), dtype=str),
+                 counts=np.array([len(image_boxes) for image_boxes in image_dict.values()], dtype=np.int64),
+                 boxes=np.array(boxes, dtype=np.int64).reshape(-1, 8))
+    os.replace(temporary_path, cache_path)
+
+def createGroundTruthDictionary(original_images_dir, ground_truth_annotations_dir, tiling_plan=None, cache_dir=None):
     """
     Takes all cropped annotations by specified letter, and compiles them into a dictionary. (Handles crop offsets)
     Inputs:
         - original_images_dir:  Directory containing cropped images
         - ground_truth_annotations_dir: Directory containing ground truth annotations
+        - tiling_plan: Optional TilingPlan; only the crops on its windows are used
+        - cache_dir: Optional directory the parsed ground truth is cached in; the cache is rebuilt
+          whenever an annotation file, the map listing or the tiling plan changes
     Outputs:
         - image_dict: Dictionary of format {
                 (key) image_filename: (value) [annotation filename]
             }
     """
     ## get all the original filenames
-    image_filenames = glob.glob(os.path.join(original_images_dir, "*.tiff"))
+    image_filenames = listOriginalImages(original_images_dir)
+
+    ## unchanged ground truth is read from the cache instead of parsed again
+    if cache_dir:
+        cache_path = groundTruthCachePath(cache_dir, ground_truth_annotations_dir)
+        cache_key = groundTruthCacheKey(ground_truth_annotations_dir, image_filenames, tiling_plan)
+        image_dict = readGroundTruthCache(cache_path, cache_key)
+        if image_dict is not None:
+            print("Ground truth read from cache: ", cache_path)
+            return image_dict
+
     ## get all the ground truth annotation filenames
     ground_truth_filenames = glob.glob(os.path.join(ground_truth_annotations_dir, "*.txt"))
     print("Number of ground truth files: ", len(ground_truth_filenames))
 
     ## create empty dictionary
     image_dict = {filename[:-5].split(os.sep)[-1]: [] for filename in image_filenames}
+    in_plan = createAnchorFilter(image_filenames, tiling_plan)
 
     ## iterate through ground truth annotation filenames
     for filename in ground_truth_filenames:
         ## marshal filename into components
         image_name, anchorX, anchorY = ground_truth_to_image_anchor(filename)
+        if not in_plan(image_name, anchorX, anchorY):
+            continue
         ## if the base filename is in the dictionary, add the annotations into the dictionary
         if image_name in image_dict:
             curr_list = image_dict[image_name]
@@ -44,33 +209,176 @@ def createGroundTruthDictionary(original_images_dir, ground_truth_annotations_di
             image_dict[image_name] = curr_list
         else:
             image_dict[image_name] = [getAnnotationsFromFile(os.path.join(ground_truth_annotations_dir, filename), anchorX, anchorY)]
+
+    if cache_dir:
+        writeGroundTruthCache(cache_path, cache_key, image_dict)
     return image_dict
 
-def createPredictedDictionary(original_images_dir, predicted_annotations_dir):
+def createGroundTruthDictionaryFromStore(original_images_dir, store_dir, character_folder, tiling_plan=None):
+    """
+    Same as createGroundTruthDictionary, but reads the cropped annotations of one character folder from a crop store
+    Inputs:
+        - original_images_dir:  Directory containing the original images
+        - store_dir: Directory of the crop store
+        - character_folder: Name of the character folder, e.g. char_anots_a
+        - tiling_plan: Optional TilingPlan; only the crops on its windows are used
+    Outputs:
+        - image_dict: Dictionary of format {
+                (key) image_filename: (value) [annotations]
+            }
+    """
+    ## get all the original filenames
+    image_filenames = listOriginalImages(original_images_dir)
+    store = CropStore(store_dir)
+
+    ## create empty dictionary
+    image_dict = {filename[:-5].split(os.sep)[-1]: [] for filename in image_filenames}
+    in_plan = createAnchorFilter(image_filenames, tiling_plan)
+
+    for image_name in store.maps():
+        anchors, boxes = store.class_annotations(image_name, character_folder)
+        keep = np.array([in_plan(image_name, anchorX, anchorY) for anchorX, anchorY in anchors.tolist()], dtype=bool)
+        ## offset every box by the anchor of its crop
+        image_dict[image_name] = (boxes[keep] + np.tile(anchors[keep], 4)).tolist()
+    return image_dict
+
+def createDictionaryFromTable(original_images_dir, table_name, class_name=None, tiling_plan=None, merge=None, with_scores=False):
+    """
+    Same as createGroundTruthDictionary and createPredictedDictionary, but reads the annotations from a
+    binary annotation table (see annotation_table.py) instead of parsing a directory of text files
+    Inputs:
+        - original_images_dir:  Directory containing the original images
+        - table_name: Path of the annotation table
+        - class_name: Optional character folder to select from a table holding several
+        - tiling_plan: Optional TilingPlan; only the crops on its windows are used
+        - merge: Optional merge spec (see polygon_merge.parseMerge) for the duplicate predictions of
+          overlapping crops; the score column ranks them when it is filled
+        - with_scores: Also return the score column
+    Outputs:
+        - image_dict: Dictionary of format {
+                (key) image_filename: (value) [annotations]
+            }
+        - score_dict: Only with with_scores; dictionary of {image_filename: [scores]}, NaN where unknown
+    """
+    ## get all the original filenames
+    image_filenames = listOriginalImages(original_images_dir)
+    records, map_names, class_names = read_annotation_table(table_name)
+    if class_name is not None:
+        records = select_records(records, class_names, "class", class_name)
+    print("Number of annotations in table: ", len(records))
+
+    ## create empty dictionary
+    image_dict = {filename[:-5].split(os.sep)[-1]: [] for filename in image_filenames}
+    score_dict = {image_name: [] for image_name in image_dict}
+    in_plan = createAnchorFilter(image_filenames, tiling_plan)
+
+    for map_id, image_name in enumerate(map_names):
+        map_records = records[records["map"] == map_id]
+        if tiling_plan is not None:
+            keep = np.array([in_plan(image_name, anchorX, anchorY) for anchorX, anchorY in zip(map_records["anchor_x"].tolist(), map_records["anchor_y"].tolist())], dtype=bool)
+            map_records = map_records[keep]
+        image_dict[image_name] = getAnnotationsFromRecords(map_records)
+        scores = map_records["score"].astype(np.float64)
+        if merge:
+            method, iou_threshold = parseMerge(merge)
+            image_dict[image_name], kept = mergeDuplicates(image_dict[image_name], scores, iou_threshold, method)
+            scores = scores[kept]
+        score_dict[image_name] = scores.tolist()
+
+    if with_scores:
+        return image_dict, score_dict
+    return image_dict
+
+def createFusedPredictions(original_images_dir, predicted_annotations_dir, rotated_annotations_dir=None, tiling_plan=None, merge="nms", class_name=None):
+    """
+    Back projects the predictions of the horizontal and rotated crops, and merges them into one set per map
+    Inputs:
+        - original_images_dir:  Directory containing the original images
+        - predicted_annotations_dir: Directory or annotation table containing the predicted annotations of
+          the horizontal crops
+        - rotated_annotations_dir: Optional directory or annotation table containing the predicted annotations
+          of the rotated crops
+        - tiling_plan: Optional TilingPlan; only the crops on its windows are used
+        - merge: Merge spec, see polygon_merge.parseMerge
+        - class_name: Optional character folder to select from the annotation tables
+    Outputs:
+        - fused: Dictionary of {image name: (boxes, scores)}, see prediction_fusion.fusePredictions;
+          every listed map has an entry
+    """
+    image_filenames = listOriginalImages(original_images_dir)
+    in_plan = createAnchorFilter(image_filenames, tiling_plan)
+
+    ## the horizontal predictions come first on every map, whether they are files or table records
+    image_dicts = []
+    for annotations_source, rotated in ((predicted_annotations_dir, False), (rotated_annotations_dir, True)):
+        if not annotations_source:
+            continue
+        if is_annotation_table(annotations_source):
+            image_dicts.append(backProjectRecords(annotations_source, class_name, in_plan))
+            continue
+        prediction_files = predictionFiles(annotations_source, rotated)
+        print("Number of predicted annotation files: ", len(prediction_files))
+        image_dicts.append(backProjectPredictions([prediction_file for prediction_file in prediction_files if in_plan(*prediction_file[1:4])]))
+
+    fused = {filename[:-5].split(os.sep)[-1]: (np.zeros((0, 8), dtype=np.int64), np.zeros(0)) for filename in image_filenames}
+    fused.update(fusePredictions(joinPredictions(*image_dicts), merge))
+    return fused
+
+def createPredictedDictionary(original_images_dir, predicted_annotations_dir, tiling_plan=None, merge=None, with_scores=False, rotated_annotations_dir=None, class_name=None):
     """
     Takes all cropped annotations by specified letter, and compiles them into a dictionary. (Handles crop offsets)
     Inputs:
         - original_images_dir:  Directory containing cropped images
-        - predicted_annotations_dir: Directory containing ground truth annotations
+        - predicted_annotations_dir: Directory containing ground truth annotations, an annotation table
+          (see createDictionaryFromTable), or a fused prediction file (see prediction_fusion), which is
+          used as it is
+        - tiling_plan: Optional TilingPlan; only the crops on its windows are used
+        - merge: Optional merge spec (see polygon_merge.parseMerge) for the duplicate predictions of
+          overlapping crops
+        - with_scores: Also return the confidences of the predictions, read from an optional ninth value per line
+        - rotated_annotations_dir: Optional directory or annotation table containing the predicted annotations
+          of the rotated crops; they are fused with the horizontal ones, merged with NMS unless merge says otherwise
+        - class_name: Optional character folder to select from the annotation tables
     Outputs:
         - image_dict: Dictionary of format {
                 (key) image_filename: (value) [annotations]
             }
+        - score_dict: Only with with_scores; dictionary of {image_filename: [scores]}, NaN where unknown
     """
+    ## fused predictions are already merged, one set per map
+    fused = None
+    if isFusedPredictions(predicted_annotations_dir):
+        if rotated_annotations_dir:
+            raise ValueError("%s is already fused; the rotated predictions %s can not be added to it" % (predicted_annotations_dir, rotated_annotations_dir))
+        fused = readFusedPredictions(predicted_annotations_dir)
+    elif rotated_annotations_dir:
+        fused = createFusedPredictions(original_images_dir, predicted_annotations_dir, rotated_annotations_dir, tiling_plan, merge or "nms", class_name)
+    elif is_annotation_table(predicted_annotations_dir):
+        return createDictionaryFromTable(original_images_dir, predicted_annotations_dir, class_name, tiling_plan, merge, with_scores)
+    if fused is not None:
+        image_dict = {image_name: boxes.tolist() for image_name, (boxes, _) in fused.items()}
+        if with_scores:
+            return image_dict, {image_name: scores.tolist() for image_name, (_, scores) in fused.items()}
+        return image_dict
+
     ## get all the original filenames
-    image_filenames = glob.glob(os.path.join(original_images_dir, "*.tiff"))
+    image_filenames = listOriginalImages(original_images_dir)
     ## get all the ground truth annotation filenames
     predicted_filenames = glob.glob(os.path.join(predicted_annotations_dir, "*.txt"))
     print("Number of predicted annotation files: ", len(predicted_filenames))
 
     ## create empty dictionary
     image_dict = {filename[:-5].split(os.sep)[-1]: [] for filename in image_filenames}
+    score_dict = {image_name: [] for image_name in image_dict}
+    in_plan = createAnchorFilter(image_filenames, tiling_plan)
 
     ## iterate through ground truth annotation filenames
     for filename in predicted_filenames:
         ## marshal filename into components
         # image_name, anchorX, anchorY, angle = res_to_image_anchor(filename, True)
         image_name, anchorX, anchorY = res_to_image_anchor(filename, False)
+        if not in_plan(image_name, anchorX, anchorY):
+            continue
 
         ## set angle to 0 to modify original functionality
         angle = 0
@@ -81,8 +389,16 @@ def createPredictedDictionary(original_images_dir, predicted_annotations_dir):
             ## extend the image ground truth annotation list with new annotations
             curr_list.extend(getAnnotationsFromFile(os.path.join(predicted_annotations_dir, filename), anchorX, anchorY, angle))
             image_dict[image_name] = curr_list
+            if with_scores:
+                score_dict[image_name].extend(getScoresFromFile(os.path.join(predicted_annotations_dir, filename)))
         else:
             image_dict[image_name] = [getAnnotationsFromFile(os.path.join(predicted_annotations_dir, filename), anchorX, anchorY, angle)]
+            score_dict[image_name] = [getScoresFromFile(os.path.join(predicted_annotations_dir, filename))] if with_scores else []
+
+    if merge:
+        image_dict = mergeDictionary(image_dict, merge, score_dict if with_scores else None)
+    if with_scores:
+        return image_dict, score_dict
     return image_dict
 
 
@@ -136,6 +452,39 @@ def generatePRCurves(thresholded_dictionary, detector, figures_dir):
     ## plot the curves
     subplot_image(inverted_dict, detector, figures_dir)
 
+def generateThresholdedPrecisionRecallReport(thresholds, thresholded_dictionary, detector, figures_dir, report_path):
+    """
+    Creates a text file with the precision, recall and average precision of every image at every
+    IoU threshold, and plots each image's precision against recall across the thresholds.
+
+    Inputs:
+        - thresholds: List of thresholds being considered
+        - thresholded_dictionary: Dictionary of {threshold: performance values}, as returned by
+          performPolygonIoUCalculationMultiThreshold
+        - detector: Character detector letter
+        - figures_dir: Filepath to save curves
+        - report_path: Filepath to where the report should be written
+    """
+    ## final (precision, recall) of every image at every threshold
+    summary_dictionary = {}
+    with open(report_path, "w+") as f:
+        for threshold in thresholds:
+            image_dictionary = thresholded_dictionary[threshold]
+            f.write("Considering Threshold: %.2f\n" % threshold)
+            f.write("Mean Average Precision=%s\n" % str(image_dictionary['detector_mAP']))
+            if 'dataset_AP' in image_dictionary:
+                f.write("Dataset Average Precision=%s\n" % str(image_dictionary['dataset_AP']))
+            summary_dictionary[threshold] = {}
+            for key in image_dictionary:
+                if key in SUMMARY_KEYS:
+                    continue
+                prec, mprec, rec, mrec, ap = image_dictionary[key]
+                f.write("%s (%.2f): Precision=%.5f Recall=%.5f Average Precision=%s\n" % (key, threshold, prec[-1], rec[-1], str(ap)))
+                summary_dictionary[threshold][key] = (prec[-1], rec[-1])
+
+    ## plot the curves
+    subplot_image(marshal_thresholded_dictionary(summary_dictionary), detector, figures_dir)
+
 def generatePrecisionRecallReport(calculated_iou_dictionary, detector, report_dir, report_path):
     """
     Creates a text file with the keys and values of the mean precision recall values
@@ -154,6 +503,9 @@ def generatePrecisionRecallReport(calculated_iou_dictionary, detector, report_di
 
         ## write the mean average precision value
         f.write("Mean Average Precision=%s\n" % (str(mAP)))
+        ## and the dataset level one, when the detections were pooled
+        if 'dataset_AP' in calculated_iou_dictionary:
+            f.write("Dataset Average Precision=%s\n" % str(calculated_iou_dictionary['dataset_AP']))
 
         ## write the report for each image
         for key in calculated_iou_dictionary:
@@ -164,7 +516,7 @@ def generatePrecisionRecallReport(calculated_iou_dictionary, detector, report_di
             ## mrec is the monotonically increasing recall values
             ## ap is the average precision
 
-            if key == 'detector_mAP':
+            if key in SUMMARY_KEYS:
                 continue
 
             ## unpack the values
@@ -2,6 +2,24 @@ from __future__ import division
 import numpy as np
 from shapely.geometry import Polygon
 import statistics
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from polygon_iou import bestMatchesFromPairs, quadIoUPairs
+from matching import MATCHERS, greedyMatches, groundTruthKeys, optimalMatches
+
+## engines which compute the IoU of the predicted and ground truth polygons
+IOU_ENGINES = ["shapely", "numpy"]
+
+## orders the predictions of an image are matched in: as read from the files, or by decreasing score
+RANKINGS = ["file", "score"]
+
+## average precision of a curve: the mean precision over the predictions (the original metric),
+## or the all-point interpolated VOC average precision
+AP_METHODS = ["mean", "voc"]
+
+## keys of a result dictionary which are not images
+SUMMARY_KEYS = ["detector_mAP", "dataset_AP"]
 
 
 def performIoUCalculation(ground_truth_annotation_dictionary, predicted_annotation_dictionary):
@@ -78,118 +96,389 @@ def performIoUCalculation(ground_truth_annotation_dictionary, predicted_annotati
     return Image_IoU
 
 
-def performPolygonIoUCalculationThresholded(ground_truth_annotation_dictionary, predicted_annotation_dictionary, threshold):
+def performPolygonIoUCalculationThresholded(ground_truth_annotation_dictionary, predicted_annotation_dictionary, threshold, engine="shapely", num_workers=1):
     """
     Wrapper function for performPolygonIoUCalculation with a specified threshold
     """
-    return performPolygonIoUCalculation(ground_truth_annotation_dictionary, predicted_annotation_dictionary, threshold=threshold)
+    return performPolygonIoUCalculation(ground_truth_annotation_dictionary, predicted_annotation_dictionary, threshold=threshold, engine=engine, num_workers=num_workers)
 
-def performPolygonIoUCalculation(ground_truth_annotation_dictionary, predicted_annotation_dictionary, threshold=0.5):
+def bestGroundTruthMatches(gt, predicted, engine="shapely"):
+    """
+    Finds the ground truth annotation with the largest IoU for every predicted annotation; on ties the last one wins
+    Inputs:
+        - gt: List of 8 point ground truth annotations
+        - predicted: List of 8 point predicted annotations
+        - engine: "shapely" builds a Polygon per pair; "numpy" indexes the ground truth spatially and only
+          computes the IoU of overlapping pairs, in batches (see polygon_iou.py)
+    Outputs:
+        - gt_matches: Index into gt of the best match of every prediction
+        - iou_maxes: IoU of every prediction with its best match
+    """
+    if engine == "numpy":
+        i, j, iou = quadIoUPairs(predicted, gt)
+        gt_matches, iou_maxes = bestMatchesFromPairs(i, j, iou, len(predicted), len(gt))
+        return gt_matches.tolist(), iou_maxes.tolist()
+    if engine != "shapely":
+        raise ValueError("Unknown IoU engine: %s" % engine)
+
+    gt_matches = []
+    iou_maxes = []
+    for predictedAnnotation in predicted:
+        
+        ## keep track of largest intersection; so as to not double count
+        iou_max = -1
+        gt_match = -1
+
+        for j, groundTruthAnnotation in enumerate(gt):
+            
+            groundTruthPolygon = Polygon(groundTruthInidicies(groundTruthAnnotation))
+            predictedPolygon = Polygon(predictedIndicies(predictedAnnotation))
+
+            curr_iou = polygonIOU(groundTruthPolygon, predictedPolygon)
+
+            if curr_iou >= iou_max:
+                ## update largest intersection over union value
+                iou_max = curr_iou
+                ## keep track of the max
+                gt_match = j
+
+        gt_matches.append(gt_match)
+        iou_maxes.append(iou_max)
+    return gt_matches, iou_maxes
+
+def groundTruthIoUPairs(gt, predicted, engine="shapely"):
+    """
+    Calculates the IoU of the overlapping (predicted, ground truth) pairs
+    Inputs:
+        - gt: List of 8 point ground truth annotations
+        - predicted: List of 8 point predicted annotations
+        - engine: One of IOU_ENGINES, see bestGroundTruthMatches
+    Outputs:
+        - i, j, iou: Sparse IoU, as returned by polygon_iou.quadIoUPairs
+    """
+    if engine == "numpy":
+        return quadIoUPairs(predicted, gt)
+    if engine != "shapely":
+        raise ValueError("Unknown IoU engine: %s" % engine)
+
+    iou = np.zeros((len(predicted), len(gt)))
+    for i, predictedAnnotation in enumerate(predicted):
+        predictedPolygon = Polygon(predictedIndicies(predictedAnnotation))
+        for j, groundTruthAnnotation in enumerate(gt):
+            iou[i, j] = polygonIOU(Polygon(groundTruthInidicies(groundTruthAnnotation)), predictedPolygon)
+    i, j = np.nonzero(iou)
+    return i, j, iou[i, j]
+
+def matchKeys(gt, gt_matches):
+    """
+    Identifies the matched ground truth annotation of every prediction; equal annotations share an id,
+    as they share a key in the set of used matches
+    Inputs:
+        - gt: List of 8 point ground truth annotations
+        - gt_matches: Index into gt of the best match of every prediction
+    Outputs:
+        - keys: Int array with the id of every prediction's match
+    """
+    return groundTruthKeys(gt)[np.asarray(gt_matches, dtype=np.int64)]
+
+def rankPredictions(scores, ranking="file"):
+    """
+    Inputs:
+        - scores: Float array of the confidences of an image's predictions; NaN means unknown
+        - ranking: One of RANKINGS
+    Outputs:
+        - order: Int array of the prediction indices in matching order; ties and unknown scores keep
+          the file order, unknown scores last
+    """
+    if ranking == "file":
+        return np.arange(len(scores))
+    if ranking != "score":
+        raise ValueError("Unknown ranking: %s" % ranking)
+    return np.argsort(np.where(np.isnan(scores), np.inf, -scores), kind="stable")
+
+def truePositives(match_keys, iou_maxes, threshold):
+    """
+    Inputs:
+        - match_keys: Id of every prediction's best match, from matchKeys, in matching order
+        - iou_maxes: IoU of every prediction with its best match, in matching order
+        - threshold: IoU a prediction needs with its best match to count as a detection
+    Outputs:
+        - true_positives: Int array with 1 for every prediction whose best match clears the threshold
+          and was not taken by an earlier prediction
+    """
+    above = np.flatnonzero(np.asarray(iou_maxes) >= threshold)
+    ## the first prediction above the threshold to reach a match takes it
+    _, first = np.unique(match_keys[above], return_index=True)
+    true_positives = np.zeros(len(match_keys), dtype=np.int64)
+    true_positives[above[first]] = 1
+    return true_positives
+
+def precisionRecallCurve(true_positives, num_gt):
+    """
+    Inputs:
+        - true_positives: Int array of true positive flags, in matching order
+        - num_gt: Number of ground truth annotations
+    Outputs:
+        - rec, prec: Float arrays of the recall and precision after every prediction
+    """
+    true_positive_counts = np.cumsum(true_positives)
+    false_positive_counts = np.cumsum(1 - true_positives)
+    rec = true_positive_counts / float(num_gt)
+    prec = true_positive_counts / (false_positive_counts + true_positive_counts).astype(np.float64)
+    return rec, prec
+
+def vocAveragePrecision(rec, prec):
+    """
+    Vectorized voc_ap: all-point interpolated average precision
+    Inputs:
+        - rec, prec: Recall and precision after every prediction
+    Outputs:
+        - ap: Area under the interpolated curve
+        - mrec, mpre: Recall and monotonically decreasing precision, padded as in voc_ap
+    """
+    mrec = np.concatenate(([0.0], rec, [1.0]))
+    mpre = np.concatenate(([0.0], prec, [0.0]))
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+    changes = np.flatnonzero(mrec[1:] != mrec[:-1]) + 1
+    ap = float(np.sum((mrec[changes] - mrec[changes - 1]) * mpre[changes]))
+    return ap, mrec, mpre
+
+def averagePrecision(rec, prec, ap_method="mean"):
+    """
+    Inputs:
+        - rec, prec: Float arrays of the recall and precision after every prediction
+        - ap_method: One of AP_METHODS
+    Outputs:
+        - ap, mrec, mpre: Average precision, and the interpolated curve of vocAveragePrecision
+    """
+    ap, mrec, mpre = vocAveragePrecision(rec, prec)
+    if ap_method == "mean":
+        ap = statistics.mean(prec.tolist())
+    elif ap_method != "voc":
+        raise ValueError("Unknown average precision method: %s" % ap_method)
+    return ap, mrec, mpre
+
+def precisionRecallFromTruePositives(true_positives, num_gt, ap_method="mean"):
     """
-    Takes ground truth annotations and predicted annotations to create a dictionary of IoU scores
+    Inputs:
+        - true_positives: Int array of true positive flags, in matching order
+        - num_gt: Number of ground truth annotations of the image
+        - ap_method: One of AP_METHODS
+    Outputs:
+        - (prec, mprec, rec, mrec, ap): Precision and recall after every prediction, their VOC
+          interpolations, and the average precision
+    """
+    num_true_positives = int(np.sum(true_positives))
+
+    print("Number True Positives: ", num_true_positives)
+    print("Number False Postiives: ", len(true_positives) - num_true_positives)
+    print("Number False Negatives: ", num_gt - num_true_positives)
+
+    rec, prec = precisionRecallCurve(true_positives, num_gt)
+    ap, mrec, mprec = averagePrecision(rec, prec, ap_method)
+
+    return (prec.tolist(), mprec.tolist(), rec.tolist(), mrec.tolist(), ap)
+
+def precisionRecallAtThreshold(num_gt, match_keys, iou_maxes, threshold, ap_method="mean"):
+    """
+    Scores the best matches of an image's predictions at one IoU threshold; in matching order, a
+    prediction is a true positive when its best match clears the threshold and was not used before
+    Inputs:
+        - num_gt: Number of ground truth annotations of the image
+        - match_keys: Id of every prediction's best match, from matchKeys
+        - iou_maxes: IoU of every prediction with its best match
+        - threshold: IoU a prediction needs with its best match to count as a detection
+        - ap_method: One of AP_METHODS
+    Outputs:
+        - (prec, mprec, rec, mrec, ap): Precision and recall after every prediction, their VOC
+          interpolations, and the average precision
+    """
+    return precisionRecallFromTruePositives(truePositives(match_keys, iou_maxes, threshold), num_gt, ap_method)
+
+def matchedTruePositives(gt, predicted, order, thresholds, engine="shapely", matcher="legacy"):
+    """
+    Inputs:
+        - gt: List of 8 point ground truth annotations
+        - predicted: List of 8 point predicted annotations
+        - order: Int array of the prediction indices in matching order, from rankPredictions
+        - thresholds: IoU thresholds
+        - engine: One of IOU_ENGINES
+        - matcher: One of MATCHERS, see matching.py
+    Outputs:
+        - true_positives: Dictionary of {threshold: int array of true positive flags, in matching order}
+    """
+    if len(gt) == 0:
+        ## without ground truth every prediction is a false positive, whichever the matcher
+        return {threshold: np.zeros(len(predicted), dtype=np.int64) for threshold in thresholds}
+    if matcher == "legacy":
+        ## the best matches do not depend on the order, only which prediction takes a match first does
+        gt_matches, iou_maxes = bestGroundTruthMatches(gt, predicted, engine)
+        match_keys = matchKeys(gt, gt_matches)[order]
+        iou_maxes = np.asarray(iou_maxes)[order]
+        return {threshold: truePositives(match_keys, iou_maxes, threshold) for threshold in thresholds}
+
+    i, j, iou = groundTruthIoUPairs(gt, predicted, engine)
+    true_positives = {}
+    for threshold in thresholds:
+        if matcher == "greedy":
+            matched = greedyMatches(i, j, iou, order, threshold, len(predicted))
+        elif matcher == "optimal":
+            matched = optimalMatches(i, j, iou, threshold, len(predicted), len(gt))
+        else:
+            raise ValueError("Unknown matcher: %s" % matcher)
+        true_positives[threshold] = (matched[order] >= 0).astype(np.int64)
+    return true_positives
+
+def evaluateImage(arguments):
+    """
+    Scores one image at every threshold; a top level function so it can run in a worker process
+    Inputs:
+        - arguments: (gt, predicted, scores, thresholds, engine, ranking, ap_method, pooled, matcher)
+    Outputs:
+        - results: Dictionary of {threshold: (prec, mprec, rec, mrec, ap)}
+        - pooled_detections: Only when pooled, (ranked scores, {threshold: true positive flags}) for
+          the dataset level average precision, matched in score order whatever the ranking; otherwise None
+    """
+    gt, predicted, scores, thresholds, engine, ranking, ap_method, pooled, matcher = arguments
+    scores = np.asarray(scores, dtype=np.float64) if scores is not None else np.full(len(predicted), np.nan)
+    order = rankPredictions(scores, ranking)
+    true_positives = matchedTruePositives(gt, predicted, order, thresholds, engine, matcher)
+
+    results = {threshold: precisionRecallFromTruePositives(true_positives[threshold], len(gt), ap_method) for threshold in thresholds}
+    if not pooled:
+        return results, None
+    ## the pooled detections are ranked by score, so they take their matches in that order as well
+    if ranking != "score":
+        order = rankPredictions(scores, "score")
+        true_positives = matchedTruePositives(gt, predicted, order, thresholds, engine, matcher)
+    return results, (scores[order], true_positives)
+
+def datasetAveragePrecision(pooled_detections, num_gt, threshold, ap_method="mean"):
+    """
+    Pools the detections of every image into one ranking by decreasing score, so the average
+    precision is computed once over the dataset instead of averaged over images. The ranking does
+    not depend on the ranking the matches were made in, nor on the order of the images.
+    Inputs:
+        - pooled_detections: List of the pooled_detections of evaluateImage, in image order
+        - num_gt: Number of ground truth annotations of every image
+        - threshold: IoU threshold the true positive flags were computed at
+        - ap_method: One of AP_METHODS
+    Outputs:
+        - ap: Dataset level average precision; detections with no score are ranked last
+    """
+    if not pooled_detections or num_gt == 0:
+        return 0.0
+    scores = np.concatenate([scores for scores, _ in pooled_detections])
+    if len(scores) and np.isnan(scores).all():
+        raise ValueError("The dataset average precision ranks the detections by score, and no prediction has a score")
+    true_positives = np.concatenate([flags[threshold] for _, flags in pooled_detections])
+    true_positives = true_positives[rankPredictions(scores, "score")]
+    rec, prec = precisionRecallCurve(true_positives, num_gt)
+    return averagePrecision(rec, prec, ap_method)[0]
+
+def performPolygonIoUCalculationMultiThreshold(ground_truth_annotation_dictionary, predicted_annotation_dictionary, thresholds, engine="shapely", num_workers=1, predicted_score_dictionary=None, ranking="file", ap_method="mean", pooled=False, matcher="legacy"):
+    """
+    Same as performPolygonIoUCalculation for several thresholds at once. The best match of every
+    prediction does not depend on the threshold, so the polygon IoUs are computed once per image
+    and only the scoring is repeated per threshold.
     Inputs:
         - ground_truth_annotation_dictionary: Dictionary of images and associated ground truth annotations
         - predicted_annotation_dictionary: Dictionary of images and predicted annotations
+        - thresholds: List of IoU thresholds, e.g. np.arange(0.5, 1.0, 0.05)
+        - engine: IoU engine, one of IOU_ENGINES
+        - num_workers: Number of processes the images are evaluated in; the results are reduced in
+          image order, so they do not depend on it
+        - predicted_score_dictionary: Optional dictionary of images and the confidences of their predictions
+        - ranking: Order the predictions take their matches in, one of RANKINGS
+        - ap_method: Average precision of a curve, one of AP_METHODS
+        - pooled: Also compute the dataset level average precision, 'dataset_AP', over the
+          detections of all images ranked together
+        - matcher: How predictions are matched to the ground truth, one of MATCHERS
     Outputs:
-        - Image_IoU: Dictionary of images and calculated mean IoU values; additional field 'detector_mAP'
+        - thresholded_dictionary: Dictionary of {threshold: Image_IoU}, each Image_IoU as returned by performPolygonIoUCalculation
     """
-    Image_IoU = {}
+    ## a repeated threshold is only scored once
+    thresholds = list(OrderedDict.fromkeys(thresholds))
+    thresholded_dictionary = {threshold: {} for threshold in thresholds}
 
-    sum_AP = 0.0
+    sum_AP = {threshold: 0.0 for threshold in thresholds}
 
+    ## collect the images to evaluate
+    image_keys = []
+    tasks = []
     for ground_truth_key in ground_truth_annotation_dictionary:
         
         print("Reading Image:", ground_truth_key)
 
+        ## an image without predictions is skipped, never scored with the previous image's annotations
+        gt, predicted, scores = ground_truth_annotation_dictionary[ground_truth_key], [], None
+
         ## safety check to make sure that key is in the dictionary
         if ground_truth_key in predicted_annotation_dictionary:
             ## load gt annotations for image
             gt = ground_truth_annotation_dictionary[ground_truth_key]
             ## load predicted annotations for image
             predicted = predicted_annotation_dictionary[ground_truth_key]
+            if predicted_score_dictionary is not None:
+                scores = predicted_score_dictionary[ground_truth_key]
 
         print("Total Ground Truth Annotations", len(gt))
         print("Total Predicted Annotations", len(predicted))
 
         if len(gt) == 0 or len(predicted) == 0:
             continue
-        
-        # iou = np.zeros((len(gt), len(predicted)))
-        
-        ## instantiate arrays for record keeping
-        true_positives = [0] * len(predicted)
-        false_positives = [0] * len(predicted)
-
-        used = set()
-
-        for i, predictedAnnotation in enumerate(predicted):
-            
-            ## keep track of largest intersection; so as to not double count
-            iou_max = -1
-            gt_match = -1
-
-            for j, groundTruthAnnotation in enumerate(gt):
-                
-                groundTruthPolygon = Polygon(groundTruthInidicies(groundTruthAnnotation))
-                predictedPolygon = Polygon(predictedIndicies(predictedAnnotation))
-
-                curr_iou = polygonIOU(groundTruthPolygon, predictedPolygon)
-
-                if curr_iou >= iou_max:
-                    ## update largest intersection over union value
-                    iou_max = curr_iou
-                    ## keep track of the max
-                    gt_match = groundTruthAnnotation
-
-            if iou_max >= threshold:
-                if str(gt_match) not in used:
-                    ## this is a good detection
-                    true_positives[i] = 1
-                    used.add(str(gt_match))
-                else:
-                    ## this match has already been used
-                    false_positives[i] = 1
-            else:
-                ## insufficient over lap of match
-                false_positives[i] = 1
-
-        ## compute precision and recall
-        cumsum = 0
-        for idx, val in enumerate(false_positives):
-            false_positives[idx] += cumsum
-            cumsum += val
-
-        cumsum = 0
-        for idx, val in enumerate(true_positives):
-            true_positives[idx] += cumsum
-            cumsum += val
-        
-        print("Number True Positives: ", true_positives[-1])
-        print("Number False Postiives: ", false_positives[-1])
-        print("Number False Negatives: ", len(gt) - len(used))
-        
-        
-        rec = true_positives[:]
-        for idx, val in enumerate(true_positives):
-            rec[idx] = float(true_positives[idx]) / len(gt)
-        #print(rec)
-        prec = true_positives[:]
-        for idx, val in enumerate(true_positives):
-            prec[idx] = float(true_positives[idx]) / (false_positives[idx] + true_positives[idx])
-        
-        ap, mrec, mprec = voc_ap(rec[:], prec[:])
 
-        ap = statistics.mean(prec)
-
-        sum_AP += ap
-
-        ## set dictionary value
-        Image_IoU[ground_truth_key] = (prec, mprec, rec, mrec, ap)
+        image_keys.append(ground_truth_key)
+        tasks.append((gt, predicted, scores, thresholds, engine, ranking, ap_method, pooled, matcher))
+
+    if num_workers > 1 and len(tasks) > 1:
+        pool = Pool(min(num_workers, len(tasks)))
+        try:
+            image_results = pool.map(evaluateImage, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        image_results = [evaluateImage(task) for task in tasks]
+
+    for ground_truth_key, (results, _) in zip(image_keys, image_results):
+        for threshold in thresholds:
+            sum_AP[threshold] += results[threshold][-1]
+            ## set dictionary value
+            thresholded_dictionary[threshold][ground_truth_key] = results[threshold]
 
     ## calculate mean average precision over images
-    Image_IoU['detector_mAP'] = sum_AP / len(ground_truth_annotation_dictionary)
-
-    return Image_IoU
+    for threshold in thresholds:
+        thresholded_dictionary[threshold]['detector_mAP'] = sum_AP[threshold] / len(ground_truth_annotation_dictionary)
+
+    ## every ground truth annotation counts, including those of the images without predictions
+    if pooled:
+        num_gt = sum(len(gt) for gt in ground_truth_annotation_dictionary.values())
+        pooled_detections = [detections for _, detections in image_results]
+        if pooled_detections and all(np.isnan(scores).all() for scores, _ in pooled_detections):
+            print("Warning: no prediction has a score, so the dataset average precision is not reported")
+        else:
+            for threshold in thresholds:
+                thresholded_dictionary[threshold]['dataset_AP'] = datasetAveragePrecision(pooled_detections, num_gt, threshold, ap_method)
+
+    return thresholded_dictionary
+
+def performPolygonIoUCalculation(ground_truth_annotation_dictionary, predicted_annotation_dictionary, threshold=0.5, engine="shapely", num_workers=1, predicted_score_dictionary=None, ranking="file", ap_method="mean", pooled=False, matcher="legacy"):
+    """
+    Takes ground truth annotations and predicted annotations to create a dictionary of IoU scores
+    Inputs:
+        - ground_truth_annotation_dictionary: Dictionary of images and associated ground truth annotations
+        - predicted_annotation_dictionary: Dictionary of images and predicted annotations
+        - threshold: IoU a prediction needs with its best match to count as a detection
+        - engine: IoU engine, one of IOU_ENGINES
+        - num_workers: Number of processes the images are evaluated in
+        - predicted_score_dictionary, ranking, ap_method, pooled, matcher: See performPolygonIoUCalculationMultiThreshold
+    Outputs:
+        - Image_IoU: Dictionary of images and calculated mean IoU values; additional field 'detector_mAP',
+          and 'dataset_AP' when pooled
+    """
+    return performPolygonIoUCalculationMultiThreshold(ground_truth_annotation_dictionary, predicted_annotation_dictionary, [threshold], engine, num_workers,
+                                                      predicted_score_dictionary, ranking, ap_method, pooled, matcher)[threshold]
     
 
 def pointsPairs(points):
@@ -0,0 +1,110 @@
+"""
+    One-to-one matching of an image's predictions to its ground truth annotations, from the sparse
+    IoU of polygon_iou.quadIoUPairs. Matches are tracked by integer index.
+
+    Matchers:
+        - "legacy": every prediction only ever tries its best ground truth annotation, and is a false
+          positive when an earlier prediction already took it (the original metric)
+        - "greedy": in ranking order, every prediction takes the unmatched ground truth annotation it
+          overlaps most, as in the VOC / COCO evaluations
+        - "optimal": the most matches (then the largest total IoU) over all assignments, solved with
+          linear_sum_assignment on every connected component of the IoU graph on its own, so the
+          problems stay small with thousands of boxes
+"""
+from __future__ import division
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+MATCHERS = ["legacy", "greedy", "optimal"]
+
+
+def groundTruthKeys(gt):
+    """
+    Inputs:
+        - gt: List of 8 point ground truth annotations
+    Outputs:
+        - keys: Int array with an id per annotation; equal annotations share an id, so they share a
+          match in the legacy matcher
+    """
+    if len(gt) == 0:
+        return np.zeros(0, dtype=np.int64)
+    _, keys = np.unique(np.asarray(gt, dtype=np.float64).reshape(len(gt), -1), axis=0, return_inverse=True)
+    return keys.reshape(-1).astype(np.int64)
+
+def eligiblePairs(i, j, iou, threshold):
+    ## Pairs which may be matched: overlapping, with an IoU which clears the threshold
+    eligible = (iou >= threshold) & (iou > 0)
+    return i[eligible], j[eligible], iou[eligible]
+
+def greedyMatches(i, j, iou, order, threshold, num_predicted):
+    """
+    Inputs:
+        - i, j, iou: Sparse IoU of the predictions with the ground truth, as returned by quadIoUPairs
+        - order: Int array of the prediction indices in ranking order
+        - threshold: IoU a match needs
+        - num_predicted: Number of predictions
+    Outputs:
+        - matched: Int array with the ground truth index matched to every prediction, or -1
+    """
+    i, j, iou = eligiblePairs(i, j, iou, threshold)
+    matched = np.full(num_predicted, -1, dtype=np.int64)
+    if len(i) == 0:
+        return matched
+
+    ## candidates of every prediction, best first (the lowest index on ties)
+    by_prediction = np.lexsort((j, -iou, i))
+    candidates = j[by_prediction]
+    starts = np.searchsorted(i[by_prediction], np.arange(num_predicted + 1))
+
+    used = set()
+    for k in order:
+        for candidate in candidates[starts[k]:starts[k + 1]].tolist():
+            if candidate not in used:
+                used.add(candidate)
+                matched[k] = candidate
+                break
+    return matched
+
+def optimalMatches(i, j, iou, threshold, num_predicted, num_gt):
+    """
+    Inputs:
+        - i, j, iou: Sparse IoU of the predictions with the ground truth, as returned by quadIoUPairs
+        - threshold: IoU a match needs
+        - num_predicted: Number of predictions
+        - num_gt: Number of ground truth annotations
+    Outputs:
+        - matched: Int array with the ground truth index matched to every prediction, or -1
+    """
+    i, j, iou = eligiblePairs(i, j, iou, threshold)
+    matched = np.full(num_predicted, -1, dtype=np.int64)
+    if len(i) == 0:
+        return matched
+
+    ## connected components of the bipartite graph; predictions are nodes 0..P-1, ground truth P..P+G-1
+    graph = coo_matrix((np.ones(len(i)), (i, num_predicted + j)), shape=(num_predicted + num_gt,) * 2)
+    _, labels = connected_components(graph, directed=False)
+    component = labels[i]
+
+    ## a component with a single pair needs no assignment
+    sizes = np.bincount(component)
+    single = sizes[component] == 1
+    matched[i[single]] = j[single]
+
+    ## the rest are solved one component at a time; every match is worth more than the IoU of all the
+    ## matches a component can hold together, so the most matches win and the IoU only breaks ties
+    pairs = np.flatnonzero(~single)
+    pairs = pairs[np.argsort(component[pairs], kind="stable")]
+    bounds = np.flatnonzero(np.diff(component[pairs])) + 1
+    for group in np.split(pairs, bounds):
+        if len(group) == 0:
+            continue
+        rows, row_index = np.unique(i[group], return_inverse=True)
+        columns, column_index = np.unique(j[group], return_inverse=True)
+        weights = np.zeros((len(rows), len(columns)))
+        weights[row_index, column_index] = (min(len(rows), len(columns)) + 1) + iou[group]
+        row_assignment, column_assignment = linear_sum_assignment(weights, maximize=True)
+        assigned = weights[row_assignment, column_assignment] > 0
+        matched[rows[row_assignment[assigned]]] = columns[column_assignment[assigned]]
+    return matched
@@ -0,0 +1,256 @@
+"""
+    Batched IoU of quadrilateral annotations. The ground truth boxes of an image are indexed on a
+    uniform grid so every prediction is only scored against the boxes it can overlap, and those
+    pairs are clipped at once with a Sutherland-Hodgman pass vectorized over pairs, instead of
+    building two shapely Polygons for every (predicted, ground truth) pair.
+    Quadrilaterals which are not convex (or are degenerate) can not be clipped this way; the
+    pairs which involve one are handed to shapely so the results still match polygonIOU.
+"""
+from __future__ import division
+import numpy as np
+from shapely.geometry import Polygon
+
+## the vertex orders used by predictedIndicies and groundTruthInidicies in iou_util
+PREDICTED_ORDER = [0, 1, 6, 7, 4, 5, 2, 3]
+GROUND_TRUTH_ORDER = [0, 1, 2, 3, 4, 5, 6, 7]
+
+## a convex quadrilateral clipped by another one has at most 8 vertices
+MAX_VERTICES = 8
+
+
+def toQuadrilaterals(annotations, order):
+    """
+    Marshals 8 point annotations into an array of quadrilaterals
+    Inputs:
+        - annotations: List of 8 point annotations
+        - order: Order in which the 8 values are read as (x, y) vertices
+    Outputs:
+        - quads: Float array of shape (N, 4, 2)
+    """
+    annotations = np.asarray(annotations, dtype=np.float64).reshape(-1, 8)
+    return annotations[:, order].reshape(-1, 4, 2)
+
+def signedArea(polygons):
+    """
+    Shoelace area of polygons; positive for counterclockwise vertices (in x-right, y-up axes)
+    Inputs:
+        - polygons: Float array of shape (N, K, 2); a polygon with fewer than K vertices
+          repeats its first vertex in the remaining slots
+    Outputs:
+        - areas: Float array of shape (N,)
+    """
+    x = polygons[..., 0]
+    y = polygons[..., 1]
+    return 0.5 * np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)
+
+def isConvex(quads):
+    """
+    Inputs:
+        - quads: Float array of shape (N, 4, 2)
+    Outputs:
+        - convex: Bool array of shape (N,); True for convex quadrilaterals with a non-zero area
+    """
+    edges = np.roll(quads, -1, axis=1) - quads
+    turns = edges[:, :, 0] * np.roll(edges, -1, axis=1)[:, :, 1] - edges[:, :, 1] * np.roll(edges, -1, axis=1)[:, :, 0]
+    ## collinear corners are fine, but every proper turn has to go the same way
+    return (np.all(turns >= 0, axis=1) | np.all(turns <= 0, axis=1)) & (signedArea(quads) != 0)
+
+def counterclockwise(quads):
+    ## Same quadrilaterals, with the vertices reversed where needed so every signed area is positive
+    reverse = signedArea(quads) < 0
+    quads = quads.copy()
+    quads[reverse] = quads[reverse][:, ::-1]
+    return quads
+
+def clipConvexPairs(subjects, clips):
+    """
+    Sutherland-Hodgman clipping of each subject by its clip polygon, vectorized over pairs
+    Inputs:
+        - subjects: Float array of shape (M, 4, 2) of convex quadrilaterals
+        - clips: Float array of shape (M, 4, 2) of counterclockwise convex quadrilaterals
+    Outputs:
+        - areas: Float array of shape (M,) of the area of each intersection
+    """
+    M = len(subjects)
+    rows = np.arange(M)[:, None]
+    slots = np.arange(MAX_VERTICES)[None, :]
+    polygon = np.zeros((M, MAX_VERTICES, 2))
+    polygon[:, :4] = subjects
+    counts = np.full(M, 4)
+
+    for edge in range(4):
+        A = clips[:, edge][:, None, :]
+        B = clips[:, (edge + 1) % 4][:, None, :]
+        direction = B - A
+        valid = slots < counts[:, None]
+        ## each vertex paired with the previous one, wrapping at the polygon's own count
+        previous = np.where(slots == 0, counts[:, None] - 1, slots - 1)
+        previous = np.where(valid, previous, 0)
+        current_points = polygon
+        previous_points = polygon[rows, previous]
+
+        side_current = direction[..., 0] * (current_points[..., 1] - A[..., 1]) - direction[..., 1] * (current_points[..., 0] - A[..., 0])
+        side_previous = direction[..., 0] * (previous_points[..., 1] - A[..., 1]) - direction[..., 1] * (previous_points[..., 0] - A[..., 0])
+        inside_current = side_current >= 0
+        inside_previous = side_previous >= 0
+
+        ## the crossing of the edge previous -> current with the clip line
+        denominator = side_previous - side_current
+        t = np.divide(side_previous, denominator, out=np.zeros_like(denominator), where=denominator != 0)
+        crossing = previous_points + t[..., None] * (current_points - previous_points)
+
+        ## every vertex emits [crossing, current]: the crossing when the edge changes side, the
+        ## current vertex when it is inside
+        emit_crossing = valid & (inside_current != inside_previous)
+        emit_current = valid & inside_current
+        candidates = np.stack([crossing, current_points], axis=2).reshape(M, 2 * MAX_VERTICES, 2)
+        emitted = np.stack([emit_crossing, emit_current], axis=2).reshape(M, 2 * MAX_VERTICES)
+
+        ## compact the emitted vertices to the front, keeping their order
+        order = np.argsort(~emitted, axis=1, kind="stable")[:, :MAX_VERTICES]
+        polygon = candidates[rows, order]
+        counts = np.minimum(np.sum(emitted, axis=1), MAX_VERTICES)
+
+    ## pad with the first vertex so the shoelace sum closes each polygon at its own count
+    polygon = np.where((slots < counts[:, None])[..., None], polygon, polygon[:, :1])
+    return np.where(counts >= 3, np.abs(signedArea(polygon)), 0.0)
+
+def gridCells(box_min, box_max, cell_size, origin):
+    """
+    Expands boxes into the uniform grid cells they cover
+    Inputs:
+        - box_min, box_max: Float arrays of shape (N, 2) of the box corners
+        - cell_size: Side of a grid cell
+        - origin: (x, y) of the corner of cell (0, 0)
+    Outputs:
+        - cells: Int array of the (column, row) of every covered cell, shape (K, 2)
+        - box_ids: Int array of shape (K,) of the box covering each cell
+    """
+    first = np.floor((box_min - origin) / cell_size).astype(np.int64)
+    last = np.floor((box_max - origin) / cell_size).astype(np.int64)
+    spans = last - first + 1
+    counts = spans[:, 0] * spans[:, 1]
+    box_ids = np.repeat(np.arange(len(box_min)), counts)
+    ## position of each cell within its box's block of cells
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    columns = first[box_ids, 0] + offsets % spans[box_ids, 0]
+    rows = first[box_ids, 1] + offsets // spans[box_ids, 0]
+    return np.stack([columns, rows], axis=1), box_ids
+
+def candidatePairs(predicted_min, predicted_max, gt_min, gt_max, cell_size=None):
+    """
+    Spatial index of the ground truth boxes on a uniform grid; returns the (prediction, ground truth)
+    pairs whose bounding boxes intersect, without comparing every prediction with every ground truth box
+    Inputs:
+        - predicted_min, predicted_max: Float arrays of shape (P, 2) of the predicted bounding boxes
+        - gt_min, gt_max: Float arrays of shape (G, 2) of the ground truth bounding boxes
+        - cell_size: Side of a grid cell; defaults to twice the median box side, so a box covers a few cells
+    Outputs:
+        - i, j: Int arrays of the candidate pairs, sorted by prediction then ground truth
+    """
+    if len(predicted_min) == 0 or len(gt_min) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if cell_size is None:
+        sides = np.concatenate([(predicted_max - predicted_min).max(axis=1), (gt_max - gt_min).max(axis=1)])
+        cell_size = max(2.0 * float(np.median(sides)), 1.0)
+    origin = np.minimum(predicted_min.min(axis=0), gt_min.min(axis=0))
+
+    gt_cells, gt_ids = gridCells(gt_min, gt_max, cell_size, origin)
+    predicted_cells, predicted_ids = gridCells(predicted_min, predicted_max, cell_size, origin)
+    width = max(gt_cells[:, 0].max(), predicted_cells[:, 0].max()) + 1
+    gt_keys = gt_cells[:, 1] * width + gt_cells[:, 0]
+    predicted_keys = predicted_cells[:, 1] * width + predicted_cells[:, 0]
+
+    ## join the cells of the predictions with the ground truth boxes in the same cell
+    order = np.argsort(gt_keys, kind="stable")
+    gt_keys, gt_ids = gt_keys[order], gt_ids[order]
+    lo = np.searchsorted(gt_keys, predicted_keys, side="left")
+    hi = np.searchsorted(gt_keys, predicted_keys, side="right")
+    counts = hi - lo
+    i = np.repeat(predicted_ids, counts)
+    j = gt_ids[np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())]
+
+    ## boxes sharing several cells are joined once per shared cell
+    pairs = np.unique(i * len(gt_min) + j)
+    i, j = pairs // len(gt_min), pairs % len(gt_min)
+    overlapping = np.all(predicted_min[i] <= gt_max[j], axis=1) & np.all(gt_min[j] <= predicted_max[i], axis=1)
+    return i[overlapping], j[overlapping]
+
+def quadIoUPairs(predicted, gt, max_pairs=1 << 18):
+    """
+    Calculates the IoU of the (predicted, ground truth) pairs whose bounding boxes intersect; every
+    other pair has an IoU of 0
+    Inputs:
+        - predicted: List of 8 point predicted annotations
+        - gt: List of 8 point ground truth annotations
+        - max_pairs: Number of pairs clipped at once; bounds the memory used
+    Outputs:
+        - i, j, iou: Sparse (COO) IoU; iou[k] matches
+          polygonIOU(Polygon(groundTruthInidicies(gt[j[k]])), Polygon(predictedIndicies(predicted[i[k]])))
+    """
+    predicted_quads = toQuadrilaterals(predicted, PREDICTED_ORDER)
+    gt_quads = toQuadrilaterals(gt, GROUND_TRUTH_ORDER)
+    i, j = candidatePairs(predicted_quads.min(axis=1), predicted_quads.max(axis=1), gt_quads.min(axis=1), gt_quads.max(axis=1))
+    iou = np.zeros(len(i))
+    if len(i) == 0:
+        return i, j, iou
+
+    predicted_ccw = counterclockwise(predicted_quads)
+    gt_ccw = counterclockwise(gt_quads)
+    predicted_area = np.abs(signedArea(predicted_quads))
+    gt_area = np.abs(signedArea(gt_quads))
+    convex = isConvex(predicted_quads)[i] & isConvex(gt_quads)[j]
+
+    clipped = np.flatnonzero(convex)
+    for start in range(0, len(clipped), max_pairs):
+        k = clipped[start:start + max_pairs]
+        intersection = clipConvexPairs(predicted_ccw[i[k]], gt_ccw[j[k]])
+        iou[k] = intersection / (predicted_area[i[k]] + gt_area[j[k]] - intersection)
+
+    ## shapely handles the pairs which can not be clipped, as polygonIOU would
+    ## (including raising on an empty union)
+    for k in np.flatnonzero(~convex):
+        groundTruthPolygon = Polygon(gt_quads[j[k]])
+        predictedPolygon = Polygon(predicted_quads[i[k]])
+        iou[k] = groundTruthPolygon.intersection(predictedPolygon).area / groundTruthPolygon.union(predictedPolygon).area
+    return i, j, iou
+
+def quadIoUMatrix(predicted, gt, max_pairs=1 << 18):
+    """
+    Calculates the IoU of every predicted annotation with every ground truth annotation
+    Inputs:
+        - predicted: List of 8 point predicted annotations
+        - gt: List of 8 point ground truth annotations
+        - max_pairs: Number of pairs clipped at once; bounds the memory used
+    Outputs:
+        - iou: Float array of shape (len(predicted), len(gt)); the dense form of quadIoUPairs
+    """
+    iou = np.zeros((len(predicted), len(gt)))
+    i, j, values = quadIoUPairs(predicted, gt, max_pairs)
+    iou[i, j] = values
+    return iou
+
+def bestMatchesFromPairs(i, j, iou, num_predicted, num_gt):
+    """
+    Picks the best ground truth match of every prediction from a sparse IoU, with the tie rule of
+    the pairwise loop: the last ground truth annotation with the largest IoU wins, so a prediction
+    which overlaps nothing is matched to the last ground truth annotation with an IoU of 0
+    Inputs:
+        - i, j, iou: Sparse IoU, as returned by quadIoUPairs
+        - num_predicted: Number of predictions
+        - num_gt: Number of ground truth annotations
+    Outputs:
+        - gt_matches: Int array of shape (num_predicted,)
+        - iou_maxes: Float array of shape (num_predicted,)
+    """
+    gt_matches = np.full(num_predicted, num_gt - 1, dtype=np.int64)
+    iou_maxes = np.zeros(num_predicted)
+    positive = iou > 0
+    i, j, iou = i[positive], j[positive], iou[positive]
+    if len(i) > 0:
+        ## the last entry of each prediction, ordered by IoU then ground truth index, is its match
+        order = np.lexsort((j, iou, i))
+        last = order[np.append(i[order][1:] != i[order][:-1], True)]
+        gt_matches[i[last]] = j[last]
+        iou_maxes[i[last]] = iou[last]
+    return gt_matches, iou_maxes
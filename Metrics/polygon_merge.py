@@ -0,0 +1,119 @@
+"""
+    Merges the duplicate predictions of a map. The crops overlap (512 windows with a 200 step), so
+    once the crop predictions are stitched back onto the map the same character is found by up
+    to 6-9 crops. Duplicates are found with the batched quadrilateral IoU of polygon_iou and are
+    either suppressed (polygon NMS) or averaged into one box (weighted box fusion).
+"""
+from __future__ import division
+import numpy as np
+
+from polygon_iou import quadIoUPairs
+
+MERGE_METHODS = ["nms", "wbf"]
+
+## IoU above which two predictions are taken as the same character, unless the merge spec says otherwise
+DEFAULT_MERGE_THRESHOLD = 0.5
+
+
+def parseMerge(merge):
+    """
+    Inputs:
+        - merge: Merge spec, "<method>" or "<method>:<iou threshold>", e.g. "nms" or "wbf:0.6"
+    Outputs:
+        - method: One of MERGE_METHODS
+        - iou_threshold: IoU above which predictions are merged
+    """
+    method, _, iou_threshold = merge.partition(":")
+    if method not in MERGE_METHODS:
+        raise ValueError("Unknown merge method %s, expected one of %s" % (method, ", ".join(MERGE_METHODS)))
+    return method, float(iou_threshold) if iou_threshold else DEFAULT_MERGE_THRESHOLD
+
+def duplicatePairs(annotations, iou_threshold):
+    """
+    Inputs:
+        - annotations: List of 8 point annotations of one map
+        - iou_threshold: IoU above which two annotations are duplicates
+    Outputs:
+        - i, j: Int arrays of the duplicate pairs, both ways round; no annotation is paired with itself
+    """
+    i, j, iou = quadIoUPairs(annotations, annotations)
+    duplicate = (i != j) & (iou >= iou_threshold)
+    return i[duplicate], j[duplicate]
+
+def mergeDuplicates(annotations, scores=None, iou_threshold=DEFAULT_MERGE_THRESHOLD, method="nms"):
+    """
+    Greedily merges duplicate annotations: the best ranked annotation left takes every annotation
+    left which duplicates it. Annotations are ranked by score, or by their number of duplicates when
+    the scores are not all known (the text predictions carry none), ties going to the first.
+    Inputs:
+        - annotations: List of 8 point annotations of one map
+        - scores: Optional confidences of the annotations; NaN means unknown
+        - iou_threshold: IoU above which two annotations are duplicates
+        - method: "nms" keeps the best ranked annotation of each group, "wbf" replaces the group by
+          the score weighted mean of its vertices
+    Outputs:
+        - merged: List of the merged 8 point annotations, in the original order of their best ranked annotation
+        - kept: Int array of the index of the best ranked annotation of each merged one
+    """
+    num_annotations = len(annotations)
+    if num_annotations == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    i, j = duplicatePairs(annotations, iou_threshold)
+
+    ## rank by score, then by number of duplicates, then by position
+    support = np.bincount(i, minlength=num_annotations)
+    known = scores is not None and np.all(np.isfinite(scores))
+    weights = np.asarray(scores, dtype=np.float64) if known else np.ones(num_annotations)
+    order = np.lexsort((np.arange(num_annotations), -support, -weights))
+
+    ## duplicates of each annotation, as slices of the pairs sorted by i
+    by_i = np.argsort(i, kind="stable")
+    neighbours = j[by_i]
+    starts = np.searchsorted(i[by_i], np.arange(num_annotations + 1))
+
+    group = np.full(num_annotations, -1, dtype=np.int64)
+    for k in order:
+        if group[k] >= 0:
+            continue
+        group[k] = k
+        duplicates = neighbours[starts[k]:starts[k + 1]]
+        group[duplicates[group[duplicates] < 0]] = k
+
+    kept = np.flatnonzero(group == np.arange(num_annotations))
+    if method == "nms":
+        return [annotations[k] for k in kept], kept
+
+    ## weighted box fusion; the vertices of a group are averaged in place, so the predictions must share a vertex order
+    boxes = np.asarray(annotations, dtype=np.float64).reshape(-1, 8)
+    fused = np.zeros((num_annotations, 8))
+    total = np.zeros(num_annotations)
+    np.add.at(fused, group, boxes * weights[:, None])
+    np.add.at(total, group, weights)
+    ## int() of the fused points, as for the annotation files
+    return np.trunc(fused[kept] / total[kept, None]).astype(int).tolist(), kept
+
+def mergeDictionary(image_dict, merge, score_dict=None):
+    """
+    Merges the duplicate annotations of every image of a stitched dictionary
+    Inputs:
+        - image_dict: Dictionary of {image name: [annotations]}, as built by createPredictedDictionary
+        - merge: Merge spec, see parseMerge
+        - score_dict: Optional dictionary of {image name: [scores]}; ranks the duplicates and is
+          reduced to the scores of the kept annotations in place
+    Outputs:
+        - image_dict: Dictionary of {image name: [merged annotations]}
+    """
+    method, iou_threshold = parseMerge(merge)
+    before = after = 0
+    for image_name, annotations in image_dict.items():
+        ## annotations of maps missing from the listing are nested differently and left as they are
+        if any(len(box) != 8 or isinstance(box[0], list) for box in annotations):
+            continue
+        scores = np.asarray(score_dict[image_name], dtype=np.float64) if score_dict is not None else None
+        image_dict[image_name], kept = mergeDuplicates(annotations, scores, iou_threshold, method)
+        if score_dict is not None:
+            score_dict[image_name] = scores[kept].tolist()
+        before += len(annotations)
+        after += len(image_dict[image_name])
+    print("Predictions merged (%s, IoU >= %.2f): %d -> %d" % (method, iou_threshold, before, after))
+    return image_dict
@@ -0,0 +1,211 @@
+"""
+    Fuses the predictions on the horizontal crops and on every rotated view of them into one
+    deduplicated set per map. The rotated predictions are projected back onto the map with the
+    batched rotation of util.rotateAnnotationsBatch, and all predictions of a map are merged with
+    polygon NMS (polygon_merge), so evaluation and rendering both read the same single set.
+    A fused set is kept as one (N, 8) box array and one score array per map, and can be saved
+    as a <name>.fused.npz file which IoU.py, PR_Curves.py and the stitching read directly.
+"""
+from __future__ import division
+import glob
+import os
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+## predictions may also be kept in a binary annotation table
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataWrangling", "Cropping"))
+from annotation_table import is_annotation_table, read_annotation_table, select_records
+
+from polygon_merge import mergeDuplicates, parseMerge
+from util import getAnnotationsFromRecords, getScoresFromFile, res_to_image_anchor, rotateAnnotationsBatch
+
+FUSED_SUFFIX = ".fused.npz"
+
+
+def predictionFiles(predicted_annotations_dir, rotated=False):
+    """
+    Inputs:
+        - predicted_annotations_dir: Directory containing predicted annotation files
+        - rotated: Whether the files are predictions on rotated crops, with the angle in their name
+    Outputs:
+        - prediction_files: List of (filename, image_name, anchorX, anchorY, angle) of every file
+    """
+    prediction_files = []
+    for filename in glob.glob(os.path.join(predicted_annotations_dir, "*.txt")):
+        if rotated:
+            image_name, anchorX, anchorY, angle = res_to_image_anchor(filename, True)
+        else:
+            (image_name, anchorX, anchorY), angle = res_to_image_anchor(filename, False), 0
+        prediction_files.append((filename, image_name, anchorX, anchorY, angle))
+    return prediction_files
+
+def readPredictionFile(filename):
+    """
+    Inputs:
+        - filename: Full filename of a predicted annotation file
+    Outputs:
+        - boxes: Float array (N, 8) of the predictions, in crop coordinates
+        - scores: Float array (N,) of their confidences; NaN where unknown
+    """
+    with open(filename) as f:
+        lines = f.read().split("\n")[:-1]
+    boxes = np.array([[float(x.strip()) for x in line.split(",")[:8]] for line in lines]).reshape(-1, 8)
+    return boxes, np.array(getScoresFromFile(filename), dtype=np.float64)
+
+def backProjectPredictions(prediction_files):
+    """
+    Projects the predictions of horizontal and rotated crops onto their maps, all in one batch
+    Inputs:
+        - prediction_files: List of (filename, image_name, anchorX, anchorY, angle), see predictionFiles
+    Outputs:
+        - image_dict: Dictionary of {image name: (boxes, scores)}; boxes is an int array (N, 8) in map
+          coordinates, the values of getAnnotationsFromFile, in the order of the files
+    """
+    boxes, scores, image_index, anchors, angles = [], [], [], [], []
+    ## index of every map, in the order of its first file
+    image_ids = {}
+    for filename, image_name, anchorX, anchorY, angle in prediction_files:
+        file_boxes, file_scores = readPredictionFile(filename)
+        image_id = image_ids.setdefault(image_name, len(image_ids))
+        boxes.append(file_boxes)
+        scores.append(file_scores)
+        image_index.append(np.full(len(file_boxes), image_id))
+        anchors.append(np.tile([anchorX, anchorY], (len(file_boxes), 1)))
+        angles.append(np.full(len(file_boxes), angle, dtype=np.float64))
+    if not image_ids:
+        return {}
+
+    ## an angle of 0 is an exact identity rotation, so the horizontal crops go through the same batch
+    projected = rotateAnnotationsBatch(np.concatenate(boxes), np.concatenate(anchors), np.concatenate(angles))
+    scores = np.concatenate(scores)
+    image_index = np.concatenate(image_index)
+
+    order = np.argsort(image_index, kind="stable")
+    bounds = np.searchsorted(image_index[order], np.arange(1, len(image_ids)))
+    return {image_name: (projected[rows], scores[rows]) for image_name, rows in zip(image_ids, np.split(order, bounds))}
+
+def backProjectRecords(table_name, class_name=None, in_plan=None):
+    """
+    Same as backProjectPredictions, for an annotation table; every record is rotated back by its angle column
+    Inputs:
+        - table_name: Annotation table of predictions
+        - class_name: Optional class to keep; all records are kept if None
+        - in_plan: Optional function of (image_name, anchorX, anchorY) returning whether the records of a
+          crop are kept, see file_dictionary_util.createAnchorFilter
+    Outputs:
+        - image_dict: Dictionary of {image name: (boxes, scores)} of the maps with records
+    """
+    records, map_names, class_names = read_annotation_table(table_name)
+    if class_name is not None:
+        records = select_records(records, class_names, "class", class_name)
+    image_dict = {}
+    for map_id, image_name in enumerate(map_names):
+        map_records = records[records["map"] == map_id]
+        if in_plan is not None:
+            keep = np.array([in_plan(image_name, anchorX, anchorY) for anchorX, anchorY in zip(map_records["anchor_x"].tolist(), map_records["anchor_y"].tolist())], dtype=bool)
+            map_records = map_records[keep]
+        if len(map_records):
+            image_dict[image_name] = (np.array(getAnnotationsFromRecords(map_records), dtype=np.int64).reshape(-1, 8), map_records["score"].astype(np.float64))
+    return image_dict
+
+def backProjectSource(predictions_source, rotated=False):
+    """
+    Inputs:
+        - predictions_source: Directory of predicted annotation files, or an annotation table of predictions
+        - rotated: Whether the files are predictions on rotated crops; tables carry the angle of every record
+    Outputs:
+        - image_dict: Dictionary of {image name: (boxes, scores)}, see backProjectPredictions
+    """
+    if is_annotation_table(predictions_source):
+        return backProjectRecords(predictions_source)
+    return backProjectPredictions(predictionFiles(predictions_source, rotated))
+
+def joinPredictions(*image_dicts):
+    """
+    Inputs:
+        - image_dicts: Dictionaries of {image name: (boxes, scores)}
+    Outputs:
+        - image_dict: Dictionary of {image name: (boxes, scores)} with the predictions of every dictionary, in order
+    """
+    joined = {}
+    for image_dict in image_dicts:
+        for image_name, (boxes, scores) in image_dict.items():
+            if image_name in joined:
+                joined[image_name] = (np.concatenate([joined[image_name][0], boxes]), np.concatenate([joined[image_name][1], scores]))
+            else:
+                joined[image_name] = (boxes, scores)
+    return joined
+
+def fusePredictions(image_dict, merge="nms"):
+    """
+    Merges the duplicates among the back projected predictions of every map
+    Inputs:
+        - image_dict: Dictionary of {image name: (boxes, scores)}, see backProjectPredictions
+        - merge: Merge spec, see polygon_merge.parseMerge
+    Outputs:
+        - fused: Dictionary of {image name: (boxes, scores)} of the merged predictions
+    """
+    method, iou_threshold = parseMerge(merge)
+    fused = {}
+    before = after = 0
+    for image_name, (boxes, scores) in image_dict.items():
+        merged, kept = mergeDuplicates(boxes, scores, iou_threshold, method)
+        fused[image_name] = (np.array(merged, dtype=np.int64).reshape(-1, 8), scores[kept])
+        before += len(boxes)
+        after += len(kept)
+    print("Predictions fused (%s, IoU >= %.2f): %d -> %d" % (method, iou_threshold, before, after))
+    return fused
+
+def isFusedPredictions(path):
+    ## Whether path is a fused prediction file written by writeFusedPredictions
+    return path.endswith(FUSED_SUFFIX) and os.path.isfile(path)
+
+def writeFusedPredictions(path, fused):
+    """
+    Stores the fused predictions as one stacked (N, 8) box array, the scores and the box count of each map
+    Inputs:
+        - path: File to write; should end with FUSED_SUFFIX
+        - fused: Dictionary of {image name: (boxes, scores)}, see fusePredictions
+    """
+    ## write to a temporary file first so an interrupted run never leaves a truncated file
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        np.savez(f, images=np.array(list(fused), dtype=str),
+                 counts=np.array([len(boxes) for boxes, _ in fused.values()], dtype=np.int64),
+                 boxes=np.concatenate([boxes for boxes, _ in fused.values()] + [np.zeros((0, 8), dtype=np.int64)]),
+                 scores=np.concatenate([scores for _, scores in fused.values()] + [np.zeros(0)]))
+    os.replace(temporary_path, path)
+
+def readFusedPredictions(path):
+    """
+    Inputs:
+        - path: File written by writeFusedPredictions
+    Outputs:
+        - fused: Dictionary of {image name: (boxes, scores)}, in the order it was written
+    """
+    with np.load(path) as f:
+        splits = np.cumsum(f["counts"])[:-1]
+        return {str(image_name): (boxes, scores) for image_name, boxes, scores in zip(f["images"], np.split(f["boxes"], splits), np.split(f["scores"], splits))}
+
+
+if __name__ == "__main__":
+    ## the dictionaries import this module, so they are only needed when it is run as a script
+    from file_dictionary_util import TilingPlan, createFusedPredictions
+
+    parser = OptionParser()
+    parser.add_option("-o", "--original", help="directory containing the original images in tiff format")
+    parser.add_option("-p", "--predictions", help="directory containing the predicted annotation files of the horizontal crops")
+    parser.add_option("-x", "--rotated", help="directory containing the predicted annotation files of the rotated crops")
+    parser.add_option("-t", "--tiling", help="optional tiling plan json; only crops on its windows are fused")
+    parser.add_option("-m", "--merge", default="nms", help="merge of the duplicate predictions: nms or wbf, with an optional IoU threshold, e.g. nms:0.5")
+    parser.add_option("-f", "--fused", help="file to write the fused predictions to, ending with %s" % FUSED_SUFFIX)
+    (options, args) = parser.parse_args()
+
+    if not options.fused.endswith(FUSED_SUFFIX):
+        parser.error("--fused must end with %s" % FUSED_SUFFIX)
+    tiling_plan = TilingPlan.load(options.tiling) if options.tiling else None
+    fused = createFusedPredictions(options.original, options.predictions, options.rotated, tiling_plan, options.merge)
+    writeFusedPredictions(options.fused, fused)
+    print("Fused predictions of %d maps saved to %s" % (len(fused), options.fused))
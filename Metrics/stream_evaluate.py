@@ -0,0 +1,322 @@
+"""
+    The purpose of this file is to evaluate a detector while inference is still writing its
+    predictions. The predictions directory is watched (with inotify when inotify_simple is
+    installed, by polling otherwise), every new res_cropped_image_*.txt file is matched against
+    the ground truth of its map as it lands, and the running precision / recall of every map is
+    kept up to date in <detector>_stream_report.txt. Once the stream ends the usual
+    <detector>_iou_report.txt is written; the predictions of a map are scored in the order they
+    arrived, so on a finished directory (--once) the report is the one IoU.py writes.
+"""
+
+import glob
+import os
+import re
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+from file_dictionary_util import (TilingPlan, createAnchorFilter, createDictionaryFromTable,
+                                  createGroundTruthDictionary, createGroundTruthDictionaryFromStore,
+                                  generatePrecisionRecallReport, is_annotation_table, listOriginalImages)
+from iou_util import (AP_METHODS, IOU_ENGINES, averagePrecision, bestGroundTruthMatches, matchKeys,
+                      precisionRecallCurve)
+from util import getAnnotationsFromFile
+
+## inotify wakes the watcher as soon as a prediction file is closed; without it the directory is polled
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class StreamingEvaluator(object):
+    """
+        Match state of every map: which ground truth annotations were taken, and the true positive
+        flags of the predictions ingested so far, in arrival order
+    """
+
+    def __init__(self, ground_truth_annotation_dictionary, threshold=0.5, engine="numpy"):
+        """
+            Inputs:
+                - ground_truth_annotation_dictionary: Dictionary of images and associated ground truth annotations
+                - threshold: IoU a prediction needs with its best match to count as a detection
+                - engine: IoU engine, one of IOU_ENGINES
+        """
+        self.ground_truth_annotation_dictionary = ground_truth_annotation_dictionary
+        self.threshold = threshold
+        self.engine = engine
+        self._keys = {}
+        self._used = {}
+        self._flags = {}
+        self._sum_precision = {}
+        for image_name, gt in ground_truth_annotation_dictionary.items():
+            ## maps without ground truth are not evaluated, as in performPolygonIoUCalculation
+            if len(gt) == 0:
+                continue
+            ## equal ground truth annotations share a match, as they share a key in the batch evaluation
+            self._keys[image_name] = matchKeys(gt, range(len(gt)))
+            self._used[image_name] = np.zeros(self._keys[image_name].max() + 1, dtype=bool)
+            self._flags[image_name] = []
+            self._sum_precision[image_name] = 0.0
+
+    def ingest(self, image_name, predicted):
+        """
+            Matches new predictions of a map, after every prediction of the map ingested before
+            Inputs:
+                - image_name: Map of the predictions
+                - predicted: List of 8 point predicted annotations, in arrival order
+            Outputs:
+                - num_ingested: Number of predictions scored; those of maps without ground truth are dropped
+        """
+        if image_name not in self._keys or len(predicted) == 0:
+            return 0
+        gt_matches, iou_maxes = bestGroundTruthMatches(self.ground_truth_annotation_dictionary[image_name], predicted, self.engine)
+        keys = self._keys[image_name][np.asarray(gt_matches)]
+        used = self._used[image_name]
+
+        ## the first new prediction above the threshold to reach a match nobody took yet takes it
+        candidates = np.flatnonzero((np.asarray(iou_maxes) >= self.threshold) & ~used[keys])
+        _, first = np.unique(keys[candidates], return_index=True)
+        true_positives = np.zeros(len(keys), dtype=np.int64)
+        true_positives[candidates[first]] = 1
+        used[keys[candidates[first]]] = True
+
+        ## running sum of the precision after every prediction, for the mean precision
+        previous_true_positives, previous_count = self.counts(image_name)[:2]
+        counts = previous_count + np.arange(1, len(keys) + 1)
+        self._sum_precision[image_name] += float(np.sum((previous_true_positives + np.cumsum(true_positives)) / counts.astype(np.float64)))
+        self._flags[image_name].append(true_positives)
+        return len(keys)
+
+    def counts(self, image_name):
+        """
+            Outputs:
+                - true_positives, num_predictions, num_gt of a map so far
+        """
+        flags = self._flags[image_name]
+        return sum(int(np.sum(f)) for f in flags), sum(len(f) for f in flags), len(self.ground_truth_annotation_dictionary[image_name])
+
+    def summary(self):
+        """
+            Outputs:
+                - summary: Dictionary of {image name: (true positives, false positives, false negatives,
+                  precision, recall, mean precision)} of the maps with predictions so far
+        """
+        summary = {}
+        for image_name in self._flags:
+            true_positives, num_predictions, num_gt = self.counts(image_name)
+            if num_predictions == 0:
+                continue
+            summary[image_name] = (true_positives, num_predictions - true_positives, num_gt - true_positives,
+                                   true_positives / float(num_predictions), true_positives / float(num_gt),
+                                   self._sum_precision[image_name] / num_predictions)
+        return summary
+
+    def result(self, ap_method="mean"):
+        """
+            Outputs:
+                - Image_IoU: Dictionary as returned by performPolygonIoUCalculation, over the predictions ingested so far
+        """
+        Image_IoU = {}
+        sum_AP = 0.0
+        for image_name, flags in self._flags.items():
+            if not flags:
+                continue
+            rec, prec = precisionRecallCurve(np.concatenate(flags), len(self.ground_truth_annotation_dictionary[image_name]))
+            ap, mrec, mprec = averagePrecision(rec, prec, ap_method)
+            Image_IoU[image_name] = (prec.tolist(), mprec.tolist(), rec.tolist(), mrec.tolist(), ap)
+            sum_AP += ap
+        Image_IoU['detector_mAP'] = sum_AP / len(self.ground_truth_annotation_dictionary)
+        return Image_IoU
+
+
+def watchPredictionFiles(predictions_dir, poll_interval=5.0, idle_timeout=None, once=False):
+    """
+    Yields the prediction files of a directory as they are completed. A file is complete once it is
+    closed after writing (inotify), or once its size and modification time did not change between
+    two polls.
+    Inputs:
+        - predictions_dir: Directory the predictions are written to
+        - poll_interval: Seconds between two looks at the directory
+        - idle_timeout: Optional number of seconds without a new file after which the watch ends
+        - once: Take the files present now as complete and end the watch
+    Outputs:
+        - filenames: Lists of new complete prediction files, in glob order
+    """
+    seen = set()
+    pending = {}
+    closed = set()
+    notifier = None
+    if INotify is not None and not once:
+        notifier = INotify()
+        notifier.add_watch(predictions_dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+    last_new = time.time()
+
+    while True:
+        ready = []
+        for filename in glob.glob(os.path.join(predictions_dir, "*.txt")):
+            if filename in seen:
+                continue
+            stat = os.stat(filename)
+            current = (stat.st_size, stat.st_mtime_ns)
+            if once or filename in closed or pending.get(filename) == current:
+                ready.append(filename)
+                seen.add(filename)
+                pending.pop(filename, None)
+            else:
+                pending[filename] = current
+
+        if ready:
+            last_new = time.time()
+            yield ready
+        if once:
+            return
+        if idle_timeout is not None and not pending and time.time() - last_new >= idle_timeout:
+            return
+
+        if notifier is not None:
+            for event in notifier.read(timeout=int(poll_interval * 1000)):
+                closed.add(os.path.join(predictions_dir, event.name))
+        else:
+            time.sleep(poll_interval)
+
+def horizontalPredictionAnchor(filename, image_names):
+    """
+    Inputs:
+        - filename: Prediction file of the watched directory
+        - image_names: Names of the maps being evaluated
+    Outputs:
+        - (image_name, anchorX, anchorY) of the predictions of a horizontal crop, or None for the
+          predictions of a rotated view (res_cropped_image_<map>_<x>_<y>_<angle>.txt), which are only
+          evaluated fused with the horizontal ones (IoU.py -x), and for the files of other maps
+    """
+    ## the name of a rotated view with a positive angle also parses as a horizontal crop, of a map
+    ## named <map>_<x>, so only the names of known maps are taken
+    match = re.match(r"res_cropped_image_(.*)_(\d+)_(\d+)\.txt$", filename.split(os.sep)[-1])
+    if match is None or match.group(1) not in image_names:
+        return None
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+def generateStreamingReport(evaluator, num_files, report_path, num_skipped=0):
+    """
+    Creates a text file with the running counts of every map and of all maps
+
+    Inputs:
+        - evaluator: StreamingEvaluator
+        - num_files: Number of prediction files ingested so far
+        - report_path: Filepath to where the report should be written
+        - num_skipped: Number of prediction files of rotated views or other maps skipped so far
+    """
+    summary = evaluator.summary()
+    totals = np.sum([values[:3] for values in summary.values()], axis=0) if summary else np.zeros(3, dtype=np.int64)
+    true_positives, false_positives, false_negatives = [int(x) for x in totals]
+    with open(report_path, "w+") as f:
+        f.write("Prediction files ingested=%d\n" % num_files)
+        if num_skipped:
+            f.write("Prediction files skipped (rotated views or other maps)=%d\n" % num_skipped)
+        f.write("True Positives=%d False Positives=%d False Negatives=%d\n" % (true_positives, false_positives, false_negatives))
+        if true_positives + false_positives:
+            f.write("Precision=%.5f Recall=%.5f\n" % (true_positives / float(true_positives + false_positives),
+                                                      true_positives / float(true_positives + false_negatives)))
+        for image_name, (tp, fp, fn, precision, recall, mean_precision) in summary.items():
+            f.write("%s: TP=%d FP=%d FN=%d Precision=%.5f Recall=%.5f Average Precision=%s\n" % (image_name, tp, fp, fn, precision, recall, str(mean_precision)))
+
+def driver(detector, original_images_dir, ground_truth_directory, predictions_directory, reports_dir, tiling_plan=None, store_dir=None, character_folder=None, engine="numpy", cache_dir=None,
+           threshold=0.5, ap_method="mean", poll_interval=5.0, idle_timeout=None, once=False):
+    """
+    Run the streaming IoU metric for specified character detector
+
+    Inputs:
+        - detector: Letter of the detector to be evaluated
+        - ground_truth_directory: Directory containing the ground truth annotations for the specified letter
+        - predictions_directory: Directory the predicted annotations for the specified letter are written to
+        - tiling_plan: Optional TilingPlan; only the crops on its windows are evaluated
+        - store_dir: Optional crop store to read the ground truth annotations from, instead of ground_truth_directory
+        - character_folder: Character folder of the detector in the crop store or annotation table
+        - engine: Polygon IoU engine
+        - cache_dir: Optional directory to cache the parsed ground truth annotation files in
+        - threshold: IoU a prediction needs with its best match to count as a detection
+        - ap_method: Average precision of the final report, one of AP_METHODS
+        - poll_interval: Seconds between two looks at the predictions directory
+        - idle_timeout: Optional number of seconds without a new prediction file after which the evaluation ends
+        - once: Evaluate the prediction files present now and end
+    """
+    ## the ground truth is read once, the same way as IoU.py
+    if store_dir:
+        ground_truth_annotation_dictionary = createGroundTruthDictionaryFromStore(original_images_dir, store_dir, character_folder or "char_anots_%s" % detector, tiling_plan)
+    elif is_annotation_table(ground_truth_directory):
+        ground_truth_annotation_dictionary = createDictionaryFromTable(original_images_dir, ground_truth_directory, character_folder, tiling_plan)
+    else:
+        ground_truth_annotation_dictionary = createGroundTruthDictionary(original_images_dir, ground_truth_directory, tiling_plan, cache_dir)
+    in_plan = createAnchorFilter(listOriginalImages(original_images_dir), tiling_plan)
+
+    if not reports_dir:
+        reports_dir = os.path.join(os.curdir, "reports")
+
+    if not os.path.isdir(reports_dir):
+        os.mkdir(reports_dir)
+
+    evaluator = StreamingEvaluator(ground_truth_annotation_dictionary, threshold, engine)
+    stream_report_filepath = os.path.join(reports_dir, "%s_stream_report.txt" % detector)
+    print("Watching predictions in %s (%s)" % (predictions_directory, "polling" if INotify is None or once else "inotify"))
+
+    image_names = set(ground_truth_annotation_dictionary)
+    num_files = num_skipped = 0
+    try:
+        for filenames in watchPredictionFiles(predictions_directory, poll_interval, idle_timeout, once):
+            ## group the new crops by map, keeping their order
+            new_predictions = {}
+            batch_skipped = 0
+            for filename in filenames:
+                anchor = horizontalPredictionAnchor(filename, image_names)
+                if anchor is None:
+                    batch_skipped += 1
+                    continue
+                image_name, anchorX, anchorY = anchor
+                if not in_plan(image_name, anchorX, anchorY):
+                    continue
+                new_predictions.setdefault(image_name, []).extend(getAnnotationsFromFile(filename, anchorX, anchorY, 0))
+            num_predictions = sum(evaluator.ingest(image_name, predicted) for image_name, predicted in new_predictions.items())
+
+            num_files += len(filenames) - batch_skipped
+            num_skipped += batch_skipped
+            generateStreamingReport(evaluator, num_files, stream_report_filepath, num_skipped)
+            print("Ingested %d prediction files (%d predictions), %d so far, %d skipped" % (len(filenames) - batch_skipped, num_predictions, num_files, num_skipped))
+    except KeyboardInterrupt:
+        ## stopping the watch by hand still writes the final report of what was ingested
+        print("Watch interrupted")
+
+    ## the final report, as written by IoU.py
+    report_filepath = os.path.join(reports_dir, "%s_iou_report.txt" % detector)
+    generatePrecisionRecallReport(evaluator.result(ap_method), detector, reports_dir, report_filepath)
+
+    ## signal completion
+    print("Streaming IoU Calculation Complete!")
+
+if __name__ == "__main__":
+    ## instantiate an options parser to load ground truth annotations and watch predictions
+    parser = OptionParser()
+    parser.add_option("-d", "--detector", help="specify which character detector is being evaluated")
+    parser.add_option("-o", "--original", help="directory containing the original images in tiff format")
+    parser.add_option("-g", "--groundtruth", help="directory containing ground truth annotation files, or a ground truth annotation table")
+    parser.add_option("-p", "--predictions", help="directory the predicted annotation files are written to")
+    parser.add_option("-r", "--reports", help="outfile directory to output the reports")
+    parser.add_option("-t", "--tiling", help="optional tiling plan json; only crops on its windows are evaluated")
+    parser.add_option("-s", "--store", help="optional crop store directory to read the ground truth annotations from instead of --groundtruth")
+    parser.add_option("-e", "--engine", default="numpy", choices=IOU_ENGINES, help="polygon IoU engine: numpy (batched) or shapely (one Polygon per pair)")
+    parser.add_option("-c", "--character", help="character folder of the detector in the crop store or annotation tables; defaults to char_anots_<detector> for the store")
+    parser.add_option("-k", "--cache", help="optional directory to cache the parsed ground truth annotation files in")
+    parser.add_option("-T", "--threshold", type="float", default=0.5, help="IoU a prediction needs with its best match to count as a detection")
+    parser.add_option("-a", "--ap", default="mean", choices=AP_METHODS, help="average precision of the final report: mean (mean precision, the original metric) or voc (interpolated)")
+    parser.add_option("-i", "--interval", type="float", default=5.0, help="seconds between two looks at the predictions directory")
+    parser.add_option("-x", "--idle-timeout", dest="idle_timeout", type="float", help="stop after this many seconds without a new prediction file")
+    parser.add_option("-1", "--once", action="store_true", default=False, help="evaluate the prediction files present now and stop")
+
+    ## get options
+    (options, args) = parser.parse_args()
+    tiling_plan = TilingPlan.load(options.tiling) if options.tiling else None
+
+    ## run
+    driver(options.detector, options.original, options.groundtruth, options.predictions, options.reports, tiling_plan, options.store, options.character, options.engine, options.cache,
+           options.threshold, options.ap, options.interval, options.idle_timeout, options.once)
@@ -0,0 +1,85 @@
+"""
+    Checks of the matchers of matching.py, and of the legacy matcher of iou_util.py; run with pytest
+    from the Metrics directory.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from iou_util import MATCHERS, matchedTruePositives
+from matching import greedyMatches, optimalMatches
+
+## 8 point boxes; the prediction order of the vertices differs from the ground truth one, but an
+## axis aligned box lists the same corners either way
+BOX = [0, 0, 10, 0, 10, 10, 0, 10]
+SHIFTED_BOX = [2, 0, 12, 0, 12, 10, 2, 10]
+FAR_BOX = [50, 50, 60, 50, 60, 60, 50, 60]
+
+
+def test_optimal_prefers_more_matches_over_iou():
+    ## P0-G0 and P1-G1 overlap well; taking both leaves P2 without a match, while the weak pairs
+    ## P0-G1, P1-G2 and P2-G0 match all three predictions
+    i = np.array([0, 1, 0, 1, 2])
+    j = np.array([0, 1, 1, 2, 0])
+    iou = np.array([0.95, 0.95, 0.1, 0.1, 0.1])
+    matched = optimalMatches(i, j, iou, 0.1, 3, 3)
+    assert matched.tolist() == [1, 2, 0]
+
+def test_optimal_breaks_ties_on_iou():
+    ## both assignments match two predictions; the one with the larger IoU wins
+    i = np.array([0, 0, 1, 1])
+    j = np.array([0, 1, 0, 1])
+    iou = np.array([0.9, 0.2, 0.3, 0.8])
+    matched = optimalMatches(i, j, iou, 0.1, 2, 2)
+    assert matched.tolist() == [0, 1]
+
+def test_greedy_falls_back_to_the_next_best_match():
+    ## P0 takes G0 first; P1 prefers G0 too, and takes G1 instead
+    i = np.array([0, 1, 1])
+    j = np.array([0, 0, 1])
+    iou = np.array([0.9, 0.8, 0.6])
+    assert greedyMatches(i, j, iou, np.array([0, 1]), 0.5, 2).tolist() == [0, 1]
+    ## in the other order P1 takes G0 and P0 is left without a match
+    assert greedyMatches(i, j, iou, np.array([1, 0]), 0.5, 2).tolist() == [-1, 0]
+
+def test_greedy_tie_takes_the_lowest_ground_truth_index():
+    i = np.array([0, 0])
+    j = np.array([1, 0])
+    iou = np.array([0.7, 0.7])
+    assert greedyMatches(i, j, iou, np.array([0]), 0.5, 1).tolist() == [0]
+
+def test_greedy_tie_between_predictions_goes_to_the_first_in_order():
+    i = np.array([0, 1])
+    j = np.array([0, 0])
+    iou = np.array([0.7, 0.7])
+    assert greedyMatches(i, j, iou, np.array([0, 1]), 0.5, 2).tolist() == [0, -1]
+    assert greedyMatches(i, j, iou, np.array([1, 0]), 0.5, 2).tolist() == [-1, 0]
+
+def test_legacy_tie_between_predictions_goes_to_the_first_in_order():
+    ## two equal predictions share their best match; only the first in matching order is a detection
+    true_positives = matchedTruePositives([BOX], [BOX, BOX], np.array([1, 0]), [0.5], "numpy", "legacy")
+    assert true_positives[0.5].tolist() == [1, 0]
+
+def test_legacy_does_not_fall_back_to_the_next_best_match():
+    ## the second prediction's best match is taken, so it is a false positive even though it
+    ## overlaps the other ground truth annotation above the threshold
+    gt = [BOX, SHIFTED_BOX]
+    true_positives = matchedTruePositives(gt, [SHIFTED_BOX, [3, 0, 13, 0, 13, 10, 3, 10]], np.array([0, 1]), [0.5], "numpy", "legacy")
+    greedy = matchedTruePositives(gt, [SHIFTED_BOX, [3, 0, 13, 0, 13, 10, 3, 10]], np.array([0, 1]), [0.5], "numpy", "greedy")
+    assert true_positives[0.5].tolist() == [1, 0]
+    assert greedy[0.5].tolist() == [1, 1]
+
+@pytest.mark.parametrize("matcher", MATCHERS)
+@pytest.mark.parametrize("engine", ["numpy", "shapely"])
+def test_no_predictions(matcher, engine):
+    true_positives = matchedTruePositives([BOX, FAR_BOX], [], np.arange(0), [0.5, 0.75], engine, matcher)
+    assert {threshold: flags.tolist() for threshold, flags in true_positives.items()} == {0.5: [], 0.75: []}
+
+@pytest.mark.parametrize("matcher", MATCHERS)
+@pytest.mark.parametrize("engine", ["numpy", "shapely"])
+def test_no_ground_truth(matcher, engine):
+    true_positives = matchedTruePositives([], [BOX, FAR_BOX], np.arange(2), [0.5, 0.75], engine, matcher)
+    assert {threshold: flags.tolist() for threshold, flags in true_positives.items()} == {0.5: [0, 0], 0.75: [0, 0]}
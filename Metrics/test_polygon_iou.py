@@ -0,0 +1,78 @@
+"""
+    Checks that the batched quadrilateral IoU of polygon_iou.py agrees with the shapely polygonIOU;
+    run with pytest from the Metrics directory.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from iou_util import groundTruthInidicies, polygonIOU, predictedIndicies
+from polygon_iou import quadIoUMatrix
+
+
+def shapelyIoUMatrix(predicted, gt):
+    ## the pairwise IoU of the shapely engine, in the same vertex orders
+    return np.array([[polygonIOU(Polygon(groundTruthInidicies(g)), Polygon(predictedIndicies(p))) for g in gt] for p in predicted]).reshape(len(predicted), len(gt))
+
+def predictedBox(corners):
+    ## 8 point prediction of the corners (x, y) of a quadrilateral, in the order predictedIndicies reads them
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = corners
+    return [x0, y0, x3, y3, x2, y2, x1, y1]
+
+def groundTruthBox(corners):
+    return [value for corner in corners for value in corner]
+
+def randomQuads(rng, count, convex):
+    ## rotated rectangles when convex, else star shaped quadrilaterals which may have a reflex corner
+    centers = rng.uniform(0, 100, (count, 2))
+    if convex:
+        size = rng.uniform(2, 30, (count, 1, 2))
+        corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * size / 2
+        angle = rng.uniform(0, np.pi, count)
+        rotation = np.stack([np.stack([np.cos(angle), -np.sin(angle)], 1), np.stack([np.sin(angle), np.cos(angle)], 1)], 1)
+        corners = np.einsum("nij,nkj->nki", rotation, corners)
+    else:
+        angles = np.sort(rng.uniform(0, 2 * np.pi, (count, 4)), axis=1)
+        radii = rng.uniform(1, 20, (count, 4))
+        corners = np.stack([radii * np.cos(angles), radii * np.sin(angles)], axis=2)
+    quads = centers[:, None, :] + corners
+    ## shapely can not intersect invalid polygons, so neither engine is checked on them
+    return [quad for quad in quads if Polygon(quad).is_valid]
+
+@pytest.mark.parametrize("convex", [True, False])
+def test_random_quads_match_shapely(convex):
+    rng = np.random.default_rng(11)
+    predicted = [predictedBox(q) for q in randomQuads(rng, 60, convex)]
+    gt = [groundTruthBox(q) for q in randomQuads(rng, 50, convex)]
+    np.testing.assert_allclose(quadIoUMatrix(predicted, gt), shapelyIoUMatrix(predicted, gt), atol=1e-9)
+
+def test_identical_quads():
+    corners = [(10, 10), (40, 12), (38, 30), (9, 28)]
+    iou = quadIoUMatrix([predictedBox(corners)], [groundTruthBox(corners)])
+    assert iou[0, 0] == pytest.approx(1.0)
+    assert iou[0, 0] == pytest.approx(shapelyIoUMatrix([predictedBox(corners)], [groundTruthBox(corners)])[0, 0])
+
+def test_disjoint_quads():
+    predicted = [predictedBox([(0, 0), (10, 0), (10, 10), (0, 10)])]
+    gt = [groundTruthBox([(20, 20), (30, 20), (30, 30), (20, 30)]), groundTruthBox([(10, 0), (20, 0), (20, 10), (10, 10)])]
+    np.testing.assert_array_equal(quadIoUMatrix(predicted, gt), [[0.0, 0.0]])
+    np.testing.assert_array_equal(shapelyIoUMatrix(predicted, gt), [[0.0, 0.0]])
+
+def test_zero_area_quads():
+    ## a line and a point have no area, so their IoU with a box is 0 in both engines
+    predicted = [predictedBox([(0, 5), (20, 5), (20, 5), (0, 5)]), predictedBox([(5, 5), (5, 5), (5, 5), (5, 5)])]
+    gt = [groundTruthBox([(0, 0), (10, 0), (10, 10), (0, 10)])]
+    np.testing.assert_array_equal(quadIoUMatrix(predicted, gt), shapelyIoUMatrix(predicted, gt))
+    np.testing.assert_array_equal(quadIoUMatrix(predicted, gt), [[0.0], [0.0]])
+
+def test_zero_area_pair_raises_like_shapely():
+    ## two boxes without area have an empty union; both engines raise instead of making up an IoU
+    line = [(0, 5), (20, 5), (20, 5), (0, 5)]
+    with pytest.raises(ZeroDivisionError):
+        shapelyIoUMatrix([predictedBox(line)], [groundTruthBox(line)])
+    with pytest.raises(ZeroDivisionError):
+        quadIoUMatrix([predictedBox(line)], [groundTruthBox(line)])
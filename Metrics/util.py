@@ -1,7 +1,11 @@
 import os
 import re
+import sys
 import numpy as np
-import cv2
+
+## the rotated crop transforms are shared with the crop rotation
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataAugmentation"))
+from rotation_table import DEFAULT_ROTATION_TABLE
 
 def res_to_image_anchor(filename, rotated=False):
     """
@@ -65,12 +69,74 @@ def getAnnotationsFromFile(annotation_filename, anchorX, anchorY, angle=0):
     if angle == 0:
         add_anchors = lambda points: [int(x) for x in [points[0] + anchorX, points[1] + anchorY, points[2] + anchorX, points[3] + anchorY, points[4] + anchorX, points[5] + anchorY, points[6] + anchorX, points[7] + anchorY]]
         annotations = [add_anchors(float_points(line)) for line in lines]
+    elif lines:
+        ## all the boxes of a rotated crop are rotated back at once
+        boxes = np.array([float_points(line)[:8] for line in lines])
+        annotations = rotateAnnotationsBatch(boxes, np.tile([anchorX, anchorY], (len(lines), 1)), np.full(len(lines), angle)).tolist()
     else:
-        annotations = [rotateAnnotations(float_points(line), anchorX, anchorY, angle) for line in lines]
+        annotations = []
 
     return annotations
 
+def getScoresFromFile(annotation_filename):
+    """
+    Returns the confidence of every annotation of a file, read from an optional ninth value per line
+    Inputs:
+        - annotation_filename: Full filename of annotation file
+    Outputs:
+        - scores: List of scores, in the order of getAnnotationsFromFile; NaN where a line has no score
+    """
+    with open(annotation_filename) as f:
+        lines = f.read().split("\n")[:-1]
+    values = [line.split(",") for line in lines]
+    return [float(line[8]) if len(line) > 8 and line[8].strip() else float("nan") for line in values]
+
+
 
+def getAnnotationsFromRecords(records):
+    """
+    Returns list of 8 point annotations from binary annotation table records (see annotation_table.py);
+    the table counterpart of getAnnotationsFromFile
+    Inputs:
+        - records: Annotation records, each carrying its own anchor and angle
+    Outputs:
+        - annotations: List of annotations
+    """
+    anchors = np.tile(np.stack([records["anchor_x"], records["anchor_y"]], axis=1), 4)
+    ## int() of the anchored float points, as for the text files
+    annotations = np.trunc(records["box"].astype(np.float64) + anchors).astype(int)
+    rotated = np.flatnonzero(records["angle"] != 0)
+    if len(rotated):
+        annotations[rotated] = rotateAnnotationsBatch(records["box"][rotated].astype(np.float64), anchors[rotated, :2],
+                                                      records["angle"][rotated].astype(np.float64))
+    return annotations.tolist()
+
+
+def rotateAnnotationsBatch(boxes, anchors, angles, rotation_table=DEFAULT_ROTATION_TABLE):
+    """
+    Rotates annotated boxes of rotated crops back, and offsets them by their crop anchors
+    Inputs:
+        - boxes: Float array (N, 8) of the eight point boxes, in rotated crop coordinates
+        - anchors: Int array (N, 2) of the (x, y) anchor of every box's crop
+        - angles: Array (N,) of the angle every box's crop was rotated by
+        - rotation_table: RotationTable of the crops
+    Outputs:
+        - new_boxes: Int array (N, 8) of the boxes on the original image; the values of rotateAnnotations
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4, 2)
+    anchors = np.asarray(anchors).reshape(-1, 1, 2)
+    angles = np.asarray(angles, dtype=np.float64)
+    corners = np.concatenate([boxes, np.ones(boxes.shape[:2] + (1,))], axis=2)
+    new_boxes = np.zeros(boxes.shape, dtype=np.int64)
+
+    for angle in np.unique(angles):
+        rows = np.flatnonzero(angles == angle)
+        box_matrix, offset = rotation_table.inverse(angle)
+        ## one matrix product per angle; optimize hands it to BLAS like the np.dot of a single box, so the
+        ## truncations below see the same values
+        rotated = np.einsum("ij,nkj->nki", box_matrix, corners[rows], optimize=True)
+        new_boxes[rows] = np.trunc(rotated + anchors[rows]).astype(np.int64) + offset
+    return new_boxes.reshape(-1, 8)
 
 def rotateAnnotations(points, anchorX, anchorY, angle):
     """
@@ -83,32 +149,4 @@ def rotateAnnotations(points, anchorX, anchorY, angle):
     Outputs:
         - new_box: The original annotations, rotated back
     """
-    image_default_height = image_default_width = 512
-
-
-    image_center = (512 // 2, 512 // 2)
-    rotation_mat = cv2.getRotationMatrix2D(image_center, angle, scale=1.0)
-    cos = np.abs(rotation_mat[0, 0])
-    sin = np.abs(rotation_mat[0, 1])
-    
-    adjustedWidth = int((image_default_height * sin) + (image_default_width * cos))
-    adjustedHeight = int((image_default_height * cos) + (image_default_width * sin))
-
-    cX, cY = (adjustedWidth // 2, adjustedHeight // 2)
-    ## rotate the box around the center of the original rotated image dimensions
-    box_matrix  = cv2.getRotationMatrix2D((cX, cY), -angle, 1.0)
-    points = np.array(points)
-    corners = points.reshape(-1,2)
-    corners = np.hstack((corners, np.ones((corners.shape[0],1), dtype = type(corners[0][0]))))
-    ## calculate the new box
-    new_box = np.dot(box_matrix, corners.T).T.reshape(1, 8)[0]
-    
-    new_box = [int(x) for x in [new_box[0] + anchorX, new_box[1] + anchorY, new_box[2] + anchorX, new_box[3] + anchorY, new_box[4] + anchorX, new_box[5] + anchorY, new_box[6] + anchorX, new_box[7] + anchorY]]
-    new_box = np.array(new_box)
-    new_box[0::2] += int((image_default_width / 2) - cX)
-    new_box[1::2] += int((image_default_height / 2) - cY)
-    new_box = list(new_box)
-
-    return new_box
-            
-            
\ No newline at end of file
+    return list(rotateAnnotationsBatch([points], [[anchorX, anchorY]], [angle])[0])
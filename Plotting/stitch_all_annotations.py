@@ -8,6 +8,14 @@ import numpy as np
 
 from PIL import Image, ImageDraw
 
+## predictions may also be kept in binary annotation tables
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataWrangling", "Cropping"))
+from annotation_table import is_annotation_table, read_annotation_table
+## the horizontal and rotated predictions are fused as in the metrics
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Metrics"))
+from prediction_fusion import backProjectSource, fusePredictions, isFusedPredictions, joinPredictions, readFusedPredictions
+from util import rotateAnnotationsBatch
+
 def res_to_image_anchor(filename, rotated=False):
     """
         Inputs:
@@ -90,12 +98,51 @@ def create_file_dictionary(original_images_dir, horizontal_annotations_dir, rota
     return image_dict_horizontal, image_dict_rotated
 
 
-def list_crops_to_annotated_image(original_image, horizontal_annotations, rotated_annotations, outfile):
+def create_table_dictionary(original_images_dir, table_names):
+    """
+        Inputs:
+            - original_images_dir: Directory where the original images which were cropped live
+            - table_names: Annotation tables of the predicted crop annotations
+        Outputs:
+            - image_dict: Dictionary of format {
+                (key) image_filename: (value) annotation records of the image, of every table
+            }
+    """
+    image_filenames = glob(os.path.join(original_images_dir, "*.tiff"))
+    image_dict = {}
+    for table_name in table_names:
+        records, map_names, _ = read_annotation_table(table_name)
+        print("Number of annotations: ", len(records))
+        image_dict.update({filename[:-5].split(os.sep)[-1]: records[:0] for filename in image_filenames if filename[:-5].split(os.sep)[-1] not in image_dict})
+        for map_id, image_name in enumerate(map_names):
+            map_records = records[records["map"] == map_id]
+            image_dict[image_name] = np.concatenate([image_dict[image_name], map_records]) if image_name in image_dict else map_records
+    return image_dict
+
+def draw_records(draw, records):
+    """
+        Draws annotation table records the way the text files are drawn: records of horizontal crops
+        as red rectangles, records of rotated crops rotated back by their angle as blue polygons
+        Inputs:
+            - draw: ImageDraw of the original image
+            - records: The annotation records of the image
+    """
+    horizontal = records[records["angle"] == 0]
+    for oriented_box, anchor_x0, anchor_y0 in zip(horizontal["box"].astype(int).tolist(), horizontal["anchor_x"].tolist(), horizontal["anchor_y"].tolist()):
+        draw.rectangle([oriented_box[6] + anchor_x0, oriented_box[7] + anchor_y0, oriented_box[2] + anchor_x0, oriented_box[3] + anchor_y0], outline='red')
+    rotated = records[records["angle"] != 0]
+    if len(rotated):
+        anchors = np.stack([rotated["anchor_x"], rotated["anchor_y"]], axis=1)
+        for new_box in rotateAnnotationsBatch(rotated["box"].astype(np.float64), anchors, rotated["angle"].astype(np.float64)).tolist():
+            draw.polygon(new_box, outline="blue", fill=None)
+
+def list_crops_to_annotated_image(original_image, horizontal_annotations, rotated_annotations, outfile, records=None):
     """
         Inputs:
             - original_image: The image which will be copied and have annotations drawn on it
             - annotations: The annotation filepaths that need to be translated and drawn on the image copy
             - outfile: Where the drawn on image should be saved
+            - records: Optional annotation table records of the image, drawn as well
     """
     print("Stitching Image: ", original_image)
     image = Image.open(original_image)
@@ -146,23 +193,63 @@ def list_crops_to_annotated_image(original_image, horizontal_annotations, rotate
             print("Drawing Box: ", new_box)
             draw.polygon(new_box, outline="blue", fill=None)
 
+    if records is not None:
+        draw_records(draw, records)
+
     del draw
     image.save(outfile)
     print("Image Saved: ", outfile)
 
 
-def driver(original_images_dir, horizontal_predicted_annotations_dir, rotated_predicted_annotations_dir, output_dir):
+def fused_predictions_to_annotated_image(original_image, boxes, outfile):
+    """
+        Inputs:
+            - original_image: The image which will be copied and have annotations drawn on it
+            - boxes: The fused 8 point predictions of the image, in image coordinates
+            - outfile: Where the drawn on image should be saved
+    """
+    print("Stitching Image: ", original_image)
+    image = Image.open(original_image)
+    draw = ImageDraw.Draw(image)
+    for box in boxes.tolist():
+        draw.polygon(box, outline="blue", fill=None)
+    print("Drew %d fused boxes" % len(boxes))
+    del draw
+    image.save(outfile)
+    print("Image Saved: ", outfile)
+
+
+def driver(original_images_dir, horizontal_predicted_annotations_dir, rotated_predicted_annotations_dir, output_dir, merge="nms"):
     """
         Inputs:
             - original_images_dir: Where the uncropped images live
-            - horizontal_predicted_annotations_dir: Where the test time predicted annotations live
-            - rotated_predicted_annotations_dir: Where the test time predicted annotations live
+            - horizontal_predicted_annotations_dir: Where the test time predicted annotations live, an annotation table of them, or a fused prediction file
+            - rotated_predicted_annotations_dir: Where the test time predicted annotations live, or an annotation table of them
             - output_dir: Where the drawn on images live
+            - merge: Merge spec the horizontal and rotated predictions are fused with (see polygon_merge.parseMerge),
+              or "none" to draw both sets as they were predicted
     """
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
+
+    if merge != "none":
+        ## one deduplicated set per map, as evaluated by the metrics
+        if isFusedPredictions(horizontal_predicted_annotations_dir):
+            fused = readFusedPredictions(horizontal_predicted_annotations_dir)
+        else:
+            fused = fusePredictions(joinPredictions(backProjectSource(horizontal_predicted_annotations_dir), backProjectSource(rotated_predicted_annotations_dir, True)), merge)
+        print("Predictions Fused")
+        for i, filename in enumerate(glob(os.path.join(original_images_dir, "*.tiff"))):
+            print("Key #:", i)
+            image = filename[:-5].split(os.sep)[-1]
+            boxes = fused[image][0] if image in fused else np.zeros((0, 8), dtype=np.int64)
+            fused_predictions_to_annotated_image(filename, boxes, os.path.join(output_dir, image + ".jpg"))
+        return
     
     image_dict_horizontal, image_dict_rotated = create_file_dictionary(original_images_dir, horizontal_predicted_annotations_dir, rotated_predicted_annotations_dir)
+    ## either set of predictions may be an annotation table instead; its records carry their angle
+    table_names = [source for source in [horizontal_predicted_annotations_dir, rotated_predicted_annotations_dir] if is_annotation_table(source)]
+    image_dict_records = create_table_dictionary(original_images_dir, table_names) if table_names else {}
     print("Dictionary Created")
     ##print(image_dict)
     for i, image in enumerate(image_dict_horizontal.keys()):
@@ -170,18 +257,20 @@ def driver(original_images_dir, horizontal_predicted_annotations_dir, rotated_pr
         ## pass the function the image filename and the list of annotation files
         original_image_filename = os.path.join(original_images_dir, image + ".tiff")
         outfile = os.path.join(output_dir, image + ".jpg")
-        list_crops_to_annotated_image(original_image_filename, image_dict_horizontal[image], image_dict_rotated[image],outfile)
+        list_crops_to_annotated_image(original_image_filename, image_dict_horizontal[image], image_dict_rotated[image],outfile, image_dict_records.get(image))
 
 original_images_dir = sys.argv[1]
 horizontal_predicted_annotations_dir = sys.argv[2]
 rotated_predicted_annotations_dir = sys.argv[3]
 output_dir = sys.argv[4]
+## optional merge spec of the fusion; "none" draws the horizontal and rotated predictions separately
+merge = sys.argv[5] if len(sys.argv) > 5 else "nms"
 
 print("Ingesting images from:", original_images_dir)
 print("Ingesting horizontal annotations from: ", horizontal_predicted_annotations_dir)
 print("Ingesting rotated annotations from: ", rotated_predicted_annotations_dir)
 print("Saving annotated images to:", output_dir)
 
-driver(original_images_dir, horizontal_predicted_annotations_dir, rotated_predicted_annotations_dir, output_dir)
+driver(original_images_dir, horizontal_predicted_annotations_dir, rotated_predicted_annotations_dir, output_dir, merge)
 
 print("Done Annotating")
\ No newline at end of file
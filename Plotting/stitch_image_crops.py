@@ -6,10 +6,19 @@
 import re
 import os
 import sys
+from functools import partial
 import numpy as np
 from PIL import Image, ImageDraw
 from glob import glob
 
+## predictions may also be kept in a binary annotation table
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataWrangling", "Cropping"))
+from annotation_table import absolute_boxes, is_annotation_table, read_annotation_table
+## the duplicate merge of overlapping crops is shared with the metrics
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Metrics"))
+from polygon_merge import mergeDuplicates, parseMerge
+from util import rotateAnnotationsBatch
+
 ## function to partition the whole predicted files into large files
 ## res_cropped_image_D5005-5028149_800_5000.txt is the format
 
@@ -54,6 +63,63 @@ def create_file_dictionary(original_images_dir, predicted_annotations_dir):
             image_dict[image_name] = [os.path.join(predicted_annotations_dir, filename)]
     return image_dict
 
+def create_table_dictionary(original_images_dir, table_name):
+    """
+        Inputs:
+            - original_images_dir: Directory where the original images which were cropped live
+            - table_name: Annotation table of the predicted crop annotations
+        Outputs:
+            - image_dict: Dictionary of format {
+                (key) image_filename: (value) annotation records of the image
+            }
+    """
+    image_filenames = glob(os.path.join(original_images_dir, "*.tiff"))
+    records, map_names, _ = read_annotation_table(table_name)
+    print("Number of annotations: ", len(records))
+    image_dict = {filename[:-5].split(os.sep)[-1]: records[:0] for filename in image_filenames}
+    for map_id, image_name in enumerate(map_names):
+        image_dict[image_name] = records[records["map"] == map_id]
+    return image_dict
+
+def records_to_boxes(records):
+    """
+        Inputs:
+            - records: Annotation records of one image
+        Outputs:
+            - boxes: Int array (N, 8) of the records on the original image; records of rotated crops
+              are rotated back by their angle, as Metrics/util.getAnnotationsFromRecords does
+            - rotated: Bool array (N,) of the records of rotated crops
+    """
+    boxes = absolute_boxes(records).astype(int)
+    rotated = records["angle"] != 0
+    if rotated.any():
+        anchors = np.stack([records["anchor_x"][rotated], records["anchor_y"][rotated]], axis=1)
+        boxes[rotated] = rotateAnnotationsBatch(records["box"][rotated].astype(np.float64), anchors, records["angle"][rotated].astype(np.float64))
+    return boxes, rotated
+
+def records_to_annotated_image(original_image, records, outfile):
+    """
+        Same as list_crops_to_annotated_image, for annotation table records; the records of rotated
+        crops are rotated back and drawn as blue polygons
+        Inputs:
+            - original_image: The image which will be copied and have annotations drawn on it
+            - records: The annotation records that need to be translated and drawn on the image copy
+            - outfile: Where the drawn on image should be saved
+    """
+    print("Stitching Image: ", original_image)
+    image = Image.open(original_image)
+    draw = ImageDraw.Draw(image)
+    horizontal = records[records["angle"] == 0]
+    oriented_boxes = horizontal["box"].astype(int)
+    for oriented_box, anchor_x0, anchor_y0 in zip(oriented_boxes.tolist(), horizontal["anchor_x"].tolist(), horizontal["anchor_y"].tolist()):
+        draw.rectangle([oriented_box[6] + anchor_x0, oriented_box[7] + anchor_y0, oriented_box[2] + anchor_x0, oriented_box[3] + anchor_y0], outline='red')
+    boxes, rotated = records_to_boxes(records)
+    for new_box in boxes[rotated].tolist():
+        draw.polygon(new_box, outline="blue", fill=None)
+    del draw
+    image.save(outfile)
+    print("Image Saved: ", outfile)
+
 def list_crops_to_annotated_image(original_image, annotations, outfile):
     """
         Inputs:
@@ -76,36 +142,96 @@ def list_crops_to_annotated_image(original_image, annotations, outfile):
     image.save(outfile)
     print("Image Saved: ", outfile)
 
+def boxes_to_annotated_image(original_image, boxes, outfile, rotated=None):
+    """
+        Inputs:
+            - original_image: The image which will be copied and have annotations drawn on it
+            - boxes: The 8 point boxes to draw, already offset onto the original image
+            - outfile: Where the drawn on image should be saved
+            - rotated: Optional flags of the boxes of rotated crops, drawn as blue polygons
+    """
+    print("Stitching Image: ", original_image)
+    image = Image.open(original_image)
+    draw = ImageDraw.Draw(image)
+    for k, oriented_box in enumerate(boxes):
+        if rotated is not None and rotated[k]:
+            draw.polygon(list(oriented_box), outline="blue", fill=None)
+        else:
+            draw.rectangle([oriented_box[6], oriented_box[7], oriented_box[2], oriented_box[3]], outline='red')
+    del draw
+    image.save(outfile)
+    print("Image Saved: ", outfile)
+
+def merged_crops_to_annotated_image(original_image, annotations, outfile, merge):
+    """
+        Same as list_crops_to_annotated_image, with the duplicates of overlapping crops merged first
+        Inputs:
+            - original_image: The image which will be copied and have annotations drawn on it
+            - annotations: The annotation filepaths that need to be translated and drawn on the image copy
+            - outfile: Where the drawn on image should be saved
+            - merge: Merge spec, e.g. nms or wbf:0.5 (see Metrics/polygon_merge.py)
+    """
+    boxes = []
+    for annotation in annotations:
+        _, anchor_x0, anchor_y0 = res_to_image_anchor(annotation)
+        for line in open(annotation).readlines():
+            gt = line.split(',')
+            boxes.append([int(gt[i]) + (anchor_x0 if i % 2 == 0 else anchor_y0) for i in range(8)])
+    method, iou_threshold = parseMerge(merge)
+    merged, _ = mergeDuplicates(boxes, None, iou_threshold, method)
+    print("Boxes merged: %d -> %d" % (len(boxes), len(merged)))
+    boxes_to_annotated_image(original_image, merged, outfile)
+
+def merged_records_to_annotated_image(original_image, records, outfile, merge):
+    """
+        Same as records_to_annotated_image, with the duplicates of overlapping crops merged first;
+        the score column ranks the duplicates when it is filled
+    """
+    boxes, rotated = records_to_boxes(records)
+    method, iou_threshold = parseMerge(merge)
+    merged, kept = mergeDuplicates(boxes.tolist(), records["score"], iou_threshold, method)
+    print("Boxes merged: %d -> %d" % (len(boxes), len(merged)))
+    boxes_to_annotated_image(original_image, merged, outfile, rotated[kept])
+
 
-def driver(original_images_dir, predicted_annotations_dir, output_dir):
+def driver(original_images_dir, predicted_annotations_dir, output_dir, merge=None):
     """
         Inputs:
             - original_images_dir: Where the uncropped images live
-            - predicted_annotations_dir: Where the test time predicted annotations live
+            - predicted_annotations_dir: Where the test time predicted annotations live, or an annotation table of them
             - output_dir: Where the drawn on images live
+            - merge: Optional merge spec for the duplicate boxes of overlapping crops, e.g. nms or wbf:0.5
     """
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
     
-    image_dict = create_file_dictionary(original_images_dir, predicted_annotations_dir)
+    if is_annotation_table(predicted_annotations_dir):
+        image_dict = create_table_dictionary(original_images_dir, predicted_annotations_dir)
+        stitch = partial(merged_records_to_annotated_image, merge=merge) if merge else records_to_annotated_image
+    else:
+        image_dict = create_file_dictionary(original_images_dir, predicted_annotations_dir)
+        print(image_dict)
+        stitch = partial(merged_crops_to_annotated_image, merge=merge) if merge else list_crops_to_annotated_image
     print("Dictionary Created")
-    print(image_dict)
     for i, image in enumerate(image_dict.keys()):
         print("Key #:", i)
         ## pass the function the image filename and the list of annotation files
         original_image_filename = os.path.join(original_images_dir, image + ".tiff")
         outfile = os.path.join(output_dir, image + ".jpg")
-        list_crops_to_annotated_image(original_image_filename, image_dict[image], outfile)
+        stitch(original_image_filename, image_dict[image], outfile)
 
 
 original_images_dir = sys.argv[1]
 predicted_annotations_dir = sys.argv[2]
 output_dir = sys.argv[3]
+merge = sys.argv[4] if len(sys.argv) > 4 else None
 
 print("Ingesting images from:", original_images_dir)
 print("Ingesting annotations from: ", predicted_annotations_dir)
 print("Saving annotated images to:", output_dir)
+if merge:
+    print("Merging duplicate boxes with:", merge)
 
-driver(original_images_dir, predicted_annotations_dir, output_dir)
+driver(original_images_dir, predicted_annotations_dir, output_dir, merge)
 
 print("Done Annotating")
\ No newline at end of file
@@ -8,11 +8,19 @@ import re
 import sys
 from glob import glob
 
-import cv2
 import numpy as np
 
 from PIL import Image, ImageDraw
 
+## the rotation transforms are shared with the crop rotation and the metrics
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataAugmentation"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Metrics"))
+from rotation_table import DEFAULT_ROTATION_TABLE, RotationTable
+from util import rotateAnnotationsBatch
+## predictions may also be kept in a binary annotation table
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "DataWrangling", "Cropping"))
+from annotation_table import is_annotation_table, read_annotation_table
+
 
 ## function to partition the whole predicted files into large files
 ## res_cropped_image_D5005-5028149_800_5000.txt is the format
@@ -59,12 +67,52 @@ def create_file_dictionary(original_images_dir, predicted_annotations_dir):
             image_dict[image_name] = [os.path.join(predicted_annotations_dir, filename)]
     return image_dict
 
-def list_crops_to_annotated_image(original_image, annotations, outfile, image_default_width=512, image_default_height=512):
+def create_table_dictionary(original_images_dir, table_name):
+    """
+        Inputs:
+            - original_images_dir: Directory where the original images which were cropped live
+            - table_name: Annotation table of the predicted crop annotations
+        Outputs:
+            - image_dict: Dictionary of format {
+                (key) image_filename: (value) annotation records of the image
+            }
+    """
+    image_filenames = glob(os.path.join(original_images_dir, "*.tiff"))
+    records, map_names, _ = read_annotation_table(table_name)
+    print("Number of annotations: ", len(records))
+    image_dict = {filename[:-5].split(os.sep)[-1]: records[:0] for filename in image_filenames}
+    for map_id, image_name in enumerate(map_names):
+        image_dict[image_name] = records[records["map"] == map_id]
+    return image_dict
+
+def records_to_annotated_image(original_image, records, outfile, rotation_table=DEFAULT_ROTATION_TABLE):
+    """
+        Same as list_crops_to_annotated_image, for annotation table records; every record is rotated
+        back by its angle column
+        Inputs:
+            - original_image: The image which will be copied and have annotations drawn on it
+            - records: The annotation records that need to be translated and drawn on the image copy
+            - outfile: Where the drawn on image should be saved
+            - rotation_table: RotationTable of the crops
+    """
+    print("Stitching Image: ", original_image)
+    image = Image.open(original_image)
+    draw = ImageDraw.Draw(image)
+    anchors = np.stack([records["anchor_x"], records["anchor_y"]], axis=1)
+    new_boxes = rotateAnnotationsBatch(records["box"].astype(np.float64), anchors, records["angle"].astype(np.float64), rotation_table)
+    for new_box in new_boxes.tolist():
+        draw.polygon(new_box, outline="blue", fill=None)
+    del draw
+    image.save(outfile)
+    print("Image Saved: ", outfile)
+
+def list_crops_to_annotated_image(original_image, annotations, outfile, rotation_table=DEFAULT_ROTATION_TABLE):
     """
         Inputs:
             - original_image: The image which will be copied and have annotations drawn on it
             - annotations: The annotation filepaths that need to be translated and drawn on the image copy
             - outfile: Where the drawn on image should be saved
+            - rotation_table: RotationTable of the crops
     """
     print("Stitching Image: ", original_image)
     image = Image.open(original_image)
@@ -73,34 +121,11 @@ def list_crops_to_annotated_image(original_image, annotations, outfile, image_de
     for annotation in annotations:
         print("Considering annotations from:", annotation)
         _, anchor_x0, anchor_y0, angle = res_to_image_anchor(annotation)
-        for line in open(annotation).readlines():
-            gt = line.split(',')
-            oriented_box = np.array([int(gt[i]) for i in range(8)])
-            
-            ## get the dimensions of the original rotated image
-            image_center = (image_default_width // 2, image_default_height // 2)
-            rotation_mat = cv2.getRotationMatrix2D(image_center, angle, scale=1.0)
-            cos = np.abs(rotation_mat[0, 0])
-            sin = np.abs(rotation_mat[0, 1])
-            
-            adjustedWidth = int((image_default_height * sin) + (image_default_width * cos))
-            adjustedHeight = int((image_default_height * cos) + (image_default_width * sin))
-
-            cX, cY = (adjustedWidth // 2, adjustedHeight // 2)
-            ## rotate the box around the center of the original rotated image dimensions
-            box_matrix  = cv2.getRotationMatrix2D((cX, cY), -angle, 1.0)
-            
-            corners = oriented_box.reshape(-1,2)
-            corners = np.hstack((corners, np.ones((corners.shape[0],1), dtype = type(corners[0][0]))))
-            ## calculate the new box
-            new_box = np.dot(box_matrix, corners.T).T.reshape(1, 8)[0]
-            
-            new_box = [int(x) for x in [new_box[0] + anchor_x0, new_box[1] + anchor_y0, new_box[2] + anchor_x0, new_box[3] + anchor_y0, new_box[4] + anchor_x0, new_box[5] + anchor_y0, new_box[6] + anchor_x0, new_box[7] + anchor_y0]]
-            new_box = np.array(new_box)
-            new_box[0::2] += int((image_default_width / 2) - cX)
-            new_box[1::2] += int((image_default_height / 2) - cY)
-            new_box = list(new_box)
-            
+        oriented_boxes = np.array([[int(gt[i]) for i in range(8)] for gt in [line.split(',') for line in open(annotation).readlines()]]).reshape(-1, 8)
+
+        ## rotate every box of the crop back at once, with the crop's transforms from the rotation table
+        new_boxes = rotateAnnotationsBatch(oriented_boxes, np.tile([anchor_x0, anchor_y0], (len(oriented_boxes), 1)), np.full(len(oriented_boxes), angle), rotation_table)
+        for new_box in new_boxes.tolist():
             print("Drawing Box: ", new_box)
             draw.polygon(new_box, outline="blue", fill=None)
     del draw
@@ -108,17 +133,23 @@ def list_crops_to_annotated_image(original_image, annotations, outfile, image_de
     print("Image Saved: ", outfile)
 
 
-def driver(original_images_dir, predicted_annotations_dir, output_dir):
+def driver(original_images_dir, predicted_annotations_dir, output_dir, rotation_table=DEFAULT_ROTATION_TABLE):
     """
         Inputs:
             - original_images_dir: Where the uncropped images live
-            - predicted_annotations_dir: Where the test time predicted annotations live
+            - predicted_annotations_dir: Where the test time predicted annotations live, or an annotation table of them
             - output_dir: Where the drawn on images live
+            - rotation_table: RotationTable of the crops
     """
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
     
-    image_dict = create_file_dictionary(original_images_dir, predicted_annotations_dir)
+    if is_annotation_table(predicted_annotations_dir):
+        image_dict = create_table_dictionary(original_images_dir, predicted_annotations_dir)
+        stitch = records_to_annotated_image
+    else:
+        image_dict = create_file_dictionary(original_images_dir, predicted_annotations_dir)
+        stitch = list_crops_to_annotated_image
     print("Dictionary Created")
     ##print(image_dict)
     for i, image in enumerate(image_dict.keys()):
@@ -126,17 +157,19 @@ def driver(original_images_dir, predicted_annotations_dir, output_dir):
         ## pass the function the image filename and the list of annotation files
         original_image_filename = os.path.join(original_images_dir, image + ".tiff")
         outfile = os.path.join(output_dir, image + ".jpg")
-        list_crops_to_annotated_image(original_image_filename, image_dict[image], outfile)
+        stitch(original_image_filename, image_dict[image], outfile, rotation_table)
 
 
 original_images_dir = sys.argv[1]
 predicted_annotations_dir = sys.argv[2]
 output_dir = sys.argv[3]
+## optional rotation table saved by rotate_crops; the 512 x 512 crop table is computed otherwise
+rotation_table = RotationTable.load(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_ROTATION_TABLE
 
 print("Ingesting images from:", original_images_dir)
 print("Ingesting annotations from: ", predicted_annotations_dir)
 print("Saving annotated images to:", output_dir)
 
-driver(original_images_dir, predicted_annotations_dir, output_dir)
+driver(original_images_dir, predicted_annotations_dir, output_dir, rotation_table)
 
 print("Done Annotating")
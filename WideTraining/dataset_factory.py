@@ -1,10 +1,42 @@
 """A factory-pattern class which returns classification image/label pairs."""
+import glob
+import json
+import os
+
+import tensorflow as tf
 from datasets import dataset_utils
 
+## written next to the tfrecords by DataWrangling/TFRecords/map_char_text_to_tfrecords.py
+MANIFEST_FILENAME = 'tfrecords_manifest.json'
+
 class DatasetConfig():
-    def __init__(self, file_pattern, split_sizes):
+    def __init__(self, file_pattern, split_sizes, manifest_key=None):
         self.file_pattern = file_pattern
         self.split_sizes = split_sizes
+        self.manifest_key = manifest_key
+
+
+def read_split_size(dataset_dir, manifest_key, file_pattern):
+    """Returns the number of samples of a split from the tfrecords manifest.
+    Args:
+        dataset_dir: The directory where the dataset files are stored.
+        manifest_key: Key of the split in the manifest.
+        file_pattern: Pattern of the split's tfrecords; counted when the
+            directory has no manifest entry for the split.
+    Returns:
+        The number of samples.
+    """
+    manifest_path = os.path.join(dataset_dir, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest_key in manifest:
+            return manifest[manifest_key]['num_samples']
+    ## tfrecords converted before the manifest existed
+    filenames = glob.glob(os.path.join(dataset_dir, file_pattern))
+    if not filenames:
+        raise ValueError('No tfrecords match %s in %s' % (file_pattern, dataset_dir))
+    return sum(sum(1 for _ in tf.python_io.tf_record_iterator(filename)) for filename in filenames)
         
 icdar2013 = DatasetConfig(
         file_pattern = '*_%s.tfrecord', 
@@ -48,72 +80,11 @@ synthtext = DatasetConfig(
     }
 )
 
+## split_name is the character; the sample counts are read from the manifest written by map_char_text_to_tfrecords
 maptext = DatasetConfig(
-    file_pattern = 'char_anots_%s_train.tfrecord',
-    split_sizes = {
-        '0': 20976,
-        '1': 20976,
-        '2': 20976,
-        '3': 20976,
-        '4': 20976,
-        '5': 20976,
-        '6': 20976,
-        '7': 20976,
-        '8': 20976,
-        '9': 20976,
-        'a': 20976,
-        'b': 20976,
-        'c': 20976,
-        'd': 20976,
-        'e': 20976,
-        'f': 20976,
-        'g': 20976,
-        'h': 20976,
-        'i': 20976,
-        'j': 20976,
-        'k': 20976,
-        'l': 20976,
-        'm': 20976,
-        'n': 20976,
-        'o': 20976,
-        'p': 20976,
-        'q': 20976,
-        'r': 20976,
-        's': 20976,
-        't': 20976,
-        'u': 20976,
-        'v': 20976,
-        'w': 20976,
-        'x': 20976,
-        'y': 20976,
-        'z': 20976,
-        'A': 20976,
-        'B': 20976,
-        'C': 20976,
-        'D': 20976,
-        'E': 20976,
-        'F': 20976,
-        'G': 20976,
-        'H': 20976,
-        'I': 20976,
-        'J': 20976,
-        'K': 20976,
-        'L': 20976,
-        'M': 20976,
-        'N': 20976,
-        'O': 20976,
-        'P': 20976,
-        'Q': 20976,
-        'R': 20976,
-        'S': 20976,
-        'T': 20976,
-        'U': 20976,
-        'V': 20976,
-        'W': 20976,
-        'X': 20976,
-        'Y': 20976,
-        'Z': 20976
-    }
+    file_pattern = 'char_anots_%s_train*.tfrecord',
+    split_sizes = None,
+    manifest_key = 'char_anots_%s_train'
 )
 
 datasets_map = {
@@ -144,5 +115,8 @@ def get_dataset(dataset_name, split_name, dataset_dir, reader=None):
         raise ValueError('Name of dataset unknown %s' % dataset_name)
     dataset_config = datasets_map[dataset_name];
     file_pattern = dataset_config.file_pattern
-    num_samples = dataset_config.split_sizes[split_name]
+    if dataset_config.manifest_key is not None:
+        num_samples = read_split_size(dataset_dir, dataset_config.manifest_key % split_name, file_pattern % split_name)
+    else:
+        num_samples = dataset_config.split_sizes[split_name]
     return dataset_utils.get_split(split_name, dataset_dir,file_pattern, num_samples, reader)
\ No newline at end of file